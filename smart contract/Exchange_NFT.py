@@ -27,7 +27,8 @@ class FA2_config:
                  store_total_supply                 = True,
                  lazy_entry_points                  = False,
                  allow_self_transfer                = False,
-                 use_token_metadata_offchain_view   = False
+                 use_token_metadata_offchain_view   = False,
+                 mint_batch_max_size                = 200
                  ):
 
         if debug_mode:
@@ -48,6 +49,8 @@ class FA2_config:
         self.non_fungible = non_fungible
         # Enforce the non-fungibility of the tokens, i.e. the fact
         # that total supply has to be 1.
+        # The ledger is then a `token-id -> owner` map: a transfer is one
+        # overwrite and the total supply of 1 is implied, not stored.
 
         self.readable = readable
         # The `readable` option is a legacy setting that we keep around
@@ -93,6 +96,11 @@ class FA2_config:
 
         self.allow_self_transfer = allow_self_transfer
         # Authorize call of `transfer` entry_point from self
+
+        self.mint_batch_max_size = mint_batch_max_size
+        # The maximum number of tokens minted by one `mint_batch` call, a
+        # batch of this size stays well below the gas limit of an operation;
+        # bigger catalogs have to be split in several batches.
         name = "FA2"
         if debug_mode:
             name += "-debug"
@@ -137,6 +145,7 @@ class Error_message:
     def operators_unsupported(self): return self.make("OPERATORS_UNSUPPORTED")
     def not_admin(self):             return self.make("NOT_ADMIN")
     def not_admin_or_operator(self): return self.make("NOT_ADMIN_OR_OPERATOR")
+    def metadata_view_required(self): return self.make("METADATA_VIEW_REQUIRED")
     def paused(self):                return self.make("PAUSED")
 
 ## The current type for a batched transfer in the specification is as
@@ -193,6 +202,17 @@ class Operator_param:
                       operator = operator,
                       token_id = token_id)
         return sp.set_type_expr(r, self.get_type())
+    def get_for_all_type(self):
+        t = sp.TRecord(
+            owner = sp.TAddress,
+            operator = sp.TAddress)
+        if self.config.force_layouts:
+            t = t.layout(("owner", "operator"))
+        return t
+    def make_for_all(self, owner, operator):
+        r = sp.record(owner = owner,
+                      operator = operator)
+        return sp.set_type_expr(r, self.get_for_all_type())
 
 ## The class `Ledger_key` defines the key type for the main ledger (big-)map:
 ##
@@ -257,6 +277,32 @@ class Operator_set:
         del set[self.make_key(owner, operator, token_id)]
     def is_member(self, set, owner, operator, token_id):
         return set.contains(self.make_key(owner, operator, token_id))
+    # An operator for all moves every token of the owner, it is kept in its
+    # own `(owner, operator)` map.
+    def for_all_inner_type(self):
+        return sp.TRecord(owner = sp.TAddress,
+                          operator = sp.TAddress
+                          ).layout(("owner", "operator"))
+    def for_all_key_type(self):
+        if self.config.readable:
+            return self.for_all_inner_type()
+        else:
+            return sp.TBytes
+    def make_for_all(self):
+        return self.config.my_map(tkey = self.for_all_key_type(), tvalue = sp.TUnit)
+    def make_for_all_key(self, owner, operator):
+        metakey = sp.set_type_expr(sp.record(owner = owner, operator = operator),
+                                   self.for_all_inner_type())
+        if self.config.readable:
+            return metakey
+        else:
+            return sp.pack(metakey)
+    def add_for_all(self, set, owner, operator):
+        set[self.make_for_all_key(owner, operator)] = sp.unit
+    def remove_for_all(self, set, owner, operator):
+        del set[self.make_for_all_key(owner, operator)]
+    def is_member_for_all(self, set, owner, operator):
+        return set.contains(self.make_for_all_key(owner, operator))
 
 class Balance_of:
     def request_type():
@@ -285,7 +331,9 @@ class Token_meta_data:
         sp.set_type(expr, self.get_type())
 
 ## The set of all tokens is represented by a `nat` if we assume that token-ids
-## are consecutive, or by an actual `(set nat)` if not.
+## are consecutive. If not, it is a big-map chaining each token-id to the next
+## minted one, with its cardinal and both ends of the chain, so that minting
+## and membership checks do not load the whole set.
 ##
 ## - Knowing the set of tokens is useful for throwing accurate error messages.
 ## - Previous versions of the specification required this set for functional
@@ -298,23 +346,34 @@ class Token_id_set:
             # The "set" is its cardinal.
             return sp.nat(0)
         else:
-            return sp.set(t = token_id_type)
+            return sp.record(
+                size = sp.nat(0),
+                first = sp.set_type_expr(sp.none, sp.TOption(token_id_type)),
+                last = sp.set_type_expr(sp.none, sp.TOption(token_id_type)),
+                next = self.config.my_map(tkey = token_id_type, tvalue = sp.TOption(token_id_type)))
     def add(self, metaset, v):
         if self.config.assume_consecutive_token_ids:
             sp.verify(metaset == v, message = "Token-IDs should be consecutive")
             metaset.set(sp.max(metaset, v + 1))
         else:
-            metaset.add(v)
+            sp.if ~ metaset.next.contains(v):
+                sp.if metaset.last.is_some():
+                    metaset.next[metaset.last.open_some()] = sp.some(v)
+                sp.else:
+                    metaset.first = sp.some(v)
+                metaset.last = sp.some(v)
+                metaset.next[v] = sp.none
+                metaset.size += 1
     def contains(self, metaset, v):
         if self.config.assume_consecutive_token_ids:
             return (v < metaset)
         else:
-            return metaset.contains(v)
+            return metaset.next.contains(v)
     def cardinal(self, metaset):
         if self.config.assume_consecutive_token_ids:
             return metaset
         else:
-            return sp.len(metaset)
+            return metaset.size
 
 ##
 ## ## Implementation of the Contract
@@ -357,13 +416,20 @@ class FA2_core(sp.Contract):
             self.add_flag("lazy-entry-points")
         self.add_flag("initial-cast")
         self.exception_optimization_level = "default-line"
+        if self.config.non_fungible:
+            ledger = self.config.my_map(tkey = token_id_type, tvalue = sp.TAddress)
+        else:
+            ledger = self.config.my_map(tvalue = Ledger_value.get_type())
         self.init(
-            ledger = self.config.my_map(tvalue = Ledger_value.get_type()),
+            ledger = ledger,
             token_metadata = self.config.my_map(tkey = sp.TNat, tvalue = self.token_meta_data.get_type()),
             total_supply = self.config.my_map(tkey = sp.TNat, tvalue = sp.TNat),
             operators = self.operator_set.make(),
+            operators_for_all = self.operator_set.make_for_all(),
             all_tokens = self.token_id_set.empty(),
             metadata = metadata,
+            metadata_base_uri = sp.bytes("0x"),
+            metadata_defaults = sp.map(tkey = sp.TString, tvalue = sp.TBytes),
             **extra_storage
         )
 
@@ -371,41 +437,39 @@ class FA2_core(sp.Contract):
     def transfer(self, params):
         sp.verify( ~self.is_paused(), message = self.error_message.paused() )
         sp.set_type(params, self.batch_transfer.get_type())
+        # The sender checks do not depend on the transactions, they are
+        # evaluated once for the whole batch.
+        sender_trusted = self.is_administrator(sp.sender)
+        if self.config.allow_self_transfer:
+            sender_trusted |= (sp.sender == sp.self_address)
+        sender_is_trusted = sp.local("sender_is_trusted", sender_trusted)
+        if self.config.support_operator:
+            # (from_, token_id) pairs whose operator membership already passed
+            operator_checked = sp.local("operator_checked",
+                                        sp.set(t = sp.TPair(sp.TAddress, token_id_type)))
         sp.for transfer in params:
            current_from = transfer.from_
            sp.for tx in transfer.txs:
                 if self.config.single_asset:
                     sp.verify(tx.token_id == 0, message = "single-asset: token-id <> 0")
 
-                sender_verify = ((self.is_administrator(sp.sender)) |
-                                (current_from == sp.sender))
-                message = self.error_message.not_owner()
+                sender_verify = sender_is_trusted.value | (current_from == sp.sender)
                 if self.config.support_operator:
-                    message = self.error_message.not_operator()
-                    sender_verify |= (self.operator_set.is_member(self.data.operators,
-                                                                  current_from,
-                                                                  sp.sender,
-                                                                  tx.token_id))
-                if self.config.allow_self_transfer:
-                    sender_verify |= (sp.sender == sp.self_address)
-                sp.verify(sender_verify, message = message)
+                    operator_key = sp.pair(current_from, tx.token_id)
+                    sp.if ~(sender_verify | operator_checked.value.contains(operator_key)):
+                        sp.verify(self.is_operator_of(current_from, sp.sender, tx.token_id),
+                                  message = self.error_message.not_operator())
+                        operator_checked.value.add(operator_key)
+                else:
+                    sp.verify(sender_verify, message = self.error_message.not_owner())
                 sp.verify(
                     self.data.token_metadata.contains(tx.token_id),
                     message = self.error_message.token_undefined()
                 )
                 # If amount is 0 we do nothing now:
                 sp.if (tx.amount > 0):
-                    from_user = self.ledger_key.make(current_from, tx.token_id)
-                    sp.verify(
-                        (self.data.ledger[from_user].balance >= tx.amount),
-                        message = self.error_message.insufficient_balance())
-                    to_user = self.ledger_key.make(tx.to_, tx.token_id)
-                    self.data.ledger[from_user].balance = sp.as_nat(
-                        self.data.ledger[from_user].balance - tx.amount)
-                    sp.if self.data.ledger.contains(to_user):
-                        self.data.ledger[to_user].balance += tx.amount
-                    sp.else:
-                         self.data.ledger[to_user] = Ledger_value.make(tx.amount)
+                    self.ledger_transfer(current_from, tx.to_, tx.token_id, tx.amount)
+                    self.on_transfer(current_from, tx.token_id)
                 sp.else:
                     pass
 
@@ -415,23 +479,13 @@ class FA2_core(sp.Contract):
         sp.verify( ~self.is_paused(), message = self.error_message.paused())
         sp.set_type(params, Balance_of.entry_point_type())
         def f_process_request(req):
-            user = self.ledger_key.make(req.owner, req.token_id)
             sp.verify(self.data.token_metadata.contains(req.token_id), message = self.error_message.token_undefined())
-            sp.if self.data.ledger.contains(user):
-                balance = self.data.ledger[user].balance
-                sp.result(
-                    sp.record(
-                        request = sp.record(
-                            owner = sp.set_type_expr(req.owner, sp.TAddress),
-                            token_id = sp.set_type_expr(req.token_id, sp.TNat)),
-                        balance = balance))
-            sp.else:
-                sp.result(
-                    sp.record(
-                        request = sp.record(
-                            owner = sp.set_type_expr(req.owner, sp.TAddress),
-                            token_id = sp.set_type_expr(req.token_id, sp.TNat)),
-                        balance = 0))
+            sp.result(
+                sp.record(
+                    request = sp.record(
+                        owner = sp.set_type_expr(req.owner, sp.TAddress),
+                        token_id = sp.set_type_expr(req.token_id, sp.TNat)),
+                    balance = self.owned_balance(req.owner, req.token_id)))
         res = sp.local("responses", params.requests.map(f_process_request))
         destination = sp.set_type_expr(params.callback, sp.TContract(Balance_of.response_type()))
         sp.transfer(res.value, sp.mutez(0), destination)
@@ -444,9 +498,39 @@ class FA2_core(sp.Contract):
                 owner = sp.TAddress,
                 token_id = sp.TNat
             ).layout(("owner", "token_id")))
-        user = self.ledger_key.make(req.owner, req.token_id)
         sp.verify(self.data.token_metadata.contains(req.token_id), message = self.error_message.token_undefined())
-        sp.result(self.data.ledger[user].balance)
+        if self.config.non_fungible:
+            sp.result(self.ledger_balance(req.owner, req.token_id))
+        else:
+            user = self.ledger_key.make(req.owner, req.token_id)
+            sp.result(self.data.ledger[user].balance)
+
+    @sp.offchain_view(pure = True)
+    def get_balances(self, requests):
+        """Batched `get_balance`, all the requests are answered in one run."""
+        sp.set_type(requests, sp.TList(Balance_of.request_type()))
+        def f_process_request(req):
+            sp.verify(self.data.token_metadata.contains(req.token_id), message = self.error_message.token_undefined())
+            sp.result(sp.record(request = req, balance = self.owned_balance(req.owner, req.token_id)))
+        sp.result(requests.map(f_process_request))
+
+    @sp.onchain_view()
+    def get_balance_view(self, req):
+        """On-chain version of `get_balance`, unknown owners have a balance of 0."""
+        sp.set_type(
+            req, sp.TRecord(
+                owner = sp.TAddress,
+                token_id = sp.TNat
+            ).layout(("owner", "token_id")))
+        sp.verify(self.data.token_metadata.contains(req.token_id), message = self.error_message.token_undefined())
+        if self.config.non_fungible:
+            sp.result(self.ledger_balance(req.owner, req.token_id))
+        else:
+            user = self.ledger_key.make(req.owner, req.token_id)
+            sp.if self.data.ledger.contains(user):
+                sp.result(self.data.ledger[user].balance)
+            sp.else:
+                sp.result(sp.nat(0))
 
 
     @sp.entry_point
@@ -481,6 +565,87 @@ class FA2_core(sp.Contract):
         else:
             sp.failwith(self.error_message.operators_unsupported())
 
+    @sp.entry_point
+    def update_operators_for_all(self, params):
+        """Approve or revoke an operator for every token of the owner."""
+        sp.set_type(params, sp.TList(
+            sp.TVariant(
+                add_operator = self.operator_param.get_for_all_type(),
+                remove_operator = self.operator_param.get_for_all_type()
+            )
+        ))
+        if self.config.support_operator:
+            sp.for update in params:
+                with update.match_cases() as arg:
+                    with arg.match("add_operator") as upd:
+                        sp.verify(
+                            (upd.owner == sp.sender) | self.is_administrator(sp.sender),
+                            message = self.error_message.not_admin_or_operator()
+                        )
+                        self.operator_set.add_for_all(self.data.operators_for_all,
+                                                      upd.owner,
+                                                      upd.operator)
+                    with arg.match("remove_operator") as upd:
+                        sp.verify(
+                            (upd.owner == sp.sender) | self.is_administrator(sp.sender),
+                            message = self.error_message.not_admin_or_operator()
+                        )
+                        self.operator_set.remove_for_all(self.data.operators_for_all,
+                                                         upd.owner,
+                                                         upd.operator)
+        else:
+            sp.failwith(self.error_message.operators_unsupported())
+
+    # The operators for all of the owner are looked up first, the per token
+    # ones are only read when the owner did not approve the operator for all.
+    def is_operator_of(self, owner, operator, token_id):
+        is_operator = sp.local("is_operator",
+                               self.operator_set.is_member_for_all(self.data.operators_for_all,
+                                                                   owner,
+                                                                   operator))
+        sp.if ~ is_operator.value:
+            is_operator.value = self.operator_set.is_member(self.data.operators,
+                                                            owner,
+                                                            operator,
+                                                            token_id)
+        return is_operator.value
+
+    # Move `amount` of `token_id` in the ledger, `from_` must hold it.
+    def ledger_transfer(self, from_, to_, token_id, amount):
+        if self.config.non_fungible:
+            # the token goes to its new owner with one overwrite
+            sp.verify(
+                (amount == 1) & (self.data.ledger[token_id] == from_),
+                message = self.error_message.insufficient_balance())
+            self.data.ledger[token_id] = to_
+        else:
+            # one read and one write per ledger entry
+            from_user = self.ledger_key.make(from_, token_id)
+            from_balance = sp.local("from_balance",
+                self.data.ledger.get(from_user, Ledger_value.make(0)).balance)
+            sp.verify(
+                (from_balance.value >= amount),
+                message = self.error_message.insufficient_balance())
+            self.data.ledger[from_user] = Ledger_value.make(sp.as_nat(from_balance.value - amount))
+            to_user = self.ledger_key.make(to_, token_id)
+            self.data.ledger[to_user] = Ledger_value.make(
+                self.data.ledger.get(to_user, Ledger_value.make(0)).balance + amount)
+
+    # Called after each non-zero transaction, extended by the rights.
+    def on_transfer(self, from_, token_id):
+        pass
+
+    # The balance of `owner`, 0 when the ledger has no entry for it.
+    def owned_balance(self, owner, token_id):
+        if self.config.non_fungible:
+            return self.ledger_balance(owner, token_id)
+        user = self.ledger_key.make(owner, token_id)
+        return self.data.ledger.get(user, Ledger_value.make(0)).balance
+
+    # The balance of a defined non-fungible token is 1 for its owner, 0 otherwise.
+    def ledger_balance(self, owner, token_id):
+        return sp.eif(self.data.ledger[token_id] == owner, sp.nat(1), sp.nat(0))
+
     # this is not part of the standard but can be supported through inheritance.
     def is_paused(self):
         return sp.bool(False)
@@ -518,28 +683,78 @@ class FA2_mint(FA2_core):
     def mint(self, params):
         sp.verify(self.is_administrator(sp.sender), message = self.error_message.not_admin())
         # We don't check for pauseness because we're the admin.
+        self.mint_token(params)
+
+    @sp.entry_point
+    def mint_batch(self, params):
+        """Mint a list of tokens with one administrator check.
+
+        With `assume_consecutive_token_ids` the whole batch must continue
+        the token-ids, so the new tokens are known not to exist and
+        `all_tokens` is written once."""
+        sp.set_type(params, sp.TList(sp.TRecord(address = sp.TAddress,
+                                                amount = sp.TNat,
+                                                metadata = sp.TMap(sp.TString, sp.TBytes),
+                                                token_id = sp.TNat)))
+        sp.verify(self.is_administrator(sp.sender), message = self.error_message.not_admin())
+        sp.verify(sp.len(params) <= self.config.mint_batch_max_size, message = "mint_batch: too many tokens")
+        if self.config.assume_consecutive_token_ids:
+            next_token_id = sp.local("next_token_id", self.data.all_tokens)
+            sp.for params_item in params:
+                sp.verify(params_item.token_id == next_token_id.value, message = "Token-IDs should be consecutive")
+                next_token_id.value += 1
+                self.mint_token(params_item, new_token = True)
+            self.data.all_tokens = next_token_id.value
+        else:
+            sp.for params_item in params:
+                self.mint_token(params_item)
+
+    def mint_token(self, params, new_token = False):
+        # `new_token` means the caller already checked the token-id is not minted.
         if self.config.single_asset:
             sp.verify(params.token_id == 0, message = "single-asset: token-id <> 0")
         if self.config.non_fungible:
             sp.verify(params.amount == 1, message = "NFT-asset: amount <> 1")
-            sp.verify(
-                ~ self.token_id_set.contains(self.data.all_tokens, params.token_id),
-                message = "NFT-asset: cannot mint twice same token"
-            )
+            if not new_token:
+                sp.verify(
+                    ~ self.token_id_set.contains(self.data.all_tokens, params.token_id),
+                    message = "NFT-asset: cannot mint twice same token"
+                )
         user = self.ledger_key.make(params.address, params.token_id)
-        self.token_id_set.add(self.data.all_tokens, params.token_id)
-        sp.if self.data.ledger.contains(user):
-            self.data.ledger[user].balance += params.amount
-        sp.else:
+        if self.config.non_fungible:
+            # the token is new, its total supply of 1 is implied
+            if not new_token:
+                self.token_id_set.add(self.data.all_tokens, params.token_id)
+            self.data.ledger[params.token_id] = params.address
+            self.data.token_metadata[params.token_id] = sp.record(
+                token_id    = params.token_id,
+                token_info  = params.metadata
+            )
+        elif new_token:
             self.data.ledger[user] = Ledger_value.make(params.amount)
-        sp.if self.data.token_metadata.contains(params.token_id):
-            pass
-        sp.else:
             self.data.token_metadata[params.token_id] = sp.record(
                 token_id    = params.token_id,
                 token_info  = params.metadata
             )
             self.data.total_supply[params.token_id] = params.amount
+        else:
+            self.token_id_set.add(self.data.all_tokens, params.token_id)
+            sp.if self.data.ledger.contains(user):
+                self.data.ledger[user].balance += params.amount
+            sp.else:
+                self.data.ledger[user] = Ledger_value.make(params.amount)
+            sp.if self.data.token_metadata.contains(params.token_id):
+                pass
+            sp.else:
+                self.data.token_metadata[params.token_id] = sp.record(
+                    token_id    = params.token_id,
+                    token_info  = params.metadata
+                )
+                self.data.total_supply[params.token_id] = params.amount
+
+## The "" entry of a token is a full URI, kept as is, when it starts with one of
+## these schemes, otherwise it is a suffix of the base URI.
+metadata_uri_schemes = ["ipfs://", "https://", "http://", "tezos-storage:"]
 
 class FA2_token_metadata(FA2_core):
     def set_token_metadata_view(self):
@@ -551,10 +766,46 @@ class FA2_token_metadata(FA2_core):
             most flexible choice.
             """
             sp.set_type(tok, sp.TNat)
-            sp.result(self.data.token_metadata[tok])
+            sp.result(sp.record(token_id = tok, token_info = self.token_info_of(tok)))
 
         self.token_metadata = sp.offchain_view(pure = True, doc = "Get Token Metadata")(token_metadata)
 
+    # The token-info of a token is the collection defaults updated with the
+    # entries stored for the token, its "" entry is a suffix of the base URI
+    # unless it is a full URI.
+    def token_info_of(self, token_id):
+        token_info = sp.local("token_info", self.data.metadata_defaults)
+        sp.for item in self.data.token_metadata[token_id].token_info.items():
+            token_info.value[item.key] = item.value
+        sp.if token_info.value.contains(""):
+            sp.if ~ self.is_full_uri(token_info.value[""]):
+                token_info.value[""] = sp.concat([self.data.metadata_base_uri, token_info.value[""]])
+        return token_info.value
+
+    def is_full_uri(self, uri):
+        is_full = sp.local("is_full", False)
+        for scheme in metadata_uri_schemes:
+            prefix = sp.utils.bytes_of_string(scheme)
+            sp.if sp.slice(uri, 0, len(scheme)) == sp.some(prefix):
+                is_full.value = True
+        return is_full.value
+
+    @sp.entry_point
+    def set_metadata_base(self, base_uri, defaults):
+        """Set the base URI and the token-info entries shared by every token.
+
+        Minting then only needs the entries a token overrides and the suffix
+        of its URI under the "" key. The shared entries are only served by
+        the `token_metadata` off-chain view, the `token_metadata` big-map
+        keeps the entries of each token, so the view is required."""
+        sp.set_type(base_uri, sp.TBytes)
+        sp.set_type(defaults, sp.TMap(sp.TString, sp.TBytes))
+        if not self.config.use_token_metadata_offchain_view:
+            sp.failwith(self.error_message.metadata_view_required())
+        sp.verify(self.is_administrator(sp.sender), message = self.error_message.not_admin())
+        self.data.metadata_base_uri = base_uri
+        self.data.metadata_defaults = defaults
+
     def make_metadata(symbol, name, decimals):
         "Helper function to build metadata JSON bytes values."
         return (sp.map(l = {
@@ -584,16 +835,96 @@ class FA2(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrator,
         if self.config.assume_consecutive_token_ids:
             sp.result(sp.range(0, self.data.all_tokens))
         else:
-            sp.result(self.data.all_tokens.elements())
+            tokens = sp.local("tokens", sp.list(t = token_id_type))
+            cursor = sp.local("cursor", self.data.all_tokens.first)
+            sp.while cursor.value.is_some():
+                tokens.value.push(cursor.value.open_some())
+                cursor.value = self.data.all_tokens.next[cursor.value.open_some()]
+            sp.result(tokens.value.rev())
+
+    @sp.offchain_view(pure = True)
+    def all_tokens_page(self, params):
+        """A page of `all_tokens`: at most `limit` token ids starting at
+        position `offset`. Without consecutive token ids the chain is walked
+        from the first token, so the cost grows with `offset + limit`: deep
+        pages should be read with `all_tokens_after` instead."""
+        sp.set_type(params, sp.TRecord(offset = sp.TNat, limit = sp.TNat).layout(("offset", "limit")))
+        if self.config.assume_consecutive_token_ids:
+            sp.result(sp.range(sp.min(params.offset, self.data.all_tokens),
+                               sp.min(params.offset + params.limit, self.data.all_tokens)))
+        else:
+            page = sp.local("page", sp.list(t = token_id_type))
+            index = sp.local("index", sp.nat(0))
+            cursor = sp.local("cursor", self.data.all_tokens.first)
+            sp.while cursor.value.is_some() & (index.value < params.offset + params.limit):
+                sp.if index.value >= params.offset:
+                    page.value.push(cursor.value.open_some())
+                index.value += 1
+                cursor.value = self.data.all_tokens.next[cursor.value.open_some()]
+            sp.result(page.value.rev())
+
+    @sp.offchain_view(pure = True)
+    def all_tokens_after(self, params):
+        """At most `limit` token ids minted after `cursor`, from the first
+        token when `cursor` is `None`. The last id of a page is the cursor of
+        the next one, which also works when the token ids are not consecutive.
+        A `cursor` that is not a minted token id fails with FA2_TOKEN_UNDEFINED."""
+        sp.set_type(params, sp.TRecord(cursor = sp.TOption(token_id_type), limit = sp.TNat).layout(("cursor", "limit")))
+        if self.config.assume_consecutive_token_ids:
+            sp.if params.cursor.is_some():
+                sp.verify(params.cursor.open_some() < self.data.all_tokens, message = self.error_message.token_undefined())
+            start = sp.eif(params.cursor.is_some(), params.cursor.open_some() + 1, sp.nat(0))
+            sp.result(sp.range(sp.min(start, self.data.all_tokens),
+                               sp.min(start + params.limit, self.data.all_tokens)))
+        else:
+            page = sp.local("page", sp.list(t = token_id_type))
+            count = sp.local("count", sp.nat(0))
+            sp.if params.cursor.is_some():
+                sp.verify(self.data.all_tokens.next.contains(params.cursor.open_some()), message = self.error_message.token_undefined())
+            cursor = sp.local("cursor", sp.eif(params.cursor.is_some(),
+                                               self.data.all_tokens.next[params.cursor.open_some()],
+                                               self.data.all_tokens.first))
+            sp.while cursor.value.is_some() & (count.value < params.limit):
+                page.value.push(cursor.value.open_some())
+                count.value += 1
+                cursor.value = self.data.all_tokens.next[cursor.value.open_some()]
+            sp.result(page.value.rev())
 
     @sp.offchain_view(pure = True)
     def total_supply(self, tok):
-        if self.config.store_total_supply:
+        if self.config.non_fungible:
+            sp.set_type(tok, sp.TNat)
+            sp.verify(self.data.token_metadata.contains(tok), message = self.error_message.token_undefined())
+            sp.result(sp.nat(1))
+        elif self.config.store_total_supply:
             sp.result(self.data.total_supply[tok])
         else:
             sp.set_type(tok, sp.TNat)
             sp.result("total-supply not supported")
 
+    @sp.offchain_view(pure = True)
+    def owner_of(self, tok):
+        """Get the owner of a non-fungible token."""
+        sp.set_type(tok, sp.TNat)
+        if self.config.non_fungible:
+            sp.verify(self.data.token_metadata.contains(tok), message = self.error_message.token_undefined())
+            sp.result(self.data.ledger[tok])
+        else:
+            sp.result("owner_of only supported for non-fungible tokens")
+
+    @sp.onchain_view()
+    def owner_of_view(self, tok):
+        """On-chain version of `owner_of`, `None` for an undefined token or
+        a fungible contract."""
+        sp.set_type(tok, sp.TNat)
+        if self.config.non_fungible:
+            sp.if self.data.ledger.contains(tok):
+                sp.result(sp.some(self.data.ledger[tok]))
+            sp.else:
+                sp.result(sp.none)
+        else:
+            sp.result(sp.set_type_expr(sp.none, sp.TOption(sp.TAddress)))
+
     @sp.offchain_view(pure = True)
     def is_operator(self, query):
         sp.set_type(query,
@@ -601,12 +932,30 @@ class FA2(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrator,
                                owner = sp.TAddress,
                                operator = sp.TAddress).layout(
                                    ("owner", ("operator", "token_id"))))
-        sp.result(
-            self.operator_set.is_member(self.data.operators,
-                                        query.owner,
-                                        query.operator,
-                                        query.token_id)
-        )
+        sp.result(self.is_operator_of(query.owner, query.operator, query.token_id))
+
+    @sp.onchain_view()
+    def is_operator_view(self, query):
+        """On-chain version of `is_operator`."""
+        sp.set_type(query,
+                    sp.TRecord(token_id = sp.TNat,
+                               owner = sp.TAddress,
+                               operator = sp.TAddress).layout(
+                                   ("owner", ("operator", "token_id"))))
+        sp.result(self.is_operator_of(query.owner, query.operator, query.token_id))
+
+    @sp.offchain_view(pure = True)
+    def are_operators(self, queries):
+        """Batched `is_operator`, all the queries are answered in one run."""
+        sp.set_type(queries,
+                    sp.TList(sp.TRecord(token_id = sp.TNat,
+                                        owner = sp.TAddress,
+                                        operator = sp.TAddress).layout(
+                                            ("owner", ("operator", "token_id")))))
+        def f_process_query(query):
+            sp.result(sp.record(request = query,
+                                is_operator = self.is_operator_of(query.owner, query.operator, query.token_id)))
+        sp.result(queries.map(f_process_query))
 
     def __init__(self, config, metadata, admin):
         # Let's show off some meta-programming:
@@ -622,19 +971,25 @@ class FA2(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrator,
             This view is specified (but optional) in the standard.
 
             This contract is built with assume_consecutive_token_ids =
-            False, so we convert the set of tokens from the storage to a list
-            to fit the expected type of TZIP-16.
+            False, so we walk the chain of token-ids from the storage in
+            minting order to fit the expected type of TZIP-16.
             """
         list_of_views = [
             self.get_balance
             , self.does_token_exist
             , self.count_tokens
             , self.all_tokens
+            , self.all_tokens_page
+            , self.all_tokens_after
             , self.is_operator
+            , self.get_balances
+            , self.are_operators
         ]
 
-        if config.store_total_supply:
+        if config.store_total_supply or config.non_fungible:
             list_of_views = list_of_views + [self.total_supply]
+        if config.non_fungible:
+            list_of_views = list_of_views + [self.owner_of]
         if config.use_token_metadata_offchain_view:
             self.set_token_metadata_view()
             list_of_views = list_of_views + [self.token_metadata]
@@ -686,6 +1041,41 @@ class Viewer(sp.Contract):
     def target(self, params):
         self.data.last = sp.some(params)
 
+## ## 
+##
+## ### Signed order
+##
+## An off-chain listing signed by the seller, it is settled by `Exchange.buySignedNFT`.
+## The `nonce` is chosen by the seller, it can be canceled with `Exchange.cancelSignedOrders`.
+##
+## The seller signs the packed order, so its layout is fixed explicitly: wallets
+## pack the fields as the right comb
+## `(exchange, (seller, (tokenID, (currencyID, (expectedValue, (startTime, (endTime, nonce)))))))`,
+## whatever the `force_layouts` setting or the field order of the record.
+class Signed_order:
+    def get_type():
+        return sp.TRecord(
+            exchange = sp.TAddress,
+            seller = sp.TAddress,
+            tokenID = sp.TNat,
+            currencyID = sp.TNat,
+            expectedValue = sp.TNat,
+            startTime = sp.TTimestamp,
+            endTime = sp.TTimestamp,
+            nonce = sp.TNat).layout(("exchange", ("seller", ("tokenID", ("currencyID",
+                                     ("expectedValue", ("startTime", ("endTime", "nonce"))))))))
+    def make(exchange, seller, tokenID, currencyID, expectedValue, startTime, endTime, nonce):
+        return sp.set_type_expr(
+            sp.record(exchange = exchange,
+                      seller = seller,
+                      tokenID = tokenID,
+                      currencyID = currencyID,
+                      expectedValue = expectedValue,
+                      startTime = startTime,
+                      endTime = endTime,
+                      nonce = nonce),
+            Signed_order.get_type())
+
 ## ## 
 ##
 ## ### Exchange Contract
@@ -697,6 +1087,19 @@ class Viewer(sp.Contract):
 ## param _ftMosAddress: the MOS token contract address
 ## param _ftMozAddress: the MOZ token contract address
 ## 
+## the currency ID of XTZ, the other currency IDs are the FA2 tokens registered in `Exchange.currencies`
+xtz_currency_id = 0
+## the currency ID of MOZ, it follows ftMozAddress and ftMozTokenID
+moz_currency_id = 1
+## the fee of a pool swap, it is left in the pool for the liquidity providers
+pool_fee_per_thousand = 3
+## the window in which queued swaps are netted against each other
+swap_batch_seconds = 300
+## the most swaps queued in a batch, so that settleSwapBatch stays within the gas limit
+swap_batch_max_intents = 100
+## the most offers makeOffer walks past its hint, a closer hint is needed beyond it
+offer_walk_max_steps = 20
+
 class Exchange(sp.Contract):
     ## __init__: constructor function
     def __init__(self, _admin,_mozikNftAddress,_ftMosAddress,_ftMosTokenID, _ftMozAddress,_ftMozTokenID,_bankerAddress):
@@ -713,12 +1116,52 @@ class Exchange(sp.Contract):
             mosPerMozHundred = sp.TNat,            
             # banker who has enouth MOS or MOZ for exchange
             bankerAddress = sp.TAddress,
-            goodsStoreMap = sp.TMap(sp.TNat, sp.TRecord(
+            # the listings keyed by (seller, tokenID), every holder of an editioned token lists its own copies
+            goodsStoreMap = sp.TBigMap(sp.TPair(sp.TAddress, sp.TNat), sp.TRecord(
                 sellerAddress =  sp.TAddress,
-                expectedTokenType = sp.TVariant(choice = sp.TString),
-                expectedTokenAddress = sp.TOption(sp.TAddress), 
+                currencyID = sp.TNat,
+                # the price of one copy and the copies left on sale
                 expectedValue = sp.TNat,
-                startTime = sp.TTimestamp)))
+                quantity = sp.TNat,
+                startTime = sp.TTimestamp,
+                # the listing is expired from endTime, sp.none if it never expires
+                endTime = sp.TOption(sp.TTimestamp),
+                # the token IDs of the previous and next listings in the chain of the seller
+                prev = sp.TOption(sp.TNat),
+                next = sp.TOption(sp.TNat))),
+            # active listings count
+            listingCount = sp.TNat,
+            # the first listing of the chain of each seller and its listings count
+            sellerListings = sp.TBigMap(sp.TAddress, sp.TRecord(first = sp.TOption(sp.TNat), count = sp.TNat)),
+            # the (seller, nonce) of the off-chain signed orders which are used or canceled
+            usedOrderNonces = sp.TBigMap(sp.TPair(sp.TAddress, sp.TNat), sp.TUnit),
+            # MOS and MOZ deposited in the Exchange by each user
+            ftBalances = sp.TBigMap(sp.TRecord(owner = sp.TAddress, fa2 = sp.TAddress, tokenID = sp.TNat), sp.TNat),
+            # MOZ/MOS constant-product pool: reserves held by the Exchange and LP shares
+            poolMozReserve = sp.TNat,
+            poolMosReserve = sp.TNat,
+            poolTotalShares = sp.TNat,
+            poolShares = sp.TBigMap(sp.TAddress, sp.TNat),
+            # the swaps queued in the current batch and the end of its window
+            # the queued swaps with their payout at the rate of the time they were queued
+            swapIntents = sp.TList(sp.TRecord(owner = sp.TAddress, direction = sp.TNat, amount = sp.TNat, payout = sp.TNat)),
+            swapBatchEnd = sp.TTimestamp,
+            # the author of each token, for the offers on any token by an author
+            tokenAuthors = sp.TBigMap(sp.TNat, sp.TNat),
+            # escrowed XTZ offers of the buyers, the offers of a target are linked from the best to the worst price
+            offers = sp.TBigMap(sp.TNat, sp.TRecord(
+                buyer = sp.TAddress,
+                target = sp.TVariant(token = sp.TNat, author = sp.TNat),
+                price = sp.TMutez,
+                prev = sp.TOption(sp.TNat),
+                next = sp.TOption(sp.TNat))),
+            # the best offer of each target
+            bestOffer = sp.TBigMap(sp.TVariant(token = sp.TNat, author = sp.TNat), sp.TNat),
+            nextOfferID = sp.TNat,
+            # the XTZ escrowed by the offers, which the administrator can not withdraw
+            escrowedOffers = sp.TMutez,
+            # the FA2 tokens accepted for payment by their currency ID
+            currencies = sp.TBigMap(sp.TNat, sp.TRecord(fa2 = sp.TAddress, tokenID = sp.TNat)))
         )
 
         # Initialize the contract storage
@@ -731,13 +1174,29 @@ class Exchange(sp.Contract):
             ftMozTokenID = _ftMozTokenID,
             mosPerMozHundred = 500,
             bankerAddress = _bankerAddress,
-            goodsStoreMap = sp.map()
+            goodsStoreMap = sp.big_map(),
+            listingCount = 0,
+            sellerListings = sp.big_map(),
+            usedOrderNonces = sp.big_map(),
+            ftBalances = sp.big_map(),
+            poolMozReserve = 0,
+            poolMosReserve = 0,
+            poolTotalShares = 0,
+            poolShares = sp.big_map(),
+            swapIntents = sp.list([]),
+            swapBatchEnd = sp.timestamp(0),
+            tokenAuthors = sp.big_map(),
+            offers = sp.big_map(),
+            bestOffer = sp.big_map(),
+            nextOfferID = 0,
+            escrowedOffers = sp.mutez(0),
+            currencies = sp.big_map({moz_currency_id: sp.record(fa2 = _ftMozAddress, tokenID = _ftMozTokenID)})
         )
 
     ##
     ## ## WithdrawContractXTZ
     ##
-    ## administroter can withdraw the balance of XTZ frome contract.
+    ## administroter can withdraw the balance of XTZ frome contract, except the XTZ escrowed by the offers.
     ## 
     @sp.entry_point     
     def WithdrawContractXTZ(self,_destination, _amount):
@@ -748,6 +1207,9 @@ class Exchange(sp.Contract):
         # 2. only administrator can withdraw XTZ in  TMutez amount
         sp.verify(sp.sender == self.data.administrator,"only administrator can withdraw XTZ from contract!")  
 
+        # 3. the XTZ escrowed by the offers stays in the contract
+        sp.verify(sp.balance - self.data.escrowedOffers >= _amount, "The XTZ escrowed by the offers can't be withdrawn!")
+
         sp.send(_destination, _amount)    
  
     ## UpdateParameters: 
@@ -778,148 +1240,438 @@ class Exchange(sp.Contract):
         self.data.ftMozTokenID = _ftMozTokenID
         self.data.mosPerMozHundred = _mosPerMozHundred
         self.data.bankerAddress = _bankerAddress
+        self.data.currencies[moz_currency_id] = sp.record(fa2 = _ftMozAddress, tokenID = _ftMozTokenID)
+
+    ## setCurrency: administrator registers the FA2 token accepted for payment with _currencyID
+    @sp.entry_point     
+    def setCurrency(self, _currencyID, _fa2, _tokenID):
+        '"setCurrency"'
+        sp.set_type(_currencyID, sp.TNat)
+        sp.set_type(_fa2, sp.TAddress)
+        sp.set_type(_tokenID, sp.TNat)
+        sp.verify(sp.sender == self.data.administrator, "only administrator can set the currencies!")
+        sp.verify(_currencyID != xtz_currency_id, "The currency ID of XTZ is reserved!")
+        self.data.currencies[_currencyID] = sp.record(fa2 = _fa2, tokenID = _tokenID)
 
     ## sellNFT: sell NFT token by the owner
     ## param _saleTokenID: token ID which to sale.
-    ## param _expectedTokenType: choice = “XTZ” or "MOZ".
-    ## param _tokenAddress: sp.none if expected is “XTZ”, or the tokenAddress KT1... if expected is "MOZ".
-    ## param _value: the amount expected to.
+    ## param _currencyID: xtz_currency_id(0) for XTZ, or the ID of a registered currency, MOZ is 1.
+    ## param _value: the amount expected to for one copy.
+    ## param _quantity: the copies on sale, 1 for a non-fungible token.
     ## param _startTime: the start time to sale.    
+    ## param _endTime: the time the listing expires, sp.none if it never expires.
     @sp.entry_point 
-    def sellNFT(self, _saleTokenID, _expectedTokenType, _tokenAddress, _value, _startTime):
+    def sellNFT(self, _saleTokenID, _currencyID, _value, _quantity, _startTime, _endTime):
         '"sellNFT"'
+        self.sell_goods(_saleTokenID, _currencyID, _value, _quantity, _startTime, _endTime)
 
+    ## sellNFTs: sell several NFT tokens by the owner in one operation.
+    ## param _goodsList: list of the sellNFT parameters without their "_" prefix.
+    @sp.entry_point 
+    def sellNFTs(self, _goodsList):
+        '"sellNFTs"'
+        sp.set_type(_goodsList, sp.TList(sp.TRecord(
+                saleTokenID = sp.TNat,
+                currencyID = sp.TNat,
+                value = sp.TNat,
+                quantity = sp.TNat,
+                startTime = sp.TTimestamp,
+                endTime = sp.TOption(sp.TTimestamp))))
+        sp.for goods in _goodsList:
+            self.sell_goods(goods.saleTokenID, goods.currencyID, goods.value, goods.quantity, goods.startTime, goods.endTime)
+
+    ## sell_goods: check and set the goods in goodsStoreMap for sellNFT and sellNFTs
+    def sell_goods(self, _saleTokenID, _currencyID, _value, _quantity, _startTime, _endTime):
         # 1.fisrt set inputed parameters type
         sp.set_type(_saleTokenID, sp.TNat)
-        sp.set_type(_expectedTokenType, sp.TVariant( choice = sp.TString))
-        sp.set_type(_tokenAddress, sp.TOption(sp.TAddress))
+        sp.set_type(_currencyID, sp.TNat)
         sp.set_type(_value, sp.TNat)
+        sp.set_type(_quantity, sp.TNat)
         sp.set_type(_startTime,sp.TTimestamp)
+        sp.set_type(_endTime, sp.TOption(sp.TTimestamp))
 
-        # 2. Verify the token is not on sale. 
-        sp.verify(~self.data.goodsStoreMap.contains(_saleTokenID), message = "This token is already ON SALE!")
+        # 2. Verify the token is not on sale by the sender. 
+        sp.verify(~self.data.goodsStoreMap.contains(self.listing_key(sp.sender, _saleTokenID)), message = "This token is already ON SALE!")
 
         # 2. Verify the Exchange contract has got the approve of the token 
-        # viewOperator = Viewer(sp.TBool)
-        # mozikNftContract = sp.contract(sp.TRecord(token_id = sp.TNat,
-        #                                           owner = sp.TAddress,
-        #                                           operator = sp.TAddress).layout(("owner", ("operator", "token_id"))), 
-        #                            address = self.data.mozikNftAddress, 
-        #                            entry_point = "is_operator").open_some()
-        # sp.transfer((sp.record(token_id=_saleTokenID,owner=sp.sender, operator=sp.self_address), viewOperator.typed.target),
-        #             sp.mutez(0),
-        #             mozikNftContract)
-
-        # sp.verify(viewOperator.data.last, "The Exchange contract is not the operator of the seller's NFT token!")
-        
-        # 3. Verify sp.sender has the balance of the token is equal to 1
-        # consumer = View_consumer(mozikNftContract)
-        # def arguments_for_balance_of(receiver, reqs):
-        #     return (sp.record(
-        #         callback = sp.contract(
-        #             Balance_of.response_type(),
-        #             receiver.address,
-        #             entry_point = "receive_balances").open_some(),
-        #         requests = reqs))
-        # mozikNftContract.balance_of(arguments_for_balance_of(consumer, [
-        #     sp.record(owner=sp.sender, token_id = _saleTokenID)
-        # ]))
-
-        # sp.verify(consumer.data.last_sum == 1, "The sender doesn't have the token!")
-
-        # 4. Verify the _expectedTokenType is  choice = XTZ or "MOZ"
-        expectedTokenType = _expectedTokenType.open_variant("choice", message = "TVariant is not choice!")
-        sp.verify( ((expectedTokenType ==  "XTZ" ) | (expectedTokenType ==  "MOZ")),
-                    "_expectedTokenType should only be XTZ or MOZ!")
+        isOperator = sp.view("is_operator_view",
+                             self.data.mozikNftAddress,
+                             sp.set_type_expr(sp.record(owner = sp.sender, operator = sp.self_address, token_id = _saleTokenID),
+                                              sp.TRecord(owner = sp.TAddress, operator = sp.TAddress, token_id = sp.TNat).layout(("owner", ("operator", "token_id")))),
+                             t = sp.TBool).open_some(message = "The is_operator_view of the NFT contract is not available!")
+        sp.verify(isOperator, "The Exchange contract is not the operator of the seller's NFT token!")
+
+        # 3. Verify sp.sender has the balance of the token for the copies on sale
+        sp.verify(_quantity > 0, "The quantity must be greater than 0!")
+        sp.verify(self.nft_balance(sp.sender, _saleTokenID) >= _quantity, "The sender doesn't have the token!")
+
+        # 4. Verify the _currencyID is XTZ or a registered currency
+        sp.verify((_currencyID == xtz_currency_id) | self.data.currencies.contains(_currencyID),
+                  "The currency is not registered!")
 
         # # 5. Verify startTime must equal or bigger than the block time(sp.now)
         sp.verify( (_startTime >= sp.now), "The token can't be set saled in the past!")
-
+        sp.if _endTime.is_some():
+            sp.verify(_endTime.open_some() > _startTime, "The listing must end after its start time!")
 
         # 6. set the goods in goodsStoreMap
-        self.data.goodsStoreMap[_saleTokenID] = sp.record(
+        self.add_listing(_saleTokenID, sp.record(
                 sellerAddress =  sp.sender,
-                expectedTokenType = _expectedTokenType,
-                expectedTokenAddress = _tokenAddress, 
+                currencyID = _currencyID,
                 expectedValue = _value,
-                startTime = _startTime )  
+                quantity = _quantity,
+                startTime = _startTime,
+                endTime = _endTime ))
 
             
 
  
-    ## cancelSell: cancel sell the tokenID  NFT token by the owner
+    ## cancelSell: cancel sell the tokenID  NFT token listed by _seller
     @sp.entry_point     
-    def cancelSell(self, _tokenID):
+    def cancelSell(self, _seller, _tokenID):
         '"cancelSell"'
+        self.cancel_goods(_seller, _tokenID)
+
+    ## cancelSells: cancel sell several NFT tokens in one operation
+    ## param _listings: list of the (seller, tokenID) of the listings.
+    @sp.entry_point     
+    def cancelSells(self, _listings):
+        '"cancelSells"'
+        sp.set_type(_listings, sp.TList(self.listing_ref_type()))
+        sp.for listing in _listings:
+            self.cancel_goods(listing.seller, listing.tokenID)
+
+    ## cancelAllMyListings: cancel sell the NFT tokens of the sender, from the latest listed one
+    ## param _limit: the most listings canceled, a large catalog is canceled in several calls.
+    @sp.entry_point     
+    def cancelAllMyListings(self, _limit):
+        '"cancelAllMyListings"'
+        sp.set_type(_limit, sp.TNat)
+        sp.verify(self.data.sellerListings.contains(sp.sender), "The sender has no token on sale!")
+        canceled = sp.local("canceled", sp.nat(0))
+        sp.while (canceled.value < _limit) & self.data.sellerListings.contains(sp.sender):
+            self.remove_listing(sp.sender, self.data.sellerListings[sp.sender].first.open_some())
+            canceled.value += 1
+
+    ## pruneListings: anyone can delete the listings which are expired or whose seller
+    ## does not own the token any more, the other listings are skipped.
+    ## param _listings: the (seller, tokenID) of the listings to check.
+    @sp.entry_point     
+    def pruneListings(self, _listings):
+        '"pruneListings"'
+        sp.set_type(_listings, sp.TList(self.listing_ref_type()))
+        sp.for listing in _listings:
+            key = self.listing_key(listing.seller, listing.tokenID)
+            sp.if self.data.goodsStoreMap.contains(key):
+                goods = sp.local("goods", self.data.goodsStoreMap[key])
+                sp.if self.is_expired(goods.value) | (self.nft_balance(listing.seller, listing.tokenID) < goods.value.quantity):
+                    self.remove_listing(listing.seller, listing.tokenID)
+
+    ## cancel_goods: delete the goods from goodsStoreMap for cancelSell and cancelSells
+    def cancel_goods(self, _seller, _tokenID):
         # 1.fisrt set inputed parameters type
+        sp.set_type(_seller, sp.TAddress)
         sp.set_type(_tokenID, sp.TNat)
 
         # 2. Verify the token is in goodsStoreMap.
-        sp.verify(self.data.goodsStoreMap.contains(_tokenID), "The token is not on sale, no need to cancel!")
+        sp.verify(self.data.goodsStoreMap.contains(self.listing_key(_seller, _tokenID)), "The token is not on sale, no need to cancel!")
 
         # 3. Only the administrator and the seller can do cancel.
         sp.verify(  (sp.sender == self.data.administrator)  \
-                  | (sp.sender == self.data.goodsStoreMap[_tokenID].sellerAddress),
+                  | (sp.sender == _seller),
                    "The sender is neither the administrator nor the seller!")
 
         # 4. cancel selling the token
-        del self.data.goodsStoreMap[_tokenID]
+        self.remove_listing(_seller, _tokenID)
 
 
-    ## buyNFT: buy the on saled tokenID  NFT token 
+    ## buyNFT: buy _amount copies of the tokenID  NFT token on saled by _seller
     @sp.entry_point     
-    def buyNFT(self, _tokenID):
+    def buyNFT(self, _seller, _tokenID, _amount):
         '"buyNFT"'
 
         # 1.fisrt set inputed parameters type
+        sp.set_type(_seller, sp.TAddress)
         sp.set_type(_tokenID, sp.TNat)
+        sp.set_type(_amount, sp.TNat)
+        sp.verify(_amount > 0, "The amount must be greater than 0!")
 
         ## 2. Verify the token is on sale, 
         ## contain the token id and the startTime is equal or bigger than now
-        sp.verify(self.data.goodsStoreMap.contains(_tokenID), "The token is not on sale!")
+        goods = sp.local("goods", self.data.goodsStoreMap.get(self.listing_key(_seller, _tokenID), message = "The token is not on sale!"))
 
         ## 3. Verify the exchange is the operator of the NFT token
         
         # 4. Verify the token is on sale time!
-        sp.verify(self.data.goodsStoreMap[_tokenID].startTime <= sp.now , "The token is not on sale!")
+        sp.verify(goods.value.startTime <= sp.now , "The token is not on sale!")
+        sp.verify(~self.is_expired(goods.value), "The listing is expired!")
 
 
 
         ## 5. Verify the sender is not the buyer.
-        sp.verify((sp.sender != self.data.goodsStoreMap[_tokenID].sellerAddress), "The buy can't be the seller!")
+        sp.verify((sp.sender != _seller), "The buy can't be the seller!")
+
+        #6. pay the seller in XTZ or the registered currency
+        self.pay_seller(_seller, goods.value.currencyID, goods.value.expectedValue * _amount)
+
+        ## 7. transfer the NFT token to the buyer
+        self.fa2_transfer(self.data.mozikNftAddress, _seller, sp.sender, _tokenID, _amount)
+
+        ## 8. update the copies left, del the goods from goodsStoreMap when none is left
+        self.fill_listing(_seller, _tokenID, goods.value, _amount)
 
-        #6.1 if the seller want XTZ
-        sp.if self.data.goodsStoreMap[_tokenID].expectedTokenType.open_variant("choice", message = "TVariant is not choice!") == "XTZ":
+    ## pay_seller: the buyer pays the seller the expected value in XTZ or the registered currency
+    def pay_seller(self, _seller, _currencyID, _expectedValue):
+        #1 if the seller want XTZ
+        sp.if _currencyID == xtz_currency_id:
             ## check the buyer whether has enough XTZ
-            sp.verify( (sp.amount >= sp.utils.nat_to_mutez(self.data.goodsStoreMap[_tokenID].expectedValue)), 
+            sp.verify( (sp.amount >= sp.utils.nat_to_mutez(_expectedValue)), 
                        "Not Enought XTZ for buying!" )
             
             ## transfer XTZ to seller.
             ## if the buyer get more banlance than the expectedValue, all to the seller as fee.
-            sp.send(self.data.goodsStoreMap[_tokenID].sellerAddress, sp.amount, \
-                    "transfer XTZ is failed") 
+            sp.send(_seller, sp.amount, "transfer XTZ is failed") 
          
         sp.else:
-            ## 6.2 if the seller want MOZ, then transfer MOZ to seller
-            sp.if self.data.goodsStoreMap[_tokenID].expectedTokenType.open_variant("choice", message = "TVariant is not choice!") == "MOZ":
-                # transfer MOZ to the seller
-                self.fa2_transfer(self.data.ftMozAddress, sp.sender, \
-                                self.data.goodsStoreMap[_tokenID].sellerAddress, \
-                                self.data.ftMozTokenID, \
-                                self.data.goodsStoreMap[_tokenID].expectedValue)
+            ## 2 if the seller want a registered currency, then transfer it to seller
+            currency = sp.local("currency", self.data.currencies.get(_currencyID, message = "The currency is not registered!"))
+            # pay with the currency deposited in the Exchange if there is enough
+            sp.if self.ft_balance(sp.sender, currency.value.fa2, currency.value.tokenID) >= _expectedValue:
+                self.ft_debit(sp.sender, currency.value.fa2, currency.value.tokenID, _expectedValue)
+                self.ft_credit(_seller, currency.value.fa2, currency.value.tokenID, _expectedValue)
+            # transfer the currency to the seller
+            sp.else:
+                self.fa2_transfer(currency.value.fa2, sp.sender, _seller, currency.value.tokenID, _expectedValue)
 
+    ## buySignedNFT: buy a NFT token listed by the seller with an off-chain signed order,
+    ## nothing is written on-chain for the listing until it is bought.
+    ## param _order: the Signed_order signed by the seller.
+    ## param _sellerKey: the public key of the seller.
+    ## param _signature: the seller's signature of sp.pack(_order).
+    @sp.entry_point     
+    def buySignedNFT(self, _order, _sellerKey, _signature):
+        '"buySignedNFT"'
 
-            ## 6.3 revert
-            sp.else:
-                sp.failwith(message = "only XTZ or MOZ be for buy!")
+        # 1.fisrt set inputed parameters type
+        sp.set_type(_order, Signed_order.get_type())
+        sp.set_type(_sellerKey, sp.TKey)
+        sp.set_type(_signature, sp.TSignature)
+
+        # 2. Verify the order is signed by the seller for this Exchange
+        sp.verify(_order.exchange == sp.self_address, "The order is not for this Exchange!")
+        sp.verify(sp.to_address(sp.implicit_account(sp.hash_key(_sellerKey))) == _order.seller,
+                  "The key is not the seller's key!")
+        sp.verify(sp.check_signature(_sellerKey, _signature, sp.pack(_order)), "The order signature is wrong!")
+
+        # 3. Verify the order is neither used nor canceled, then use it
+        nonceKey = sp.pair(_order.seller, _order.nonce)
+        sp.verify(~self.data.usedOrderNonces.contains(nonceKey), "The order is used or canceled!")
+        self.data.usedOrderNonces[nonceKey] = sp.unit
+
+        # 4. Verify the token is on sale time and the sender is not the seller
+        sp.verify((_order.startTime <= sp.now) & (sp.now <= _order.endTime), "The token is not on sale!")
+        sp.verify((sp.sender != _order.seller), "The buy can't be the seller!")
+
+        # 5. pay the seller and transfer the NFT token to the buyer
+        self.pay_seller(_order.seller, _order.currencyID, _order.expectedValue)
+        self.fa2_transfer(self.data.mozikNftAddress, _order.seller, sp.sender, _order.tokenID, 1)
+
+        # 6. an on-chain listing of the same token by the seller is stale now
+        sp.if self.data.goodsStoreMap.contains(self.listing_key(_order.seller, _order.tokenID)):
+            listed = sp.local("listed", self.data.goodsStoreMap[self.listing_key(_order.seller, _order.tokenID)])
+            self.fill_listing(_order.seller, _order.tokenID, listed.value, 1)
+
+    ## cancelSignedOrders: the seller cancels its off-chain signed orders by their nonces
+    @sp.entry_point     
+    def cancelSignedOrders(self, _nonces):
+        '"cancelSignedOrders"'
+        sp.set_type(_nonces, sp.TList(sp.TNat))
+        sp.for nonce in _nonces:
+            self.data.usedOrderNonces[sp.pair(sp.sender, nonce)] = sp.unit
 
-        ## 7. transfer the NFT token to the buyer
-        self.fa2_transfer(self.data.mozikNftAddress, \
-                          self.data.goodsStoreMap[_tokenID].sellerAddress, \
-                          sp.sender, _tokenID, 1)
+    ## setTokenAuthors: administrator sets the author of tokens for the offers on any token by an author
+    @sp.entry_point     
+    def setTokenAuthors(self, _tokenAuthors):
+        '"setTokenAuthors"'
+        sp.set_type(_tokenAuthors, sp.TList(sp.TRecord(tokenID = sp.TNat, authorID = sp.TNat)))
+        sp.verify(sp.sender == self.data.administrator, "only administrator can set the token authors!")
+        sp.for item in _tokenAuthors:
+            self.data.tokenAuthors[item.tokenID] = item.authorID
+
+    ## makeOffer: the buyer escrows XTZ as a standing offer on a token or on any token by an author.
+    ## The offer is linked after the offers of the target with a better or equal price.
+    ## param _target: token(tokenID) / author(authorID)
+    ## param _hint: an offer of the target with a better or equal price to start the search from,
+    ##   at most `offer_walk_max_steps` offers before the insertion point.
+    @sp.entry_point     
+    def makeOffer(self, _target, _hint):
+        '"makeOffer"'
+        # 1. set inputed parameters type
+        sp.set_type(_target, sp.TVariant(token = sp.TNat, author = sp.TNat))
+        sp.set_type(_hint, sp.TOption(sp.TNat))
+        sp.verify(sp.amount > sp.mutez(0), "The offer must escrow XTZ!")
+
+        # 2. find the offers between which the new offer is linked
+        prev = sp.local("prev", sp.none, t = sp.TOption(sp.TNat))
+        next = sp.local("next", sp.eif(self.data.bestOffer.contains(_target), sp.some(self.data.bestOffer[_target]), sp.none))
+        sp.if _hint.is_some():
+            hint = _hint.open_some()
+            sp.verify(self.data.offers.contains(hint), "The hint offer does not exist!")
+            sp.verify((self.data.offers[hint].target == _target) & (self.data.offers[hint].price >= sp.amount), "Wrong hint offer!")
+            prev.value = _hint
+            next.value = self.data.offers[hint].next
+        steps = sp.local("steps", sp.nat(0))
+        sp.while next.value.is_some() & (self.data.offers[next.value.open_some()].price >= sp.amount):
+            sp.verify(steps.value < offer_walk_max_steps, "Too many offers to walk, give a closer hint!")
+            steps.value += 1
+            prev.value = next.value
+            next.value = self.data.offers[next.value.open_some()].next
+
+        # 3. link the new offer
+        offerID = self.data.nextOfferID
+        self.data.offers[offerID] = sp.record(buyer = sp.sender, target = _target, price = sp.amount, prev = prev.value, next = next.value)
+        sp.if prev.value.is_some():
+            self.data.offers[prev.value.open_some()].next = sp.some(offerID)
+        sp.else:
+            self.data.bestOffer[_target] = offerID
+        sp.if next.value.is_some():
+            self.data.offers[next.value.open_some()].prev = sp.some(offerID)
+        self.data.nextOfferID += 1
+        self.data.escrowedOffers += sp.amount
+
+    ## cancelOffer: the buyer cancels its offer and gets the escrowed XTZ back
+    @sp.entry_point     
+    def cancelOffer(self, _offerID):
+        '"cancelOffer"'
+        sp.set_type(_offerID, sp.TNat)
+        sp.verify(self.data.offers.contains(_offerID), "The offer does not exist!")
+        offer = sp.local("offer", self.data.offers[_offerID])
+        sp.verify(offer.value.buyer == sp.sender, "only the buyer can cancel the offer!")
+        self.unlink_offer(_offerID)
+        sp.send(offer.value.buyer, offer.value.price, "transfer XTZ is failed")
+
+    ## acceptOffer: the owner of a token accepts the best offer of a target, the Exchange must be
+    ## the operator of the token.
+    ## param _target: token(tokenID) / author(authorID)
+    ## param _tokenID: the token sold, it must be the target or by the target author
+    ## param _minPrice: the least price the seller accepts
+    @sp.entry_point     
+    def acceptOffer(self, _target, _tokenID, _minPrice):
+        '"acceptOffer"'
+        # 1. set inputed parameters type
+        sp.set_type(_target, sp.TVariant(token = sp.TNat, author = sp.TNat))
+        sp.set_type(_tokenID, sp.TNat)
+        sp.set_type(_minPrice, sp.TMutez)
+
+        # 2. the token must match the target
+        sp.if _target.is_variant("token"):
+            sp.verify(_target.open_variant("token") == _tokenID, "The token is not the target of the offer!")
+        sp.else:
+            sp.verify(self.data.tokenAuthors.contains(_tokenID) & (self.data.tokenAuthors[_tokenID] == _target.open_variant("author")),
+                      "The token is not by the author of the offer!")
+
+        # 3. take the best offer
+        sp.verify(self.data.bestOffer.contains(_target), "There is no offer for the target!")
+        offer = sp.local("offer", self.data.offers[self.data.bestOffer[_target]])
+        sp.verify(offer.value.price >= _minPrice, "The best offer is lower than the minimum price!")
+        self.unlink_offer(self.data.bestOffer[_target])
+
+        # 4. the copy sold is not on sale anymore
+        sp.if self.data.goodsStoreMap.contains(self.listing_key(sp.sender, _tokenID)):
+            listed = sp.local("listed", self.data.goodsStoreMap[self.listing_key(sp.sender, _tokenID)])
+            self.fill_listing(sp.sender, _tokenID, listed.value, 1)
+
+        # 5. pay the seller and deliver the token to the buyer
+        sp.send(sp.sender, offer.value.price, "transfer XTZ is failed")
+        self.fa2_transfer(self.data.mozikNftAddress, sp.sender, offer.value.buyer, _tokenID, 1)
+
+    ## buyNFTs: buy copies of several on saled NFT tokens in one operation.
+    ## param _items: the seller, token ID and amount of copies of each listing to buy.
+    ## param _ftTotals: the maximum paid in each registered currency, by currency ID.
+    ## XTZ is paid with the transaction amount, the surplus is returned to the buyer.
+    ## Each listing is read once, the payouts are aggregated per seller and
+    ## all the NFT tokens are delivered with one FA2 transfer.
+    @sp.entry_point     
+    def buyNFTs(self, _items, _ftTotals):
+        '"buyNFTs"'
+
+        # 1.fisrt set inputed parameters type
+        sp.set_type(_items, sp.TList(sp.TRecord(seller = sp.TAddress, tokenID = sp.TNat, amount = sp.TNat)))
+        sp.set_type(_ftTotals, sp.TMap(sp.TNat, sp.TNat))
+        sp.verify(sp.len(_items) > 0, "No token to buy!")
+
+        xtzPayouts = sp.local("xtzPayouts", sp.map(tkey = sp.TAddress, tvalue = sp.TMutez))
+        xtzTotal = sp.local("xtzTotal", sp.mutez(0))
+        ftPayouts = sp.local("ftPayouts", sp.map(tkey = sp.TNat, tvalue = sp.TMap(sp.TAddress, sp.TNat)))
+        nftTxs = sp.local("nftTxs", sp.map(tkey = sp.TAddress, tvalue = sp.TList(self.fa2_tx_type())))
+
+        # 2. check every listing and aggregate the payouts per seller
+        sp.for item in _items:
+            ## 2.1 Verify the token is on sale, the copies bought by the previous items are not on sale any more.
+            sp.verify(item.amount > 0, "The amount must be greater than 0!")
+            goods = sp.local("goods", self.data.goodsStoreMap.get(self.listing_key(item.seller, item.tokenID), message = "The token is not on sale!"))
+            sp.verify(goods.value.startTime <= sp.now , "The token is not on sale!")
+            sp.verify(~self.is_expired(goods.value), "The listing is expired!")
+            sp.verify((sp.sender != item.seller), "The buy can't be the seller!")
+            seller = item.seller
+            currencyID = goods.value.currencyID
+            value = goods.value.expectedValue * item.amount
+
+            ## 2.2 the seller want XTZ
+            sp.if currencyID == xtz_currency_id:
+                price = sp.utils.nat_to_mutez(value)
+                xtzTotal.value += price
+                sp.if xtzPayouts.value.contains(seller):
+                    xtzPayouts.value[seller] += price
+                sp.else:
+                    xtzPayouts.value[seller] = price
+            ## 2.3 the seller want a registered currency
+            sp.else:
+                sp.if ~ftPayouts.value.contains(currencyID):
+                    ftPayouts.value[currencyID] = sp.map()
+                ftPayouts.value[currencyID][seller] = ftPayouts.value[currencyID].get(seller, sp.nat(0)) + value
+
+            ## 2.4 the NFT token goes from the seller to the buyer
+            nftTx = sp.record(amount = item.amount, to_ = sp.sender, token_id = item.tokenID)
+            sp.if nftTxs.value.contains(seller):
+                nftTxs.value[seller].push(nftTx)
+            sp.else:
+                nftTxs.value[seller] = sp.list([nftTx])
+
+            ## 2.5 update the copies left, del the goods from goodsStoreMap when none is left,
+            ## the goods read in 2.1 is written back so that each listing is read once
+            self.fill_listing(seller, item.tokenID, goods.value, item.amount)
+
+        # 3. pay XTZ to the sellers and return the surplus to the buyer
+        sp.verify(sp.amount >= xtzTotal.value, "Not Enought XTZ for buying!")
+        sp.for payout in xtzPayouts.value.items():
+            sp.send(payout.key, payout.value, "transfer XTZ is failed")
+        sp.if sp.amount > xtzTotal.value:
+            sp.send(sp.sender, sp.amount - xtzTotal.value, "transfer XTZ is failed")
+
+        # 4. pay each registered currency to the sellers with the currency deposited in the Exchange
+        # if there is enough, otherwise with one FA2 transfer
+        sp.for payouts in ftPayouts.value.items():
+            currency = sp.local("currency", self.data.currencies.get(payouts.key, message = "The currency is not registered!"))
+            ftSum = sp.local("ftSum", sp.nat(0))
+            sp.for payout in payouts.value.values():
+                ftSum.value += payout
+            sp.verify(ftSum.value <= _ftTotals.get(payouts.key, sp.nat(0)), "Not Enought token for buying!")
+            sp.if self.ft_balance(sp.sender, currency.value.fa2, currency.value.tokenID) >= ftSum.value:
+                self.ft_debit(sp.sender, currency.value.fa2, currency.value.tokenID, ftSum.value)
+                sp.for payout in payouts.value.items():
+                    self.ft_credit(payout.key, currency.value.fa2, currency.value.tokenID, payout.value)
+            sp.else:
+                ftTxs = sp.local("ftTxs", sp.list(t = self.fa2_tx_type()))
+                sp.for payout in payouts.value.items():
+                    ftTxs.value.push(sp.record(amount = payout.value, to_ = payout.key, token_id = currency.value.tokenID))
+                self.fa2_batch_transfer(currency.value.fa2, sp.list([sp.record(from_ = sp.sender, txs = ftTxs.value)]))
 
-        ## 8. del the goods from goodsStoreMap
-        del self.data.goodsStoreMap[_tokenID]
+        # 5. deliver all the NFT tokens with one FA2 transfer
+        nftTransfers = sp.local("nftTransfers", sp.list(t = sp.TRecord(from_ = sp.TAddress, txs = sp.TList(self.fa2_tx_type()))))
+        sp.for item in nftTxs.value.items():
+            nftTransfers.value.push(sp.record(from_ = item.key, txs = item.value))
+        self.fa2_batch_transfer(self.data.mozikNftAddress, nftTransfers.value)
 
   ## TokenToTokenSwap: swap MOZ to  MOS with specific exchange rate
     ## param _direction: MOZ_TO_MOS(0) / MOS_TO_MOZ(1)
@@ -956,12 +1708,389 @@ class Exchange(sp.Contract):
             sp.else:
                 sp.failwith(message = "Only MOZ_TO_MOS or MOS_TO_MOZ is supported!")
 
+    ## queueTokenToTokenSwap: queue a TokenToTokenSwap in the current batch, the token in is taken
+    ## from the MOS or MOZ deposited in the Exchange if there is enough, otherwise transferred
+    ## from the sender. The first swap of a batch opens a window of swap_batch_seconds.
+    ## The payout is fixed at the mosPerMozHundred of the time the swap is queued.
+    ## param _direction: MOZ_TO_MOS(0) / MOS_TO_MOZ(1)
+    ## param _tokenAmount: 
+    @sp.entry_point     
+    def queueTokenToTokenSwap(self, _direction, _tokenAmount):
+        '"queueTokenToTokenSwap"'
+        # 1.Define the input parameters type
+        sp.set_type(_direction, sp.TNat)
+        sp.set_type(_tokenAmount, sp.TNat)
+        sp.verify(_tokenAmount > 0, "token amount must be greater than 0!")
+
+        # 2. open a new batch or join the current one
+        sp.if sp.len(self.data.swapIntents) == 0:
+            self.data.swapBatchEnd = sp.now.add_seconds(swap_batch_seconds)
+        sp.else:
+            sp.verify(sp.now < self.data.swapBatchEnd, "The swap batch is closed, settle it first!")
+            sp.verify(sp.len(self.data.swapIntents) < swap_batch_max_intents, "The swap batch is full, settle it first!")
+
+        # 3. take the token in, the swap must pay something out at the current rate
+        ft = self.ft_of(_direction)
+        payout = sp.local("payout", self.swap_payout(_direction, _tokenAmount))
+        sp.verify(payout.value > 0, "The swap pays out 0 token!")
+        self.ft_take(sp.sender, ft.fa2, ft.tokenID, _tokenAmount)
+
+        # 4. queue the swap
+        self.data.swapIntents.push(sp.record(owner = sp.sender, direction = _direction, amount = _tokenAmount, payout = payout.value))
+
+    ## settleSwapBatch: anyone can settle the batch once its window is over. The queued swaps are
+    ## netted against each other at the payouts fixed when they were queued, only the net imbalance goes to or comes from
+    ## the banker, and each token is paid out with one FA2 transfer.
+    @sp.entry_point     
+    def settleSwapBatch(self):
+        '"settleSwapBatch"'
+        # 1. the batch must be over
+        sp.verify(sp.len(self.data.swapIntents) > 0, "The swap batch is empty!")
+        sp.verify(sp.now >= self.data.swapBatchEnd, "The swap batch is not over!")
+
+        # 2. sum the tokens in and out and the payout of each owner
+        mozIn = sp.local("mozIn", sp.nat(0))
+        mosIn = sp.local("mosIn", sp.nat(0))
+        mozPayouts = sp.local("mozPayouts", sp.map(tkey = sp.TAddress, tvalue = sp.TNat))
+        mosPayouts = sp.local("mosPayouts", sp.map(tkey = sp.TAddress, tvalue = sp.TNat))
+        sp.for intent in self.data.swapIntents:
+            ## 2.1 MOZ_TO_MOS
+            sp.if intent.direction == 0:
+                mozIn.value += intent.amount
+                mosPayouts.value[intent.owner] = mosPayouts.value.get(intent.owner, sp.nat(0)) + intent.payout
+            ## 2.2 MOS_TO_MOZ
+            sp.else:
+                mosIn.value += intent.amount
+                mozPayouts.value[intent.owner] = mozPayouts.value.get(intent.owner, sp.nat(0)) + intent.payout
+
+        # 3. pay each token out with one FA2 transfer
+        self.settle_swap_token("moz", self.data.ftMozAddress, self.data.ftMozTokenID, mozIn.value, mozPayouts.value)
+        self.settle_swap_token("mos", self.data.ftMosAddress, self.data.ftMosTokenID, mosIn.value, mosPayouts.value)
+
+        # 4. close the batch
+        self.data.swapIntents = sp.list([])
+
+    ## swap_payout: the MOS (MOZ_TO_MOS) or MOZ (MOS_TO_MOZ) paid for _amount at mosPerMozHundred
+    def swap_payout(self, _direction, _amount):
+        return sp.eif(_direction == 0,
+                      _amount * 100 // self.data.mosPerMozHundred,
+                      _amount * self.data.mosPerMozHundred // 100)
+
+    ## settle_swap_token: one FA2 transfer paying the netted swaps of a token, the banker covers
+    ## the deficit or gets the surplus of the token.
+    def settle_swap_token(self, _name, _fa2, _tokenID, _amountIn, _payouts):
+        txs = sp.local(_name + "Txs", sp.list(t = self.fa2_tx_type()))
+        amountOut = sp.local(_name + "Out", sp.nat(0))
+        sp.for payout in _payouts.items():
+            txs.value.push(sp.record(amount = payout.value, to_ = payout.key, token_id = _tokenID))
+            amountOut.value += payout.value
+        transfers = sp.local(_name + "Transfers", sp.list(t = sp.TRecord(from_ = sp.TAddress, txs = sp.TList(self.fa2_tx_type()))))
+        sp.if _amountIn > amountOut.value:
+            txs.value.push(sp.record(amount = sp.as_nat(_amountIn - amountOut.value), to_ = self.data.bankerAddress, token_id = _tokenID))
+        sp.if sp.len(txs.value) > 0:
+            transfers.value.push(sp.record(from_ = sp.self_address, txs = txs.value))
+        # pushed last so the banker's deficit reaches the Exchange before the payouts
+        sp.if amountOut.value > _amountIn:
+            transfers.value.push(sp.record(from_ = self.data.bankerAddress,
+                                           txs = sp.list([sp.record(amount = sp.as_nat(amountOut.value - _amountIn), to_ = sp.self_address, token_id = _tokenID)])))
+        sp.if sp.len(transfers.value) > 0:
+            self.fa2_batch_transfer(_fa2, transfers.value)
+
+    ## depositFT: deposit MOZ or MOS in the Exchange, the Exchange must be the sender's operator.
+    ## param _token: MOZ(0) / MOS(1)
+    ## param _amount: 
+    @sp.entry_point     
+    def depositFT(self, _token, _amount):
+        '"depositFT"'
+        sp.set_type(_token, sp.TNat)
+        sp.set_type(_amount, sp.TNat)
+
+        ft = self.ft_of(_token)
+        self.fa2_transfer(ft.fa2, sp.sender, sp.self_address, ft.tokenID, _amount)
+        self.ft_credit(sp.sender, ft.fa2, ft.tokenID, _amount)
+
+    ## withdrawFT: withdraw MOZ or MOS deposited in the Exchange.
+    ## param _token: MOZ(0) / MOS(1)
+    ## param _amount: 
+    @sp.entry_point     
+    def withdrawFT(self, _token, _amount):
+        '"withdrawFT"'
+        sp.set_type(_token, sp.TNat)
+        sp.set_type(_amount, sp.TNat)
+
+        ft = self.ft_of(_token)
+        self.ft_debit(sp.sender, ft.fa2, ft.tokenID, _amount)
+        self.fa2_transfer(ft.fa2, sp.self_address, sp.sender, ft.tokenID, _amount)
+
+    ## internalTokenToTokenSwap: TokenToTokenSwap between the MOS and MOZ deposited in the Exchange
+    ## by the sender and by the banker, no FA2 transfer is needed.
+    ## param _direction: MOZ_TO_MOS(0) / MOS_TO_MOZ(1)
+    ## param _tokenAmount: 
+    @sp.entry_point     
+    def internalTokenToTokenSwap(self, _direction, _tokenAmount):
+        '"internalTokenToTokenSwap"'
+        # 1.Define the input parameters type
+        sp.set_type(_direction, sp.TNat)
+        sp.set_type(_tokenAmount, sp.TNat)
+
+        # 2. if direction is MOZ_TO_MOS        
+        sp.if _direction == 0 :
+            mosAmount = sp.local("mosAmount", _tokenAmount * 100  // self.data.mosPerMozHundred)
+            self.ft_debit(sp.sender, self.data.ftMozAddress, self.data.ftMozTokenID, _tokenAmount)
+            self.ft_credit(self.data.bankerAddress, self.data.ftMozAddress, self.data.ftMozTokenID, _tokenAmount)
+            self.ft_debit(self.data.bankerAddress, self.data.ftMosAddress, self.data.ftMosTokenID, mosAmount.value)
+            self.ft_credit(sp.sender, self.data.ftMosAddress, self.data.ftMosTokenID, mosAmount.value)
+
+        # 3. if direction is MOS_TO_MOZ 
+        sp.else:
+            sp.verify(_direction == 1, "Only MOZ_TO_MOS or MOS_TO_MOZ is supported!")
+            mozAmount = sp.local("mozAmount", _tokenAmount * self.data.mosPerMozHundred // 100)
+            self.ft_debit(sp.sender, self.data.ftMosAddress, self.data.ftMosTokenID, _tokenAmount)
+            self.ft_credit(self.data.bankerAddress, self.data.ftMosAddress, self.data.ftMosTokenID, _tokenAmount)
+            self.ft_debit(self.data.bankerAddress, self.data.ftMozAddress, self.data.ftMozTokenID, mozAmount.value)
+            self.ft_credit(sp.sender, self.data.ftMozAddress, self.data.ftMozTokenID, mozAmount.value)
+
+    ## addLiquidity: add MOZ and MOS to the pool in the ratio of its reserves and get LP shares,
+    ## the first provider sets the ratio and gets as many shares as MOZ.
+    ## param _mozAmount: 
+    ## param _maxMos: the most MOS the sender accepts to add
+    ## param _minShares: the least LP shares the sender accepts to get
+    @sp.entry_point     
+    def addLiquidity(self, _mozAmount, _maxMos, _minShares):
+        '"addLiquidity"'
+        # 1.Define the input parameters type
+        sp.set_type(_mozAmount, sp.TNat)
+        sp.set_type(_maxMos, sp.TNat)
+        sp.set_type(_minShares, sp.TNat)
+        sp.verify(_mozAmount > 0, "MOZ amount must be greater than 0!")
+
+        # 2. compute the MOS to add and the shares to mint
+        mosAmount = sp.local("mosAmount", _maxMos)
+        shares = sp.local("shares", _mozAmount)
+        sp.if self.data.poolTotalShares > 0:
+            ## rounded up only if the division has a remainder, in favour of the pool
+            mosAmount.value = _mozAmount * self.data.poolMosReserve // self.data.poolMozReserve
+            sp.if mosAmount.value * self.data.poolMozReserve < _mozAmount * self.data.poolMosReserve:
+                mosAmount.value += 1
+            shares.value = _mozAmount * self.data.poolTotalShares // self.data.poolMozReserve
+        sp.verify(mosAmount.value > 0, "MOS amount must be greater than 0!")
+        sp.verify(mosAmount.value <= _maxMos, "Too much MOS is required!")
+        sp.verify(shares.value >= _minShares, "Too few LP shares!")
+
+        # 3. update the pool
+        self.data.poolMozReserve += _mozAmount
+        self.data.poolMosReserve += mosAmount.value
+        self.data.poolTotalShares += shares.value
+        self.data.poolShares[sp.sender] = self.data.poolShares.get(sp.sender, sp.nat(0)) + shares.value
+
+        # 4. take MOZ and MOS from the sender's deposits or accounts
+        self.ft_take(sp.sender, self.data.ftMozAddress, self.data.ftMozTokenID, _mozAmount)
+        self.ft_take(sp.sender, self.data.ftMosAddress, self.data.ftMosTokenID, mosAmount.value)
+
+    ## removeLiquidity: burn LP shares and get back their part of the MOZ and MOS reserves
+    ## param _shares: 
+    ## param _minMoz: the least MOZ the sender accepts to get
+    ## param _minMos: the least MOS the sender accepts to get
+    @sp.entry_point     
+    def removeLiquidity(self, _shares, _minMoz, _minMos):
+        '"removeLiquidity"'
+        # 1.Define the input parameters type
+        sp.set_type(_shares, sp.TNat)
+        sp.set_type(_minMoz, sp.TNat)
+        sp.set_type(_minMos, sp.TNat)
+        sp.verify(_shares > 0, "LP shares must be greater than 0!")
+        sp.verify(self.data.poolShares.get(sp.sender, sp.nat(0)) >= _shares, "Not enough LP shares!")
+
+        # 2. compute the MOZ and MOS to return
+        mozAmount = sp.local("mozAmount", _shares * self.data.poolMozReserve // self.data.poolTotalShares)
+        mosAmount = sp.local("mosAmount", _shares * self.data.poolMosReserve // self.data.poolTotalShares)
+        sp.verify(mozAmount.value >= _minMoz, "Too little MOZ out!")
+        sp.verify(mosAmount.value >= _minMos, "Too little MOS out!")
+
+        # 3. update the pool, providers without shares are removed
+        self.data.poolMozReserve = sp.as_nat(self.data.poolMozReserve - mozAmount.value)
+        self.data.poolMosReserve = sp.as_nat(self.data.poolMosReserve - mosAmount.value)
+        self.data.poolTotalShares = sp.as_nat(self.data.poolTotalShares - _shares)
+        sp.if self.data.poolShares[sp.sender] == _shares:
+            del self.data.poolShares[sp.sender]
+        sp.else:
+            self.data.poolShares[sp.sender] = sp.as_nat(self.data.poolShares[sp.sender] - _shares)
+
+        # 4. transfer MOZ and MOS from the Exchange to the sender
+        self.fa2_transfer(self.data.ftMozAddress, sp.self_address, sp.sender, self.data.ftMozTokenID, mozAmount.value)
+        self.fa2_transfer(self.data.ftMosAddress, sp.self_address, sp.sender, self.data.ftMosTokenID, mosAmount.value)
+
+    ## poolSwap: swap MOZ and MOS against the pool at the constant-product price,
+    ## no banker is involved.
+    ## param _direction: MOZ_TO_MOS(0) / MOS_TO_MOZ(1)
+    ## param _tokenAmount: 
+    ## param _minOut: the least token the sender accepts to get
+    @sp.entry_point     
+    def poolSwap(self, _direction, _tokenAmount, _minOut):
+        '"poolSwap"'
+        # 1.Define the input parameters type
+        sp.set_type(_direction, sp.TNat)
+        sp.set_type(_tokenAmount, sp.TNat)
+        sp.set_type(_minOut, sp.TNat)
+        sp.verify(_tokenAmount > 0, "token amount must be greater than 0!")
+        sp.verify(self.data.poolTotalShares > 0, "The pool is empty!")
+
+        # 2. if direction is MOZ_TO_MOS        
+        sp.if _direction == 0 :
+            mosAmount = sp.local("mosAmount", self.pool_out(_tokenAmount, self.data.poolMozReserve, self.data.poolMosReserve))
+            sp.verify((mosAmount.value > 0) & (mosAmount.value >= _minOut), "Too little token out!")
+            self.data.poolMozReserve += _tokenAmount
+            self.data.poolMosReserve = sp.as_nat(self.data.poolMosReserve - mosAmount.value)
+            self.ft_take(sp.sender, self.data.ftMozAddress, self.data.ftMozTokenID, _tokenAmount)
+            self.fa2_transfer(self.data.ftMosAddress, sp.self_address, sp.sender, self.data.ftMosTokenID, mosAmount.value)
+
+        # 3. if direction is MOS_TO_MOZ 
+        sp.else:
+            sp.verify(_direction == 1, "Only MOZ_TO_MOS or MOS_TO_MOZ is supported!")
+            mozAmount = sp.local("mozAmount", self.pool_out(_tokenAmount, self.data.poolMosReserve, self.data.poolMozReserve))
+            sp.verify((mozAmount.value > 0) & (mozAmount.value >= _minOut), "Too little token out!")
+            self.data.poolMosReserve += _tokenAmount
+            self.data.poolMozReserve = sp.as_nat(self.data.poolMozReserve - mozAmount.value)
+            self.ft_take(sp.sender, self.data.ftMosAddress, self.data.ftMosTokenID, _tokenAmount)
+            self.fa2_transfer(self.data.ftMozAddress, sp.self_address, sp.sender, self.data.ftMozTokenID, mozAmount.value)
+
+    ## pool_out: the token out of a pool swap of _amountIn, the fee stays in the pool
+    def pool_out(self, _amountIn, _reserveIn, _reserveOut):
+        amountInWithFee = _amountIn * (1000 - pool_fee_per_thousand)
+        return amountInWithFee * _reserveOut // (_reserveIn * 1000 + amountInWithFee)
+
+    ## ft_of: the FA2 address and token ID of MOZ(0) / MOS(1)
+    def ft_of(self, _token):
+        sp.verify((_token == 0) | (_token == 1), "Only MOZ(0) or MOS(1) is supported!")
+        return sp.eif(_token == 0,
+                      sp.record(fa2 = self.data.ftMozAddress, tokenID = self.data.ftMozTokenID),
+                      sp.record(fa2 = self.data.ftMosAddress, tokenID = self.data.ftMosTokenID))
+
+    ## ft_balance: the MOS or MOZ deposited in the Exchange by _owner
+    def ft_balance(self, _owner, _fa2, _tokenID):
+        return self.data.ftBalances.get(sp.record(owner = _owner, fa2 = _fa2, tokenID = _tokenID), sp.nat(0))
+
+    ## ft_credit: add _amount to the MOS or MOZ deposited in the Exchange by _owner
+    def ft_credit(self, _owner, _fa2, _tokenID, _amount):
+        key = sp.record(owner = _owner, fa2 = _fa2, tokenID = _tokenID)
+        self.data.ftBalances[key] = self.ft_balance(_owner, _fa2, _tokenID) + _amount
+
+    ## ft_debit: remove _amount from the MOS or MOZ deposited in the Exchange by _owner,
+    ## empty balances are deleted.
+    def ft_debit(self, _owner, _fa2, _tokenID, _amount):
+        key = sp.record(owner = _owner, fa2 = _fa2, tokenID = _tokenID)
+        sp.verify(self.ft_balance(_owner, _fa2, _tokenID) >= _amount, "Not enough token deposited in the Exchange!")
+        sp.if self.ft_balance(_owner, _fa2, _tokenID) == _amount:
+            del self.data.ftBalances[key]
+        sp.else:
+            self.data.ftBalances[key] = sp.as_nat(self.ft_balance(_owner, _fa2, _tokenID) - _amount)
+
+    ## ft_take: take _amount of MOS or MOZ from the deposit of _owner in the Exchange if there is enough,
+    ## otherwise transfer it from the account of _owner to the Exchange.
+    def ft_take(self, _owner, _fa2, _tokenID, _amount):
+        sp.if self.ft_balance(_owner, _fa2, _tokenID) >= _amount:
+            self.ft_debit(_owner, _fa2, _tokenID, _amount)
+        sp.else:
+            self.fa2_transfer(_fa2, _owner, sp.self_address, _tokenID, _amount)
+
+    ## unlink_offer: delete an offer and link its previous and next offers together
+    def unlink_offer(self, _offerID):
+        unlinked = sp.local("unlinked", self.data.offers[_offerID])
+        del self.data.offers[_offerID]
+        self.data.escrowedOffers -= unlinked.value.price
+        sp.if unlinked.value.prev.is_some():
+            self.data.offers[unlinked.value.prev.open_some()].next = unlinked.value.next
+        sp.else:
+            sp.if unlinked.value.next.is_some():
+                self.data.bestOffer[unlinked.value.target] = unlinked.value.next.open_some()
+            sp.else:
+                del self.data.bestOffer[unlinked.value.target]
+        sp.if unlinked.value.next.is_some():
+            self.data.offers[unlinked.value.next.open_some()].prev = unlinked.value.prev
+
+    ## is_expired: the listing has an end time which is reached
+    def is_expired(self, _goods):
+        return _goods.endTime.is_some() & (_goods.endTime.open_some() <= sp.now)
+
+    ## nft_balance: the balance of _owner for the NFT token, read with the on-chain view of the NFT contract
+    def nft_balance(self, _owner, _tokenID):
+        return sp.view("get_balance_view",
+                       self.data.mozikNftAddress,
+                       sp.set_type_expr(sp.record(owner = _owner, token_id = _tokenID),
+                                        sp.TRecord(owner = sp.TAddress, token_id = sp.TNat).layout(("owner", "token_id"))),
+                       t = sp.TNat).open_some(message = "The get_balance_view of the NFT contract is not available!")
+
+    ## listing_key: the key of the listing of _tokenID by _seller in goodsStoreMap
+    def listing_key(self, _seller, _tokenID):
+        return sp.pair(_seller, _tokenID)
+
+    ## listing_ref_type: the parameter type naming a listing
+    def listing_ref_type(self):
+        return sp.TRecord(seller = sp.TAddress, tokenID = sp.TNat)
+
+    ## add_listing: put the goods in goodsStoreMap at the head of its seller's chain
+    def add_listing(self, _tokenID, _goods):
+        seller = _goods.sellerAddress
+        head = sp.local("head", self.data.sellerListings.get(seller, sp.record(first = sp.none, count = sp.nat(0))))
+        self.data.goodsStoreMap[self.listing_key(seller, _tokenID)] = sp.record(
+                sellerAddress = seller,
+                currencyID = _goods.currencyID,
+                expectedValue = _goods.expectedValue,
+                quantity = _goods.quantity,
+                startTime = _goods.startTime,
+                endTime = _goods.endTime,
+                prev = sp.none,
+                next = head.value.first)
+        sp.if head.value.first.is_some():
+            self.data.goodsStoreMap[self.listing_key(seller, head.value.first.open_some())].prev = sp.some(_tokenID)
+        self.data.sellerListings[seller] = sp.record(first = sp.some(_tokenID), count = head.value.count + 1)
+        self.data.listingCount += 1
+
+    ## fill_listing: _amount copies of the listed token are sold, the goods is deleted when none is left.
+    ## _goods is the local the caller read the listing into, it is written back without reading it again.
+    def fill_listing(self, _seller, _tokenID, _goods, _amount):
+        sp.verify(_goods.quantity >= _amount, "Not enough copies on sale!")
+        sp.if _goods.quantity == _amount:
+            self.remove_listing(_seller, _tokenID, _goods)
+        sp.else:
+            _goods.quantity = sp.as_nat(_goods.quantity - _amount)
+            self.data.goodsStoreMap[self.listing_key(_seller, _tokenID)] = _goods
+
+    ## remove_listing: delete the goods of _seller from goodsStoreMap and unlink it from its seller's chain,
+    ## sellers without listings are removed from sellerListings.
+    ## _goods: the listing if the caller already read it.
+    def remove_listing(self, _seller, _tokenID, _goods = None):
+        seller = sp.local("seller", _seller)
+        if _goods is None:
+            _goods = sp.local("removed", self.data.goodsStoreMap[self.listing_key(seller.value, _tokenID)]).value
+        del self.data.goodsStoreMap[self.listing_key(seller.value, _tokenID)]
+        self.data.listingCount = sp.as_nat(self.data.listingCount - 1)
+        sp.if _goods.prev.is_some():
+            self.data.goodsStoreMap[self.listing_key(seller.value, _goods.prev.open_some())].next = _goods.next
+        sp.else:
+            self.data.sellerListings[seller.value].first = _goods.next
+        sp.if _goods.next.is_some():
+            self.data.goodsStoreMap[self.listing_key(seller.value, _goods.next.open_some())].prev = _goods.prev
+        sp.if self.data.sellerListings[seller.value].count == 1:
+            del self.data.sellerListings[seller.value]
+        sp.else:
+            self.data.sellerListings[seller.value].count = sp.as_nat(self.data.sellerListings[seller.value].count - 1)
+
     ## fa2_transfer: 
     ## 
     ## 
     def fa2_transfer(self, fa2, from_, to_, objkt_id, objkt_amount):
         c = sp.contract(sp.TList(sp.TRecord(from_=sp.TAddress, txs=sp.TList(sp.TRecord(amount=sp.TNat, to_=sp.TAddress, token_id=sp.TNat).layout(("to_", ("token_id", "amount")))))), fa2, entry_point='transfer').open_some()
         sp.transfer(sp.list([sp.record(from_=from_, txs=sp.list([sp.record(amount=objkt_amount, to_=to_, token_id=objkt_id)]))]), sp.mutez(0), c)
+
+    ## fa2_tx_type: the type of a transaction in an FA2 transfer
+    def fa2_tx_type(self):
+        return sp.TRecord(amount=sp.TNat, to_=sp.TAddress, token_id=sp.TNat).layout(("to_", ("token_id", "amount")))
+
+    ## fa2_batch_transfer: one FA2 transfer with several from_/txs items
+    def fa2_batch_transfer(self, fa2, transfers):
+        c = sp.contract(sp.TList(sp.TRecord(from_=sp.TAddress, txs=sp.TList(self.fa2_tx_type()))), fa2, entry_point='transfer').open_some()
+        sp.transfer(transfers, sp.mutez(0), c)
  
       
 
@@ -1191,6 +2320,16 @@ def add_test(config, is_default = True):
 
             scenario.h1("Begin sell NFT")
             scenario.h2("Approve NFT to EXCHANGE and set sellNFT token 0 / 1 /2")
+            #6.1 bob has token 1 but didn't approve the EXCHANGE yet, FAIL
+            exchange.sellNFT(
+                _saleTokenID = 1,
+                _currencyID = 0,
+                _value = sp.nat(1000000),
+                _quantity = 1,
+                _startTime = sp.timestamp(1627101952),
+                _endTime = sp.none
+            ).run(sender = bob, now = sp.timestamp(1627101900), valid = False)
+
             #7. add operator for NFT to EXCHANGE contract
             nftContract.update_operators([
                 sp.variant("add_operator", ftContract.operator_param.make(
@@ -1211,41 +2350,80 @@ def add_test(config, is_default = True):
                     token_id = 3))                    
                     ]).run(sender = bob) 
 
+            #7.1 alice doesn't have token 1 and didn't approve the EXCHANGE, FAIL
+            exchange.sellNFT(
+                _saleTokenID = 1,
+                _currencyID = 0,
+                _value = sp.nat(1000000),
+                _quantity = 1,
+                _startTime = sp.timestamp(1627101952),
+                _endTime = sp.none
+            ).run(sender = alice, now = sp.timestamp(1627101900), valid = False)
+
+            #7.2 alice approved the EXCHANGE for token 1 but doesn't have it, FAIL
+            aliceApproval = nftContract.operator_param.make(
+                    owner = alice.address,
+                    operator = exchange.address,
+                    token_id = 1)
+            nftContract.update_operators([sp.variant("add_operator", aliceApproval)]).run(sender = alice)
+            exchange.sellNFT(
+                _saleTokenID = 1,
+                _currencyID = 0,
+                _value = sp.nat(1000000),
+                _quantity = 1,
+                _startTime = sp.timestamp(1627101952),
+                _endTime = sp.none
+            ).run(sender = alice, now = sp.timestamp(1627101900), valid = False)
+            nftContract.update_operators([sp.variant("remove_operator", aliceApproval)]).run(sender = alice)
+
             #8. sell NFT, see token id = 0 for 1 xtz from 2021-07-22 09:33:50 BJ Time
             exchange.sellNFT(
                 _saleTokenID = 1,
-                _expectedTokenType = sp.variant("choice", "XTZ"),
-                _tokenAddress = sp.none,
+                _currencyID = 0,
                 _value = sp.nat(1000000),
-                _startTime = sp.timestamp(1627101952)
+                _quantity = 1,
+                _startTime = sp.timestamp(1627101952),
+                _endTime = sp.none
             ).run(sender = bob, now = sp.timestamp(1627101900))
 
             #9. sell NFT, see token id = 1 for 10 MOZ from 2021-07-22 09:33:50 BJ Time
             exchange.sellNFT(
                 _saleTokenID = 2,
-                _expectedTokenType = sp.variant("choice", "MOZ"),
-                _tokenAddress = sp.some(ftContract.address),
+                _currencyID = 1,
                 _value = 10,
-                _startTime = sp.timestamp(1627101952)
+                _quantity = 1,
+                _startTime = sp.timestamp(1627101952),
+                _endTime = sp.none
             ).run(sender = bob, now = sp.timestamp(1627101900))
 
 
             #10. sell NFT, see token id = 1 for 10 MOZ from 2021-07-22 09:33:50 BJ Time
             exchange.sellNFT(
                 _saleTokenID = 3,
-                _expectedTokenType = sp.variant("choice", "MOZ"),
-                _tokenAddress = sp.some(ftContract.address),
+                _currencyID = 1,
                 _value = 10,
-                _startTime = sp.timestamp(1627101952)
+                _quantity = 1,
+                _startTime = sp.timestamp(1627101952),
+                _endTime = sp.none
             ).run(sender = bob, now = sp.timestamp(1627101900))
 
+            scenario.verify(exchange.data.listingCount == 3)
+            scenario.verify(exchange.data.sellerListings[bob.address].count == 3)
+            ## the latest listing heads bob's chain
+            scenario.verify(exchange.data.sellerListings[bob.address].first == sp.some(3))
+            scenario.verify(exchange.data.goodsStoreMap[sp.pair(bob.address, 2)].next == sp.some(1))
+
             scenario.h2("cancelSell token 3")                       
             # 11. cancel token id 3
-            exchange.cancelSell(3).run(sender = bob)
+            exchange.cancelSell(_seller = bob.address, _tokenID = 3).run(sender = bob)
+            scenario.verify(exchange.data.listingCount == 2)
+            scenario.verify(exchange.data.sellerListings[bob.address].count == 2)
+            scenario.verify(exchange.data.sellerListings[bob.address].first == sp.some(2))
+            scenario.verify(exchange.data.goodsStoreMap[sp.pair(bob.address, 2)].prev == sp.none)
 
             # 12. buy token id 1
             scenario.h2("buyNFT token 1 with XTZ")              
-            exchange.buyNFT(1).run(sender=duncan, now = sp.timestamp(1627101990), amount = sp.mutez(1000000))
+            exchange.buyNFT(_seller = bob.address, _tokenID = 1, _amount = 1).run(sender=duncan, now = sp.timestamp(1627101990), amount = sp.mutez(1000000))
 
             # 13. buy token id 1
             scenario.h2("buyNFT token 2 with MOZ")  
@@ -1257,7 +2435,49 @@ def add_test(config, is_default = True):
                     token_id = 0)) ]).run(sender = duncan)    
 
             ## 14.buy token 2
-            exchange.buyNFT(2).run(sender = duncan, now = sp.timestamp(1627101990))
+            exchange.buyNFT(_seller = bob.address, _tokenID = 2, _amount = 1).run(sender = duncan, now = sp.timestamp(1627101990))
+            scenario.verify(exchange.data.listingCount == 0)
+            scenario.verify(~exchange.data.sellerListings.contains(bob.address))
+
+            # 14.1 buy tokens 0 and 3 in one cart, one for XTZ and one for MOZ
+            scenario.h2("buyNFTs tokens 0 and 3 with XTZ and MOZ")
+            exchange.sellNFT(
+                _saleTokenID = 0,
+                _currencyID = 0,
+                _value = sp.nat(1000000),
+                _quantity = 1,
+                _startTime = sp.timestamp(1627101952),
+                _endTime = sp.none
+            ).run(sender = bob, now = sp.timestamp(1627101900))
+            exchange.sellNFT(
+                _saleTokenID = 3,
+                _currencyID = 1,
+                _value = 10,
+                _quantity = 1,
+                _startTime = sp.timestamp(1627101952),
+                _endTime = sp.none
+            ).run(sender = bob, now = sp.timestamp(1627101900))
+            ftContract.update_operators([
+                sp.variant("add_operator", ftContract.operator_param.make(
+                    owner = duncan.address,
+                    operator = exchange.address,
+                    token_id = 0)) ]).run(sender = duncan)
+
+            ## not enough MOZ, FAIL
+            exchange.buyNFTs(_items = [sp.record(seller = bob.address, tokenID = token_id, amount = 1) for token_id in [0, 3]], _ftTotals = sp.map({1: 9})).run(sender = duncan, now = sp.timestamp(1627101990), amount = sp.mutez(1000000), valid = False)
+            ## the same token twice, FAIL
+            exchange.buyNFTs(_items = [sp.record(seller = bob.address, tokenID = token_id, amount = 1) for token_id in [0, 0]], _ftTotals = sp.map()).run(sender = duncan, now = sp.timestamp(1627101990), amount = sp.mutez(2000000), valid = False)
+            ## SUCC
+            exchange.buyNFTs(_items = [sp.record(seller = bob.address, tokenID = token_id, amount = 1) for token_id in [0, 3]], _ftTotals = sp.map({1: 10})).run(sender = duncan, now = sp.timestamp(1627101990), amount = sp.mutez(1000000))
+            scenario.verify(nftContract.data.ledger[0] == duncan.address)
+            scenario.verify(nftContract.data.ledger[3] == duncan.address)
+            scenario.verify(exchange.data.listingCount == 0)
+
+            ftContract.update_operators([
+                sp.variant("remove_operator", ftContract.operator_param.make(
+                    owner = duncan.address,
+                    operator = exchange.address,
+                    token_id = 0)) ]).run(sender = duncan)
             ## add_operator to EXCHANGE for duncan
             ftContract.update_operators([
                 sp.variant("remove_operator", ftContract.operator_param.make(
@@ -1265,6 +2485,315 @@ def add_test(config, is_default = True):
                     operator = exchange.address,
                     token_id = 0)) ]).run(sender = duncan)               
             
+            # 14.2 batch sell tokens 4 / 5 / 6, then cancel them
+            scenario.h2("sellNFTs tokens 4 / 5 / 6, cancelSells and cancelAllMyListings")
+            for token_id in [4, 5, 6]:
+                nftContract.mint(address = bob.address,
+                                    amount = 1,
+                                    metadata = mozNFTMeta,
+                                    token_id = token_id).run(sender = admin)
+            nftContract.update_operators([
+                sp.variant("add_operator", nftContract.operator_param.make(
+                    owner = bob.address,
+                    operator = exchange.address,
+                    token_id = token_id)) for token_id in [4, 5, 6]
+                    ]).run(sender = bob)
+
+            exchange.sellNFTs([
+                sp.record(saleTokenID = token_id,
+                          currencyID = 0,
+                          value = sp.nat(1000000),
+                          quantity = 1,
+                          startTime = sp.timestamp(1627101952),
+                          endTime = sp.none) for token_id in [4, 5, 6]
+            ]).run(sender = bob, now = sp.timestamp(1627101900))
+            scenario.verify(exchange.data.listingCount == 3)
+
+            exchange.cancelSells([sp.record(seller = bob.address, tokenID = 4)]).run(sender = bob)
+            scenario.verify(exchange.data.listingCount == 2)
+            scenario.verify(~exchange.data.goodsStoreMap.contains(sp.pair(bob.address, 4)))
+
+            ## alice has no token on sale, FAIL
+            exchange.cancelAllMyListings(10).run(sender = alice, valid = False)
+            ## one page of one listing, then the rest
+            exchange.cancelAllMyListings(1).run(sender = bob)
+            scenario.verify(exchange.data.listingCount == 1)
+            scenario.verify(exchange.data.sellerListings[bob.address].count == 1)
+            exchange.cancelAllMyListings(10).run(sender = bob)
+            scenario.verify(exchange.data.listingCount == 0)
+            scenario.verify(~exchange.data.goodsStoreMap.contains(sp.pair(bob.address, 5)))
+            scenario.verify(~exchange.data.sellerListings.contains(bob.address))
+
+            # 14.3 buy token 4 with an order signed off-chain by bob
+            scenario.h2("buySignedNFT token 4")
+            order = Signed_order.make(exchange = exchange.address,
+                                      seller = bob.address,
+                                      tokenID = 4,
+                                      currencyID = 0,
+                                      expectedValue = 1000000,
+                                      startTime = sp.timestamp(1627101952),
+                                      endTime = sp.timestamp(1627188352),
+                                      nonce = 0)
+            signature = sp.make_signature(bob.secret_key, sp.pack(order), message_format = "Raw")
+
+            ## signed by another key, FAIL
+            exchange.buySignedNFT(_order = order, _sellerKey = alice.public_key,
+                                  _signature = sp.make_signature(alice.secret_key, sp.pack(order), message_format = "Raw")
+                                  ).run(sender = alice, now = sp.timestamp(1627101990), amount = sp.mutez(1000000), valid = False)
+            ## SUCC
+            exchange.buySignedNFT(_order = order, _sellerKey = bob.public_key, _signature = signature
+                                  ).run(sender = alice, now = sp.timestamp(1627101990), amount = sp.mutez(1000000))
+            scenario.verify(nftContract.data.ledger[4] == alice.address)
+            ## replay, FAIL
+            exchange.buySignedNFT(_order = order, _sellerKey = bob.public_key, _signature = signature
+                                  ).run(sender = duncan, now = sp.timestamp(1627101990), amount = sp.mutez(1000000), valid = False)
+
+            ## bob cancels the order of token 5 before it is bought
+            order = Signed_order.make(exchange = exchange.address,
+                                      seller = bob.address,
+                                      tokenID = 5,
+                                      currencyID = 0,
+                                      expectedValue = 1000000,
+                                      startTime = sp.timestamp(1627101952),
+                                      endTime = sp.timestamp(1627188352),
+                                      nonce = 1)
+            signature = sp.make_signature(bob.secret_key, sp.pack(order), message_format = "Raw")
+            exchange.cancelSignedOrders([1]).run(sender = bob)
+            exchange.buySignedNFT(_order = order, _sellerKey = bob.public_key, _signature = signature
+                                  ).run(sender = alice, now = sp.timestamp(1627101990), amount = sp.mutez(1000000), valid = False)
+
+            # 14.4 alice swaps MOZ for MOS deposited in the Exchange
+            scenario.h2("depositFT, internalTokenToTokenSwap and withdrawFT")
+            ftContract.update_operators([
+                sp.variant("add_operator", ftContract.operator_param.make(
+                    owner = alice.address,
+                    operator = exchange.address,
+                    token_id = 0)) ]).run(sender = alice)
+            exchange.depositFT(_token = 0, _amount = 20).run(sender = alice)
+            ## banker duncan deposits MOS inventory
+            exchange.depositFT(_token = 1, _amount = 10).run(sender = duncan)
+            scenario.verify(exchange.data.ftBalances[sp.record(owner = alice.address, fa2 = ftContract.address, tokenID = 0)] == 20)
+
+            ## alice has not enough MOZ deposited, FAIL
+            exchange.internalTokenToTokenSwap(_direction = 0, _tokenAmount = 30).run(sender = alice, valid = False)
+            ## 10 MOZ for 2 MOS, SUCC
+            exchange.internalTokenToTokenSwap(_direction = 0, _tokenAmount = 10).run(sender = alice)
+            scenario.verify(exchange.data.ftBalances[sp.record(owner = alice.address, fa2 = ftContract.address, tokenID = 0)] == 10)
+            scenario.verify(exchange.data.ftBalances[sp.record(owner = alice.address, fa2 = ftContract.address, tokenID = 1)] == 2)
+            scenario.verify(exchange.data.ftBalances[sp.record(owner = duncan.address, fa2 = ftContract.address, tokenID = 0)] == 10)
+            scenario.verify(exchange.data.ftBalances[sp.record(owner = duncan.address, fa2 = ftContract.address, tokenID = 1)] == 8)
+
+            ## alice withdraws her MOS
+            exchange.withdrawFT(_token = 1, _amount = 3).run(sender = alice, valid = False)
+            exchange.withdrawFT(_token = 1, _amount = 2).run(sender = alice)
+            scenario.verify(~exchange.data.ftBalances.contains(sp.record(owner = alice.address, fa2 = ftContract.address, tokenID = 1)))
+
+            # 14.5 duncan provides liquidity to the MOZ/MOS pool, alice swaps against it
+            scenario.h2("addLiquidity, poolSwap and removeLiquidity")
+            ftContract.update_operators([
+                sp.variant("add_operator", ftContract.operator_param.make(
+                    owner = duncan.address,
+                    operator = exchange.address,
+                    token_id = 0)) ]).run(sender = duncan)
+            exchange.poolSwap(_direction = 0, _tokenAmount = 10, _minOut = 0).run(sender = alice, valid = False)
+            exchange.addLiquidity(_mozAmount = 50, _maxMos = 10, _minShares = 50).run(sender = duncan)
+            scenario.verify(exchange.data.poolShares[duncan.address] == 50)
+
+            ## 5 MOZ need exactly 1 MOS, 3 MOZ need 0.6 MOS rounded up to 1, FAIL
+            exchange.addLiquidity(_mozAmount = 3, _maxMos = 0, _minShares = 0).run(sender = duncan, valid = False)
+            exchange.addLiquidity(_mozAmount = 5, _maxMos = 1, _minShares = 5).run(sender = duncan)
+            scenario.verify(exchange.data.poolShares[duncan.address] == 55)
+            scenario.verify(exchange.data.poolMosReserve == 11)
+            ## the deposits of duncan in the Exchange are taken first
+            scenario.verify(exchange.data.ftBalances[sp.record(owner = duncan.address, fa2 = ftContract.address, tokenID = 0)] == 5)
+            scenario.verify(exchange.data.ftBalances[sp.record(owner = duncan.address, fa2 = ftContract.address, tokenID = 1)] == 7)
+
+            ## 10 MOZ for 1 MOS, asking for 2 MOS FAIL
+            exchange.poolSwap(_direction = 0, _tokenAmount = 10, _minOut = 2).run(sender = alice, valid = False)
+            ## alice swaps the 10 MOZ she deposited in the Exchange
+            exchange.poolSwap(_direction = 0, _tokenAmount = 10, _minOut = 1).run(sender = alice)
+            scenario.verify(exchange.data.poolMozReserve == 65)
+            scenario.verify(exchange.data.poolMosReserve == 10)
+            scenario.verify(~exchange.data.ftBalances.contains(sp.record(owner = alice.address, fa2 = ftContract.address, tokenID = 0)))
+
+            ## duncan takes all the reserves back
+            exchange.removeLiquidity(_shares = 56, _minMoz = 0, _minMos = 0).run(sender = duncan, valid = False)
+            exchange.removeLiquidity(_shares = 55, _minMoz = 65, _minMos = 10).run(sender = duncan)
+            scenario.verify(exchange.data.poolTotalShares == 0)
+            scenario.verify(~exchange.data.poolShares.contains(duncan.address))
+
+            # 14.6 alice and bob queue opposing swaps which are netted in one batch
+            scenario.h2("queueTokenToTokenSwap and settleSwapBatch")
+            ftContract.update_operators([
+                sp.variant("add_operator", ftContract.operator_param.make(
+                    owner = bob.address,
+                    operator = exchange.address,
+                    token_id = 1)) ]).run(sender = bob)
+            ## 4 MOZ are worth less than 1 MOS, FAIL
+            exchange.queueTokenToTokenSwap(_direction = 0, _tokenAmount = 4).run(sender = alice, now = sp.timestamp(1627200000), valid = False)
+            ## alice swaps 10 MOZ and bob 1 MOS from their accounts
+            exchange.queueTokenToTokenSwap(_direction = 0, _tokenAmount = 10).run(sender = alice, now = sp.timestamp(1627200000))
+            exchange.queueTokenToTokenSwap(_direction = 1, _tokenAmount = 1).run(sender = bob, now = sp.timestamp(1627200100))
+            exchange.settleSwapBatch().run(sender = duncan, now = sp.timestamp(1627200200), valid = False)
+            exchange.queueTokenToTokenSwap(_direction = 1, _tokenAmount = 1).run(sender = bob, now = sp.timestamp(1627200300), valid = False)
+            ## a rate change after the swaps are queued does not change their payouts
+            exchange.UpdateParameters(_admin=admin.address,
+                            _mozikNftAddress=mozikNftAddress,
+                            _ftMosAddress=mosAddress,
+                            _ftMosTokenID=ftMosTokenID,
+                            _ftMozAddress=mozAddress,
+                            _ftMozTokenID=ftMozTokenID,
+                            _bankerAddress=bankerAddress,
+                            _mosPerMozHundred=100).run(sender = admin)
+
+            ## alice gets 2 MOS and bob 5 MOZ, banker duncan only covers 1 MOS and gets 5 MOZ
+            aliceMos = scenario.compute(ftContract.data.ledger[ftContract.ledger_key.make(alice.address, 1)].balance)
+            bobMoz = scenario.compute(ftContract.data.ledger[ftContract.ledger_key.make(bob.address, 0)].balance)
+            exchange.settleSwapBatch().run(sender = duncan, now = sp.timestamp(1627200300))
+            scenario.verify(ftContract.data.ledger[ftContract.ledger_key.make(alice.address, 1)].balance == aliceMos + 2)
+            scenario.verify(ftContract.data.ledger[ftContract.ledger_key.make(bob.address, 0)].balance == bobMoz + 5)
+            scenario.verify(sp.len(exchange.data.swapIntents) == 0)
+            exchange.UpdateParameters(_admin=admin.address,
+                            _mozikNftAddress=mozikNftAddress,
+                            _ftMosAddress=mosAddress,
+                            _ftMosTokenID=ftMosTokenID,
+                            _ftMozAddress=mozAddress,
+                            _ftMozTokenID=ftMozTokenID,
+                            _bankerAddress=bankerAddress,
+                            _mosPerMozHundred=500).run(sender = admin)
+
+            # 14.7 offers on a token and on any token by an author
+            scenario.h2("makeOffer, cancelOffer and acceptOffer")
+            exchange.setTokenAuthors([sp.record(tokenID = 5, authorID = 1), sp.record(tokenID = 6, authorID = 1)]).run(sender = bob, valid = False)
+            exchange.setTokenAuthors([sp.record(tokenID = 5, authorID = 1), sp.record(tokenID = 6, authorID = 1)]).run(sender = admin)
+            exchange.makeOffer(_target = sp.variant("author", 1), _hint = sp.none).run(sender = alice, amount = sp.mutez(1000000))
+            exchange.makeOffer(_target = sp.variant("author", 1), _hint = sp.none).run(sender = duncan, amount = sp.mutez(2000000))
+            exchange.makeOffer(_target = sp.variant("token", 5), _hint = sp.none).run(sender = alice, amount = sp.mutez(500000))
+            ## duncan's offer is the best one, followed by alice's
+            scenario.verify(exchange.data.bestOffer[sp.variant("author", 1)] == 1)
+            scenario.verify(exchange.data.offers[1].next == sp.some(0))
+            ## a hint with a lower price, FAIL
+            exchange.makeOffer(_target = sp.variant("author", 1), _hint = sp.some(0)).run(sender = alice, amount = sp.mutez(1500000), valid = False)
+
+            ## bob sells token 6 to the best offer of author 1
+            exchange.acceptOffer(_target = sp.variant("author", 1), _tokenID = 6, _minPrice = sp.mutez(3000000)).run(sender = bob, valid = False)
+            exchange.acceptOffer(_target = sp.variant("token", 5), _tokenID = 6, _minPrice = sp.mutez(0)).run(sender = bob, valid = False)
+            exchange.acceptOffer(_target = sp.variant("author", 1), _tokenID = 6, _minPrice = sp.mutez(2000000)).run(sender = bob)
+            scenario.verify(nftContract.data.ledger[6] == duncan.address)
+            scenario.verify(exchange.data.bestOffer[sp.variant("author", 1)] == 0)
+            scenario.verify(exchange.data.offers[0].prev == sp.none)
+
+            ## alice cancels her offer on token 5
+            exchange.cancelOffer(2).run(sender = bob, valid = False)
+            exchange.cancelOffer(2).run(sender = alice)
+            scenario.verify(~exchange.data.bestOffer.contains(sp.variant("token", 5)))
+            exchange.acceptOffer(_target = sp.variant("token", 5), _tokenID = 5, _minPrice = sp.mutez(0)).run(sender = bob, valid = False)
+
+            ## the walk from the hint is bounded, a lower offer needs a closer hint
+            for i in range(offer_walk_max_steps + 1):
+                exchange.makeOffer(_target = sp.variant("token", 7), _hint = sp.none).run(sender = alice, amount = sp.mutez(1000000 - i * 1000))
+            lastOffer = 3 + offer_walk_max_steps
+            exchange.makeOffer(_target = sp.variant("token", 7), _hint = sp.none).run(sender = alice, amount = sp.mutez(1000), valid = False)
+            exchange.makeOffer(_target = sp.variant("token", 7), _hint = sp.some(lastOffer)).run(sender = alice, amount = sp.mutez(1000))
+            scenario.verify(exchange.data.offers[lastOffer].next == sp.some(lastOffer + 1))
+            for offerID in range(3, lastOffer + 2):
+                exchange.cancelOffer(offerID).run(sender = alice)
+            scenario.verify(~exchange.data.bestOffer.contains(sp.variant("token", 7)))
+
+            # 14.8 expired listings and listings of moved tokens are pruned by anyone
+            scenario.h2("listing expiry and pruneListings")
+            exchange.sellNFT(
+                _saleTokenID = 5,
+                _currencyID = 0,
+                _value = sp.nat(1000000),
+                _quantity = 1,
+                _startTime = sp.timestamp(1627300000),
+                _endTime = sp.some(sp.timestamp(1627300000))
+            ).run(sender = bob, now = sp.timestamp(1627200400), valid = False)
+            exchange.sellNFT(
+                _saleTokenID = 5,
+                _currencyID = 0,
+                _value = sp.nat(1000000),
+                _quantity = 1,
+                _startTime = sp.timestamp(1627300000),
+                _endTime = sp.some(sp.timestamp(1627400000))
+            ).run(sender = bob, now = sp.timestamp(1627200400))
+            ## not expired yet, the listing is kept
+            exchange.pruneListings([sp.record(seller = bob.address, tokenID = token_id) for token_id in [5, 6]]).run(sender = alice, now = sp.timestamp(1627300000))
+            scenario.verify(exchange.data.goodsStoreMap.contains(sp.pair(bob.address, 5)))
+            exchange.buyNFT(_seller = bob.address, _tokenID = 5, _amount = 1).run(sender = alice, now = sp.timestamp(1627400000), amount = sp.mutez(1000000), valid = False)
+            exchange.pruneListings([sp.record(seller = bob.address, tokenID = 5)]).run(sender = alice, now = sp.timestamp(1627400000))
+            scenario.verify(~exchange.data.goodsStoreMap.contains(sp.pair(bob.address, 5)))
+
+            ## bob lists token 5 again and transfers it away
+            exchange.sellNFT(
+                _saleTokenID = 5,
+                _currencyID = 0,
+                _value = sp.nat(1000000),
+                _quantity = 1,
+                _startTime = sp.timestamp(1627400000),
+                _endTime = sp.none
+            ).run(sender = bob, now = sp.timestamp(1627400000))
+            nftContract.transfer([nftContract.batch_transfer.item(from_ = bob.address,
+                                    txs = [sp.record(to_ = alice.address, amount = 1, token_id = 5)])
+            ]).run(sender = bob)
+            exchange.pruneListings([sp.record(seller = bob.address, tokenID = 5)]).run(sender = duncan, now = sp.timestamp(1627400000))
+            scenario.verify(~exchange.data.goodsStoreMap.contains(sp.pair(bob.address, 5)))
+            scenario.verify(~exchange.data.sellerListings.contains(bob.address))
+
+            # 14.9 MOS is registered as currency 2 and alice sells token 5 for MOS
+            scenario.h2("setCurrency and sellNFT for MOS")
+            exchange.setCurrency(_currencyID = 2, _fa2 = ftContract.address, _tokenID = 1).run(sender = alice, valid = False)
+            exchange.setCurrency(_currencyID = 0, _fa2 = ftContract.address, _tokenID = 1).run(sender = admin, valid = False)
+            exchange.setCurrency(_currencyID = 2, _fa2 = ftContract.address, _tokenID = 1).run(sender = admin)
+            nftContract.update_operators([
+                sp.variant("add_operator", nftContract.operator_param.make(
+                    owner = alice.address,
+                    operator = exchange.address,
+                    token_id = 5)) ]).run(sender = alice)
+            exchange.sellNFT(
+                _saleTokenID = 5,
+                _currencyID = 3,
+                _value = 2,
+                _quantity = 1,
+                _startTime = sp.timestamp(1627400000),
+                _endTime = sp.none
+            ).run(sender = alice, now = sp.timestamp(1627400000), valid = False)
+            ## alice has only one copy of token 5
+            exchange.sellNFT(
+                _saleTokenID = 5,
+                _currencyID = 2,
+                _value = 1,
+                _quantity = 2,
+                _startTime = sp.timestamp(1627400000),
+                _endTime = sp.none
+            ).run(sender = alice, now = sp.timestamp(1627400000), valid = False)
+            exchange.sellNFT(
+                _saleTokenID = 5,
+                _currencyID = 2,
+                _value = 2,
+                _quantity = 1,
+                _startTime = sp.timestamp(1627400000),
+                _endTime = sp.none
+            ).run(sender = alice, now = sp.timestamp(1627400000))
+            aliceMos = scenario.compute(ftContract.data.ledger[ftContract.ledger_key.make(alice.address, 1)].balance)
+            exchange.buyNFT(_seller = alice.address, _tokenID = 5, _amount = 2).run(sender = bob, now = sp.timestamp(1627400000), valid = False)
+            exchange.buyNFT(_seller = alice.address, _tokenID = 5, _amount = 1).run(sender = bob, now = sp.timestamp(1627400000))
+            scenario.verify(nftContract.data.ledger[5] == bob.address)
+            scenario.verify(ftContract.data.ledger[ftContract.ledger_key.make(alice.address, 1)].balance == aliceMos + 2)
+
+            # 14.9 the MOZ currency follows the MOZ token of the parameters
+            scenario.h2("UpdateParameters updates the MOZ currency")
+            exchange.UpdateParameters(_admin=admin.address,
+                            _mozikNftAddress=mozikNftAddress,
+                            _ftMosAddress=mosAddress,
+                            _ftMosTokenID=ftMosTokenID,
+                            _ftMozAddress=mozAddress,
+                            _ftMozTokenID=2,
+                            _bankerAddress=bankerAddress,
+                            _mosPerMozHundred=100).run(sender = admin)
+            scenario.verify(exchange.data.currencies[1] == sp.record(fa2 = mozAddress, tokenID = 2))
+
             # 15. updateParameters,serd 1 XTZ to contract
             scenario.h2("change Exchange parameters!")    
             exchange.UpdateParameters(_admin=admin.address,
@@ -1274,10 +2803,15 @@ def add_test(config, is_default = True):
                             _ftMozAddress=mozAddress,
                             _ftMozTokenID=ftMozTokenID,
                             _bankerAddress=bankerAddress,
-                            _mosPerMozHundred=100).run(sender = admin, _amount = sp.mutez(1000000))      
+                            _mosPerMozHundred=100).run(sender = admin, amount = sp.mutez(1000000))      
+
+            scenario.verify(exchange.data.currencies[1] == sp.record(fa2 = mozAddress, tokenID = ftMozTokenID))
 
-            # 16. withdraw XTZ from Exchange Contract
+            # 16. withdraw XTZ from Exchange Contract, alice's offer of 1 XTZ stays escrowed
+            scenario.verify(exchange.data.escrowedOffers == sp.mutez(1000000))
+            exchange.WithdrawContractXTZ(_destination=admin.address, _amount=sp.mutez(2000000)).run(sender = admin, valid = False)
             exchange.WithdrawContractXTZ(_destination=admin.address, _amount=sp.mutez(1000000)).run(sender = admin)                    
+            scenario.verify(exchange.balance == sp.mutez(1000000))
            
             return
 
@@ -1579,6 +3113,81 @@ def add_test(config, is_default = True):
                 ]).run(sender = op2)
             scenario.table_of_contents()
 
+## ## Edition test
+##
+## The Exchange trading an editioned token: an FA2 built with
+## `non_fungible = False` where several holders list copies of the same token.
+def add_edition_test(is_default = True):
+    @sp.add_test(name = "Exchange of an editioned token", is_default = is_default)
+    def test():
+        scenario = sp.test_scenario()
+        scenario.h1("Exchange of an editioned token")
+        admin = sp.test_account("Administrator")
+        alice = sp.test_account("Alice")
+        bob   = sp.test_account("bob")
+        duncan = sp.test_account("duncan")
+
+        # 1. MOZ/MOS and the edition contract, bob gets 10 copies of token 0 and gives 3 to alice
+        ftContract = FA2(FA2_config(),
+                         metadata = sp.utils.metadata_of_url("https://example.com"),
+                         admin = admin.address)
+        scenario += ftContract
+        editionContract = FA2(FA2_config(),
+                              metadata = sp.utils.metadata_of_url("https://example.com"),
+                              admin = admin.address)
+        scenario += editionContract
+        editionMeta = FA2.make_metadata(name = "The MOZIK Edition", decimals = 0, symbol = "MOZ@ED")
+        editionContract.mint(address = bob.address, amount = 10, metadata = editionMeta, token_id = 0).run(sender = admin)
+        editionContract.transfer([editionContract.batch_transfer.item(from_ = bob.address,
+                                    txs = [sp.record(to_ = alice.address, amount = 3, token_id = 0)])
+        ]).run(sender = bob)
+
+        exchange = Exchange(admin.address, editionContract.address, ftContract.address, 1, ftContract.address, 0, admin.address)
+        scenario += exchange
+        for seller in [alice, bob]:
+            editionContract.update_operators([
+                sp.variant("add_operator", editionContract.operator_param.make(
+                    owner = seller.address,
+                    operator = exchange.address,
+                    token_id = 0)) ]).run(sender = seller)
+
+        # 2. bob lists 5 copies and alice lists 2 copies of the same token
+        def sell(seller, quantity, valid = True):
+            exchange.sellNFT(
+                _saleTokenID = 0,
+                _currencyID = 0,
+                _value = sp.nat(1000000),
+                _quantity = quantity,
+                _startTime = sp.timestamp(100),
+                _endTime = sp.none
+            ).run(sender = seller, now = sp.timestamp(100), valid = valid)
+        sell(bob, 5)
+        sell(alice, 2)
+        ## bob's token is already on sale by bob, FAIL
+        sell(bob, 1, valid = False)
+        bobListing = sp.pair(bob.address, 0)
+        aliceListing = sp.pair(alice.address, 0)
+        scenario.verify(exchange.data.listingCount == 2)
+
+        # 3. duncan buys 2 of bob's 5 copies
+        exchange.buyNFT(_seller = bob.address, _tokenID = 0, _amount = 2).run(sender = duncan, now = sp.timestamp(100), amount = sp.mutez(2000000))
+        scenario.verify(exchange.data.goodsStoreMap[bobListing].quantity == 3)
+        scenario.verify(editionContract.data.ledger[editionContract.ledger_key.make(duncan.address, 0)].balance == 2)
+
+        # 4. a cart buying 1 of bob's copies and both of alice's
+        cart = [sp.record(seller = bob.address, tokenID = 0, amount = 1),
+                sp.record(seller = alice.address, tokenID = 0, amount = 2)]
+        ## not enough XTZ, FAIL
+        exchange.buyNFTs(_items = cart, _ftTotals = sp.map()).run(sender = duncan, now = sp.timestamp(100), amount = sp.mutez(2000000), valid = False)
+        exchange.buyNFTs(_items = cart, _ftTotals = sp.map()).run(sender = duncan, now = sp.timestamp(100), amount = sp.mutez(3000000))
+        scenario.verify(exchange.data.goodsStoreMap[bobListing].quantity == 2)
+        scenario.verify(~exchange.data.goodsStoreMap.contains(aliceListing))
+        scenario.verify(editionContract.data.ledger[editionContract.ledger_key.make(duncan.address, 0)].balance == 5)
+        scenario.verify(exchange.data.listingCount == 1)
+
+        ## only 2 copies are left on sale, FAIL
+        exchange.buyNFT(_seller = bob.address, _tokenID = 0, _amount = 3).run(sender = duncan, now = sp.timestamp(100), amount = sp.mutez(3000000), valid = False)
+
 ##
 ## ## Global Environment Parameters
 ##
@@ -1620,6 +3229,7 @@ def environment_config():
 ## for the browser version.
 if "templates" not in __name__:
     add_test(environment_config())
+    add_edition_test(is_default = not sp.in_browser)
 
     if not global_parameter("only_environment_test", False):
         add_test(FA2_config(debug_mode = True), is_default = not sp.in_browser)
@@ -27,7 +27,9 @@ class FA2_config:
                  store_total_supply                 = True,
                  lazy_entry_points                  = False,
                  allow_self_transfer                = False,
-                 use_token_metadata_offchain_view   = False
+                 use_token_metadata_offchain_view   = False,
+                 mint_batch_max_size                = 200,
+                 metadata_batch_max_size            = 200
                  ):
 
         if debug_mode:
@@ -48,6 +50,8 @@ class FA2_config:
         self.non_fungible = non_fungible
         # Enforce the non-fungibility of the tokens, i.e. the fact
         # that total supply has to be 1.
+        # The ledger is then a `token-id -> owner` map: a transfer is one
+        # overwrite and the total supply of 1 is implied, not stored.
 
         self.readable = readable
         # The `readable` option is a legacy setting that we keep around
@@ -93,6 +97,15 @@ class FA2_config:
 
         self.allow_self_transfer = allow_self_transfer
         # Authorize call of `transfer` entry_point from self
+
+        self.mint_batch_max_size = mint_batch_max_size
+        # The maximum number of tokens minted by one `mint_batch` call, a
+        # batch of this size stays well below the gas limit of an operation;
+        # bigger catalogs have to be split in several batches.
+
+        self.metadata_batch_max_size = metadata_batch_max_size
+        # The maximum number of tokens updated by one `set_token_metadata_batch`
+        # call, for the same reason.
         name = "FA2"
         if debug_mode:
             name += "-debug"
@@ -138,6 +151,7 @@ class Error_message:
     def operators_unsupported(self): return self.make("OPERATORS_UNSUPPORTED")
     def not_admin(self):             return self.make("NOT_ADMIN")
     def not_admin_or_operator(self): return self.make("NOT_ADMIN_OR_OPERATOR")
+    def metadata_view_required(self): return self.make("METADATA_VIEW_REQUIRED")
     def paused(self):                return self.make("PAUSED")
 
 ## The current type for a batched transfer in the specification is as
@@ -194,6 +208,17 @@ class Operator_param:
                       operator = operator,
                       token_id = token_id)
         return sp.set_type_expr(r, self.get_type())
+    def get_for_all_type(self):
+        t = sp.TRecord(
+            owner = sp.TAddress,
+            operator = sp.TAddress)
+        if self.config.force_layouts:
+            t = t.layout(("owner", "operator"))
+        return t
+    def make_for_all(self, owner, operator):
+        r = sp.record(owner = owner,
+                      operator = operator)
+        return sp.set_type_expr(r, self.get_for_all_type())
 
 ## The class `Ledger_key` defines the key type for the main ledger (big-)map:
 ##
@@ -258,6 +283,32 @@ class Operator_set:
         del set[self.make_key(owner, operator, token_id)]
     def is_member(self, set, owner, operator, token_id):
         return set.contains(self.make_key(owner, operator, token_id))
+    # An operator for all moves every token of the owner, it is kept in its
+    # own `(owner, operator)` map.
+    def for_all_inner_type(self):
+        return sp.TRecord(owner = sp.TAddress,
+                          operator = sp.TAddress
+                          ).layout(("owner", "operator"))
+    def for_all_key_type(self):
+        if self.config.readable:
+            return self.for_all_inner_type()
+        else:
+            return sp.TBytes
+    def make_for_all(self):
+        return self.config.my_map(tkey = self.for_all_key_type(), tvalue = sp.TUnit)
+    def make_for_all_key(self, owner, operator):
+        metakey = sp.set_type_expr(sp.record(owner = owner, operator = operator),
+                                   self.for_all_inner_type())
+        if self.config.readable:
+            return metakey
+        else:
+            return sp.pack(metakey)
+    def add_for_all(self, set, owner, operator):
+        set[self.make_for_all_key(owner, operator)] = sp.unit
+    def remove_for_all(self, set, owner, operator):
+        del set[self.make_for_all_key(owner, operator)]
+    def is_member_for_all(self, set, owner, operator):
+        return set.contains(self.make_for_all_key(owner, operator))
 
 class Balance_of:
     def request_type():
@@ -275,6 +326,18 @@ class Balance_of:
             requests = sp.TList(Balance_of.request_type())
         ).layout(("requests", "callback"))
 
+## The recording, propagating and other rights of a token are kept in one
+## record per token. A right which is `None`, or a token without a record,
+## is held by the owner of the token: minting writes nothing and a
+## transfer only clears the record of a token whose rights were delegated.
+class Rights:
+    def get_type():
+        return sp.TRecord(recording = sp.TOption(sp.TAddress),
+                          propagating = sp.TOption(sp.TAddress),
+                          other = sp.TOption(sp.TAddress))
+    def owner_holds_all():
+        return sp.record(recording = sp.none, propagating = sp.none, other = sp.none)
+
 class Token_meta_data:
     def __init__(self, config):
         self.config = config
@@ -286,7 +349,9 @@ class Token_meta_data:
         sp.set_type(expr, self.get_type())
 
 ## The set of all tokens is represented by a `nat` if we assume that token-ids
-## are consecutive, or by an actual `(set nat)` if not.
+## are consecutive. If not, it is a big-map chaining each token-id to the next
+## minted one, with its cardinal and both ends of the chain, so that minting
+## and membership checks do not load the whole set.
 ##
 ## - Knowing the set of tokens is useful for throwing accurate error messages.
 ## - Previous versions of the specification required this set for functional
@@ -299,23 +364,34 @@ class Token_id_set:
             # The "set" is its cardinal.
             return sp.nat(0)
         else:
-            return sp.set(t = token_id_type)
+            return sp.record(
+                size = sp.nat(0),
+                first = sp.set_type_expr(sp.none, sp.TOption(token_id_type)),
+                last = sp.set_type_expr(sp.none, sp.TOption(token_id_type)),
+                next = self.config.my_map(tkey = token_id_type, tvalue = sp.TOption(token_id_type)))
     def add(self, metaset, v):
         if self.config.assume_consecutive_token_ids:
             sp.verify(metaset == v, message = "Token-IDs should be consecutive")
             metaset.set(sp.max(metaset, v + 1))
         else:
-            metaset.add(v)
+            sp.if ~ metaset.next.contains(v):
+                sp.if metaset.last.is_some():
+                    metaset.next[metaset.last.open_some()] = sp.some(v)
+                sp.else:
+                    metaset.first = sp.some(v)
+                metaset.last = sp.some(v)
+                metaset.next[v] = sp.none
+                metaset.size += 1
     def contains(self, metaset, v):
         if self.config.assume_consecutive_token_ids:
             return (v < metaset)
         else:
-            return metaset.contains(v)
+            return metaset.next.contains(v)
     def cardinal(self, metaset):
         if self.config.assume_consecutive_token_ids:
             return metaset
         else:
-            return sp.len(metaset)
+            return metaset.size
 
 ##
 ## ## Implementation of the Contract
@@ -358,16 +434,21 @@ class FA2_core(sp.Contract):
             self.add_flag("lazy-entry-points")
         self.add_flag("initial-cast")
         self.exception_optimization_level = "default-line"
+        if self.config.non_fungible:
+            ledger = self.config.my_map(tkey = token_id_type, tvalue = sp.TAddress)
+        else:
+            ledger = self.config.my_map(tvalue = Ledger_value.get_type())
         self.init(
-            ledger = self.config.my_map(tvalue = Ledger_value.get_type()),
+            ledger = ledger,
             token_metadata = self.config.my_map(tkey = sp.TNat, tvalue = self.token_meta_data.get_type()),
             total_supply = self.config.my_map(tkey = sp.TNat, tvalue = sp.TNat),
             operators = self.operator_set.make(),
+            operators_for_all = self.operator_set.make_for_all(),
             all_tokens = self.token_id_set.empty(),
             metadata = metadata,
-            recording_right=config.my_map(tkey=sp.TNat, tvalue=sp.TAddress),
-            propagating_right=config.my_map(tkey=sp.TNat, tvalue=sp.TAddress),
-            other_rights=config.my_map(tkey=sp.TNat, tvalue=sp.TAddress),
+            metadata_base_uri = sp.bytes("0x"),
+            metadata_defaults = sp.map(tkey = sp.TString, tvalue = sp.TBytes),
+            rights = config.my_map(tkey = sp.TNat, tvalue = Rights.get_type()),
             **extra_storage
         )
 
@@ -375,41 +456,39 @@ class FA2_core(sp.Contract):
     def transfer(self, params):
         sp.verify( ~self.is_paused(), message = self.error_message.paused() )
         sp.set_type(params, self.batch_transfer.get_type())
+        # The sender checks do not depend on the transactions, they are
+        # evaluated once for the whole batch.
+        sender_trusted = self.is_administrator(sp.sender)
+        if self.config.allow_self_transfer:
+            sender_trusted |= (sp.sender == sp.self_address)
+        sender_is_trusted = sp.local("sender_is_trusted", sender_trusted)
+        if self.config.support_operator:
+            # (from_, token_id) pairs whose operator membership already passed
+            operator_checked = sp.local("operator_checked",
+                                        sp.set(t = sp.TPair(sp.TAddress, token_id_type)))
         sp.for transfer in params:
            current_from = transfer.from_
            sp.for tx in transfer.txs:
                 if self.config.single_asset:
                     sp.verify(tx.token_id == 0, message = "single-asset: token-id <> 0")
 
-                sender_verify = ((self.is_administrator(sp.sender)) |
-                                (current_from == sp.sender))
-                message = self.error_message.not_owner()
+                sender_verify = sender_is_trusted.value | (current_from == sp.sender)
                 if self.config.support_operator:
-                    message = self.error_message.not_operator()
-                    sender_verify |= (self.operator_set.is_member(self.data.operators,
-                                                                  current_from,
-                                                                  sp.sender,
-                                                                  tx.token_id))
-                if self.config.allow_self_transfer:
-                    sender_verify |= (sp.sender == sp.self_address)
-                sp.verify(sender_verify, message = message)
+                    operator_key = sp.pair(current_from, tx.token_id)
+                    sp.if ~(sender_verify | operator_checked.value.contains(operator_key)):
+                        sp.verify(self.is_operator_of(current_from, sp.sender, tx.token_id),
+                                  message = self.error_message.not_operator())
+                        operator_checked.value.add(operator_key)
+                else:
+                    sp.verify(sender_verify, message = self.error_message.not_owner())
                 sp.verify(
                     self.data.token_metadata.contains(tx.token_id),
                     message = self.error_message.token_undefined()
                 )
                 # If amount is 0 we do nothing now:
                 sp.if (tx.amount > 0):
-                    from_user = self.ledger_key.make(current_from, tx.token_id)
-                    sp.verify(
-                        (self.data.ledger[from_user].balance >= tx.amount),
-                        message = self.error_message.insufficient_balance())
-                    to_user = self.ledger_key.make(tx.to_, tx.token_id)
-                    self.data.ledger[from_user].balance = sp.as_nat(
-                        self.data.ledger[from_user].balance - tx.amount)
-                    sp.if self.data.ledger.contains(to_user):
-                        self.data.ledger[to_user].balance += tx.amount
-                    sp.else:
-                         self.data.ledger[to_user] = Ledger_value.make(tx.amount)
+                    self.ledger_transfer(current_from, tx.to_, tx.token_id, tx.amount)
+                    self.on_transfer(current_from, tx.token_id)
                 sp.else:
                     pass
 
@@ -419,23 +498,13 @@ class FA2_core(sp.Contract):
         sp.verify( ~self.is_paused(), message = self.error_message.paused())
         sp.set_type(params, Balance_of.entry_point_type())
         def f_process_request(req):
-            user = self.ledger_key.make(req.owner, req.token_id)
             sp.verify(self.data.token_metadata.contains(req.token_id), message = self.error_message.token_undefined())
-            sp.if self.data.ledger.contains(user):
-                balance = self.data.ledger[user].balance
-                sp.result(
-                    sp.record(
-                        request = sp.record(
-                            owner = sp.set_type_expr(req.owner, sp.TAddress),
-                            token_id = sp.set_type_expr(req.token_id, sp.TNat)),
-                        balance = balance))
-            sp.else:
-                sp.result(
-                    sp.record(
-                        request = sp.record(
-                            owner = sp.set_type_expr(req.owner, sp.TAddress),
-                            token_id = sp.set_type_expr(req.token_id, sp.TNat)),
-                        balance = 0))
+            sp.result(
+                sp.record(
+                    request = sp.record(
+                        owner = sp.set_type_expr(req.owner, sp.TAddress),
+                        token_id = sp.set_type_expr(req.token_id, sp.TNat)),
+                    balance = self.owned_balance(req.owner, req.token_id)))
         res = sp.local("responses", params.requests.map(f_process_request))
         destination = sp.set_type_expr(params.callback, sp.TContract(Balance_of.response_type()))
         sp.transfer(res.value, sp.mutez(0), destination)
@@ -448,9 +517,39 @@ class FA2_core(sp.Contract):
                 owner = sp.TAddress,
                 token_id = sp.TNat
             ).layout(("owner", "token_id")))
-        user = self.ledger_key.make(req.owner, req.token_id)
         sp.verify(self.data.token_metadata.contains(req.token_id), message = self.error_message.token_undefined())
-        sp.result(self.data.ledger[user].balance)
+        if self.config.non_fungible:
+            sp.result(self.ledger_balance(req.owner, req.token_id))
+        else:
+            user = self.ledger_key.make(req.owner, req.token_id)
+            sp.result(self.data.ledger[user].balance)
+
+    @sp.offchain_view(pure = True)
+    def get_balances(self, requests):
+        """Batched `get_balance`, all the requests are answered in one run."""
+        sp.set_type(requests, sp.TList(Balance_of.request_type()))
+        def f_process_request(req):
+            sp.verify(self.data.token_metadata.contains(req.token_id), message = self.error_message.token_undefined())
+            sp.result(sp.record(request = req, balance = self.owned_balance(req.owner, req.token_id)))
+        sp.result(requests.map(f_process_request))
+
+    @sp.onchain_view()
+    def get_balance_view(self, req):
+        """On-chain version of `get_balance`, unknown owners have a balance of 0."""
+        sp.set_type(
+            req, sp.TRecord(
+                owner = sp.TAddress,
+                token_id = sp.TNat
+            ).layout(("owner", "token_id")))
+        sp.verify(self.data.token_metadata.contains(req.token_id), message = self.error_message.token_undefined())
+        if self.config.non_fungible:
+            sp.result(self.ledger_balance(req.owner, req.token_id))
+        else:
+            user = self.ledger_key.make(req.owner, req.token_id)
+            sp.if self.data.ledger.contains(user):
+                sp.result(self.data.ledger[user].balance)
+            sp.else:
+                sp.result(sp.nat(0))
 
 
     @sp.entry_point
@@ -485,6 +584,87 @@ class FA2_core(sp.Contract):
         else:
             sp.failwith(self.error_message.operators_unsupported())
 
+    @sp.entry_point
+    def update_operators_for_all(self, params):
+        """Approve or revoke an operator for every token of the owner."""
+        sp.set_type(params, sp.TList(
+            sp.TVariant(
+                add_operator = self.operator_param.get_for_all_type(),
+                remove_operator = self.operator_param.get_for_all_type()
+            )
+        ))
+        if self.config.support_operator:
+            sp.for update in params:
+                with update.match_cases() as arg:
+                    with arg.match("add_operator") as upd:
+                        sp.verify(
+                            (upd.owner == sp.sender) | self.is_administrator(sp.sender),
+                            message = self.error_message.not_admin_or_operator()
+                        )
+                        self.operator_set.add_for_all(self.data.operators_for_all,
+                                                      upd.owner,
+                                                      upd.operator)
+                    with arg.match("remove_operator") as upd:
+                        sp.verify(
+                            (upd.owner == sp.sender) | self.is_administrator(sp.sender),
+                            message = self.error_message.not_admin_or_operator()
+                        )
+                        self.operator_set.remove_for_all(self.data.operators_for_all,
+                                                         upd.owner,
+                                                         upd.operator)
+        else:
+            sp.failwith(self.error_message.operators_unsupported())
+
+    # The operators for all of the owner are looked up first, the per token
+    # ones are only read when the owner did not approve the operator for all.
+    def is_operator_of(self, owner, operator, token_id):
+        is_operator = sp.local("is_operator",
+                               self.operator_set.is_member_for_all(self.data.operators_for_all,
+                                                                   owner,
+                                                                   operator))
+        sp.if ~ is_operator.value:
+            is_operator.value = self.operator_set.is_member(self.data.operators,
+                                                            owner,
+                                                            operator,
+                                                            token_id)
+        return is_operator.value
+
+    # Move `amount` of `token_id` in the ledger, `from_` must hold it.
+    def ledger_transfer(self, from_, to_, token_id, amount):
+        if self.config.non_fungible:
+            # the token goes to its new owner with one overwrite
+            sp.verify(
+                (amount == 1) & (self.data.ledger[token_id] == from_),
+                message = self.error_message.insufficient_balance())
+            self.data.ledger[token_id] = to_
+        else:
+            # one read and one write per ledger entry
+            from_user = self.ledger_key.make(from_, token_id)
+            from_balance = sp.local("from_balance",
+                self.data.ledger.get(from_user, Ledger_value.make(0)).balance)
+            sp.verify(
+                (from_balance.value >= amount),
+                message = self.error_message.insufficient_balance())
+            self.data.ledger[from_user] = Ledger_value.make(sp.as_nat(from_balance.value - amount))
+            to_user = self.ledger_key.make(to_, token_id)
+            self.data.ledger[to_user] = Ledger_value.make(
+                self.data.ledger.get(to_user, Ledger_value.make(0)).balance + amount)
+
+    # Called after each non-zero transaction, extended by the rights.
+    def on_transfer(self, from_, token_id):
+        pass
+
+    # The balance of `owner`, 0 when the ledger has no entry for it.
+    def owned_balance(self, owner, token_id):
+        if self.config.non_fungible:
+            return self.ledger_balance(owner, token_id)
+        user = self.ledger_key.make(owner, token_id)
+        return self.data.ledger.get(user, Ledger_value.make(0)).balance
+
+    # The balance of a defined non-fungible token is 1 for its owner, 0 otherwise.
+    def ledger_balance(self, owner, token_id):
+        return sp.eif(self.data.ledger[token_id] == owner, sp.nat(1), sp.nat(0))
+
     # this is not part of the standard but can be supported through inheritance.
     def is_paused(self):
         return sp.bool(False)
@@ -522,34 +702,80 @@ class FA2_mint(FA2_core):
     def mint(self, params):
         sp.verify(self.is_administrator(sp.sender), message = self.error_message.not_admin())
         # We don't check for pauseness because we're the admin.
+        self.mint_token(params)
+
+    @sp.entry_point
+    def mint_batch(self, params):
+        """Mint a list of tokens with one administrator check.
+
+        With `assume_consecutive_token_ids` the whole batch must continue
+        the token-ids, so the new tokens are known not to exist and
+        `all_tokens` is written once."""
+        sp.set_type(params, sp.TList(sp.TRecord(address = sp.TAddress,
+                                                amount = sp.TNat,
+                                                metadata = sp.TMap(sp.TString, sp.TBytes),
+                                                token_id = sp.TNat)))
+        sp.verify(self.is_administrator(sp.sender), message = self.error_message.not_admin())
+        sp.verify(sp.len(params) <= self.config.mint_batch_max_size, message = "mint_batch: too many tokens")
+        if self.config.assume_consecutive_token_ids:
+            next_token_id = sp.local("next_token_id", self.data.all_tokens)
+            sp.for params_item in params:
+                sp.verify(params_item.token_id == next_token_id.value, message = "Token-IDs should be consecutive")
+                next_token_id.value += 1
+                self.mint_token(params_item, new_token = True)
+            self.data.all_tokens = next_token_id.value
+        else:
+            sp.for params_item in params:
+                self.mint_token(params_item)
+
+    def mint_token(self, params, new_token = False):
+        # `new_token` means the caller already checked the token-id is not minted.
         if self.config.single_asset:
             sp.verify(params.token_id == 0, message = "single-asset: token-id <> 0")
         if self.config.non_fungible:
             sp.verify(params.amount == 1, message = "NFT-asset: amount <> 1")
-            sp.verify(
-                ~ self.token_id_set.contains(self.data.all_tokens, params.token_id),
-                message = "NFT-asset: cannot mint twice same token"
-            )
+            if not new_token:
+                sp.verify(
+                    ~ self.token_id_set.contains(self.data.all_tokens, params.token_id),
+                    message = "NFT-asset: cannot mint twice same token"
+                )
         user = self.ledger_key.make(params.address, params.token_id)
-        self.token_id_set.add(self.data.all_tokens, params.token_id)
-        sp.if self.data.ledger.contains(user):
-            self.data.ledger[user].balance += params.amount
-        sp.else:
+        if self.config.non_fungible:
+            # the token is new, its total supply of 1 is implied
+            if not new_token:
+                self.token_id_set.add(self.data.all_tokens, params.token_id)
+            self.data.ledger[params.token_id] = params.address
+            self.data.token_metadata[params.token_id] = sp.record(
+                token_id    = params.token_id,
+                token_info  = params.metadata
+            )
+        elif new_token:
             self.data.ledger[user] = Ledger_value.make(params.amount)
-        sp.if self.data.token_metadata.contains(params.token_id):
-            pass
-        sp.else:
             self.data.token_metadata[params.token_id] = sp.record(
                 token_id    = params.token_id,
                 token_info  = params.metadata
             )
             self.data.total_supply[params.token_id] = params.amount
-        # approve all right   
-        self.data.recording_right[params.token_id] = params.address
-        self.data.propagating_right[params.token_id] = params.address
-        self.data.other_rights[params.token_id] = params.address
+        else:
+            self.token_id_set.add(self.data.all_tokens, params.token_id)
+            sp.if self.data.ledger.contains(user):
+                self.data.ledger[user].balance += params.amount
+            sp.else:
+                self.data.ledger[user] = Ledger_value.make(params.amount)
+            sp.if self.data.token_metadata.contains(params.token_id):
+                pass
+            sp.else:
+                self.data.token_metadata[params.token_id] = sp.record(
+                    token_id    = params.token_id,
+                    token_info  = params.metadata
+                )
+                self.data.total_supply[params.token_id] = params.amount
 
 
+## The "" entry of a token is a full URI, kept as is, when it starts with one of
+## these schemes, otherwise it is a suffix of the base URI.
+metadata_uri_schemes = ["ipfs://", "https://", "http://", "tezos-storage:"]
+
 class FA2_token_metadata(FA2_core):
     def set_token_metadata_view(self):
         def token_metadata(self, tok):
@@ -560,10 +786,46 @@ class FA2_token_metadata(FA2_core):
             most flexible choice.
             """
             sp.set_type(tok, sp.TNat)
-            sp.result(self.data.token_metadata[tok])
+            sp.result(sp.record(token_id = tok, token_info = self.token_info_of(tok)))
 
         self.token_metadata = sp.offchain_view(pure = True, doc = "Get Token Metadata")(token_metadata)
 
+    # The token-info of a token is the collection defaults updated with the
+    # entries stored for the token, its "" entry is a suffix of the base URI
+    # unless it is a full URI.
+    def token_info_of(self, token_id):
+        token_info = sp.local("token_info", self.data.metadata_defaults)
+        sp.for item in self.data.token_metadata[token_id].token_info.items():
+            token_info.value[item.key] = item.value
+        sp.if token_info.value.contains(""):
+            sp.if ~ self.is_full_uri(token_info.value[""]):
+                token_info.value[""] = sp.concat([self.data.metadata_base_uri, token_info.value[""]])
+        return token_info.value
+
+    def is_full_uri(self, uri):
+        is_full = sp.local("is_full", False)
+        for scheme in metadata_uri_schemes:
+            prefix = sp.utils.bytes_of_string(scheme)
+            sp.if sp.slice(uri, 0, len(scheme)) == sp.some(prefix):
+                is_full.value = True
+        return is_full.value
+
+    @sp.entry_point
+    def set_metadata_base(self, base_uri, defaults):
+        """Set the base URI and the token-info entries shared by every token.
+
+        Minting then only needs the entries a token overrides and the suffix
+        of its URI under the "" key. The shared entries are only served by
+        the `token_metadata` off-chain view, the `token_metadata` big-map
+        keeps the entries of each token, so the view is required."""
+        sp.set_type(base_uri, sp.TBytes)
+        sp.set_type(defaults, sp.TMap(sp.TString, sp.TBytes))
+        if not self.config.use_token_metadata_offchain_view:
+            sp.failwith(self.error_message.metadata_view_required())
+        sp.verify(self.is_administrator(sp.sender), message = self.error_message.not_admin())
+        self.data.metadata_base_uri = base_uri
+        self.data.metadata_defaults = defaults
+
     def make_metadata(symbol, name, decimals):
         "Helper function to build metadata JSON bytes values."
         return (sp.map(l = {
@@ -581,132 +843,131 @@ class FA2_token_metadata(FA2_core):
         # only administrator can change token metatdata, check first
         sp.verify(self.is_administrator(sp.sender), message = self.error_message.not_admin())
         
+        self.replace_token_metadata(token_id, metadata)
+
+    @sp.entry_point
+    def set_token_metadata_batch(self, params):
+        """Replace the metadata of a list of tokens with one administrator check."""
+        sp.set_type(params, sp.TList(sp.TRecord(token_id = sp.TNat,
+                                                metadata = sp.TMap(sp.TString, sp.TBytes))))
+        sp.verify(self.is_administrator(sp.sender), message = self.error_message.not_admin())
+        sp.verify(sp.len(params) <= self.config.metadata_batch_max_size, message = "set_token_metadata_batch: too many tokens")
+        sp.for item in params:
+            self.replace_token_metadata(item.token_id, item.metadata)
+
+    # the record is keyed by its token_id, it is replaced without reading it
+    def replace_token_metadata(self, token_id, metadata):
         # check the toke_id does exist!
         sp.verify(self.data.token_metadata.contains(token_id), "the toke_id does not exist!")
-
-        # locate the token_id record,then replace it.
-        sp.if token_id == self.data.token_metadata[token_id].token_id :
-            self.data.token_metadata[token_id] = sp.record(
-                token_id    = token_id,
-                token_info  = metadata ) 
-            return
+        self.data.token_metadata[token_id] = sp.record(
+            token_id    = token_id,
+            token_info  = metadata )
 
 class FA2_right(FA2_core):
-    @sp.entry_point
-    def transfer(self, params):
-        sp.verify( ~self.is_paused(), message = self.error_message.paused() )
-        sp.set_type(params, self.batch_transfer.get_type())
-        sp.for transfer in params:
-           current_from = transfer.from_
-           sp.for tx in transfer.txs:
-                if self.config.single_asset:
-                    sp.verify(tx.token_id == 0, message = "single-asset: token-id <> 0")
-
-                sender_verify = ((self.is_administrator(sp.sender)) |
-                                (current_from == sp.sender))
-                message = self.error_message.not_owner()
-                if self.config.support_operator:
-                    message = self.error_message.not_operator()
-                    sender_verify |= (self.operator_set.is_member(self.data.operators,
-                                                                  current_from,
-                                                                  sp.sender,
-                                                                  tx.token_id))
-                if self.config.allow_self_transfer:
-                    sender_verify |= (sp.sender == sp.self_address)
-                sp.verify(sender_verify, message = message)
-                sp.verify(
-                    self.data.token_metadata.contains(tx.token_id),
-                    message = self.error_message.token_undefined()
-                )
-                # If amount is 0 we do nothing now:
-                sp.if (tx.amount > 0):
-                    from_user = self.ledger_key.make(current_from, tx.token_id)
-                    sp.verify(
-                        (self.data.ledger[from_user].balance >= tx.amount),
-                        message = self.error_message.insufficient_balance())
-                    to_user = self.ledger_key.make(tx.to_, tx.token_id)
-                    self.data.ledger[from_user].balance = sp.as_nat(
-                        self.data.ledger[from_user].balance - tx.amount)
-                    sp.if self.data.ledger.contains(to_user):
-                        self.data.ledger[to_user].balance += tx.amount
-                    sp.else:
-                         self.data.ledger[to_user] = Ledger_value.make(tx.amount)
-                     # approve all right
-                    sp.verify((self.data.recording_right[tx.token_id] == current_from) &
-                            (self.data.propagating_right[tx.token_id] == current_from) &
-                            (self.data.other_rights[tx.token_id] == current_from), message="NO ALL RIGHT")
-                    self.data.recording_right[tx.token_id] = tx.to_
-                    self.data.propagating_right[tx.token_id] = tx.to_
-                    self.data.other_rights[tx.token_id] = tx.to_
-                sp.else:
-                    pass
+    # approve all right, the rights delegated to from_ follow the token
+    def on_transfer(self, from_, token_id):
+        sp.if self.data.rights.contains(token_id):
+            rights = sp.local("transferred_rights", self.data.rights[token_id]).value
+            sp.verify(self.holds_right(rights.recording, from_) &
+                      self.holds_right(rights.propagating, from_) &
+                      self.holds_right(rights.other, from_), message="NO ALL RIGHT")
+            del self.data.rights[token_id]
 
     @sp.entry_point
     def transferRecordingRight(self, params):
-        # only administrator can change or owner token metatdata, check first
-        sp.verify((sp.sender == self.data.administrator) | (self.data.recording_right[params.token_id] == sp.sender),
+        # only administrator or the holder of the right can change it, check first
+        rights = sp.local("rights", self.get_rights(params.token_id))
+        sp.verify((sp.sender == self.data.administrator) | self.holds_right_or_owns(rights.value.recording, sp.sender, params.token_id),
                   message=self.error_message.not_admin_or_operator())
-        self.data.recording_right[params.token_id] = params.address
+        rights.value.recording = sp.some(params.address)
+        self.data.rights[params.token_id] = rights.value
 
 
     @sp.entry_point
     def transferPropagatingRight(self, params):
-        # only administrator can change or owner token metatdata, check first
-        user = self.ledger_key.make(sp.sender, params.token_id)
-        isOwner = False
-        sp.if self.data.ledger.contains(user):
-             isOwner = self.data.ledger[user].balance > 0
-
-        sp.verify((sp.sender == self.data.administrator) | (self.data.propagating_right[params.token_id] == sp.sender) | isOwner,
+        # only administrator or the holder of the right can change it, check first
+        rights = sp.local("rights", self.get_rights(params.token_id))
+        sp.verify((sp.sender == self.data.administrator) | self.holds_right_or_owns(rights.value.propagating, sp.sender, params.token_id),
                   message=self.error_message.not_admin_or_operator())
-        self.data.propagating_right[params.token_id] = params.address
+        rights.value.propagating = sp.some(params.address)
+        self.data.rights[params.token_id] = rights.value
 
 
     @sp.entry_point
     def transferOtherRightsRight(self, params):
-        # only administrator can change or owner token metatdata, check first
-        user = self.ledger_key.make(sp.sender, params.token_id)
-        isOwner = False
-        sp.if self.data.ledger.contains(user):
-            isOwner = self.data.ledger[user].balance > 0
-
-        sp.verify((sp.sender == self.data.administrator) | (self.data.other_rights[params.token_id] == sp.sender) | isOwner,
+        # only administrator or the holder of the right can change it, check first
+        rights = sp.local("rights", self.get_rights(params.token_id))
+        sp.verify((sp.sender == self.data.administrator) | self.holds_right_or_owns(rights.value.other, sp.sender, params.token_id),
                   message=self.error_message.not_admin_or_operator())
-        self.data.other_rights[params.token_id] = params.address
+        rights.value.other = sp.some(params.address)
+        self.data.rights[params.token_id] = rights.value
 
 
     @sp.entry_point
     def transferAllRight(self, params):
-        # only administrator can change or owner token metatdata, check first
-        user = self.ledger_key.make(sp.sender, params.token_id)
-        isOwner = False
-        sp.if self.data.ledger.contains(user):
-            isOwner = self.data.ledger[user].balance > 0
-
-        sp.verify((sp.sender == self.data.administrator) | isOwner,
+        # only administrator or owner can change all the rights, check first
+        sp.verify((sp.sender == self.data.administrator) | self.is_owner(sp.sender, params.token_id),
                   message=self.error_message.not_admin_or_operator())
 
-        self.data.recording_right[params.token_id] = params.recordingRightAddress
-        self.data.propagating_right[params.token_id] = params.propagatingRightAddress
-        self.data.other_rights[params.token_id] = params.otherRightsAddress
+        self.data.rights[params.token_id] = sp.record(recording = sp.some(params.recordingRightAddress),
+                                                      propagating = sp.some(params.propagatingRightAddress),
+                                                      other = sp.some(params.otherRightsAddress))
+
+
+    def get_rights(self, token_id):
+        return self.data.rights.get(token_id, Rights.owner_holds_all())
+
+    # a right held by the owner is only checked against the ledger when needed
+    def holds_right(self, right, holder):
+        return right.is_none() | (right == sp.some(holder))
 
+    # a right delegated to another holder can only be changed by that holder
+    def holds_right_or_owns(self, right, holder, token_id):
+        return sp.eif(right.is_none(), self.is_owner(holder, token_id), right == sp.some(holder))
 
+    def is_owner(self, user, token_id):
+        if self.config.non_fungible:
+            return self.data.ledger.contains(token_id) & (self.data.ledger[token_id] == user)
+        user = self.ledger_key.make(user, token_id)
+        return self.data.ledger.contains(user) & (self.data.ledger[user].balance > 0)
+
+
+    # the getters return None when the right is held by the owner of the token
+    @sp.offchain_view(pure = True)
     def getRecordingRight(self, params):
-        # sp.verify(~self.is_administrator(sp.sender) & self.data.recording_right.set[params.token_id] != sp.sender,
-        #           message=self.error_message.not_admin_or_operator())
-        sp.result(self.data.recording_right[params.token_id])
+        sp.set_type(params, sp.TRecord(token_id = sp.TNat))
+        sp.result(self.get_rights(params.token_id).recording)
 
 
+    @sp.offchain_view(pure = True)
     def getPropagatingRight(self, params):
-        # sp.verify(~self.is_administrator(sp.sender) & self.data.recording_right.set[params.token_id] != sp.sender,
-        #           message=self.error_message.not_admin_or_operator())
-        sp.result(self.data.propagating_right[params.token_id])
+        sp.set_type(params, sp.TRecord(token_id = sp.TNat))
+        sp.result(self.get_rights(params.token_id).propagating)
 
 
+    @sp.offchain_view(pure = True)
     def getRightsRight(self, params):
-        # sp.verify(~self.is_administrator(sp.sender) & self.data.recording_right.set[params.token_id] != sp.sender,
-        #           message=self.error_message.not_admin_or_operator())
-        sp.result(self.data.other_rights[params.token_id])
+        sp.set_type(params, sp.TRecord(token_id = sp.TNat))
+        sp.result(self.get_rights(params.token_id).other)
+
+
+    @sp.onchain_view()
+    def rights_of_view(self, token_id):
+        """The recording, propagating and other rights of a token in one call,
+        `None` for a right held by the owner."""
+        sp.set_type(token_id, sp.TNat)
+        sp.verify(self.data.token_metadata.contains(token_id), message = self.error_message.token_undefined())
+        sp.result(self.get_rights(token_id))
+
+
+    @sp.offchain_view(pure = True)
+    def rights_of(self, token_ids):
+        """Batched `rights_of_view`, the rights of all the tokens in one run."""
+        sp.set_type(token_ids, sp.TList(sp.TNat))
+        def f_process_token(token_id):
+            sp.verify(self.data.token_metadata.contains(token_id), message = self.error_message.token_undefined())
+            sp.result(sp.record(token_id = token_id, rights = self.get_rights(token_id)))
+        sp.result(token_ids.map(f_process_token))
 
 
 
@@ -729,16 +990,96 @@ class FA2(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrator,
         if self.config.assume_consecutive_token_ids:
             sp.result(sp.range(0, self.data.all_tokens))
         else:
-            sp.result(self.data.all_tokens.elements())
+            tokens = sp.local("tokens", sp.list(t = token_id_type))
+            cursor = sp.local("cursor", self.data.all_tokens.first)
+            sp.while cursor.value.is_some():
+                tokens.value.push(cursor.value.open_some())
+                cursor.value = self.data.all_tokens.next[cursor.value.open_some()]
+            sp.result(tokens.value.rev())
+
+    @sp.offchain_view(pure = True)
+    def all_tokens_page(self, params):
+        """A page of `all_tokens`: at most `limit` token ids starting at
+        position `offset`. Without consecutive token ids the chain is walked
+        from the first token, so the cost grows with `offset + limit`: deep
+        pages should be read with `all_tokens_after` instead."""
+        sp.set_type(params, sp.TRecord(offset = sp.TNat, limit = sp.TNat).layout(("offset", "limit")))
+        if self.config.assume_consecutive_token_ids:
+            sp.result(sp.range(sp.min(params.offset, self.data.all_tokens),
+                               sp.min(params.offset + params.limit, self.data.all_tokens)))
+        else:
+            page = sp.local("page", sp.list(t = token_id_type))
+            index = sp.local("index", sp.nat(0))
+            cursor = sp.local("cursor", self.data.all_tokens.first)
+            sp.while cursor.value.is_some() & (index.value < params.offset + params.limit):
+                sp.if index.value >= params.offset:
+                    page.value.push(cursor.value.open_some())
+                index.value += 1
+                cursor.value = self.data.all_tokens.next[cursor.value.open_some()]
+            sp.result(page.value.rev())
+
+    @sp.offchain_view(pure = True)
+    def all_tokens_after(self, params):
+        """At most `limit` token ids minted after `cursor`, from the first
+        token when `cursor` is `None`. The last id of a page is the cursor of
+        the next one, which also works when the token ids are not consecutive.
+        A `cursor` that is not a minted token id fails with FA2_TOKEN_UNDEFINED."""
+        sp.set_type(params, sp.TRecord(cursor = sp.TOption(token_id_type), limit = sp.TNat).layout(("cursor", "limit")))
+        if self.config.assume_consecutive_token_ids:
+            sp.if params.cursor.is_some():
+                sp.verify(params.cursor.open_some() < self.data.all_tokens, message = self.error_message.token_undefined())
+            start = sp.eif(params.cursor.is_some(), params.cursor.open_some() + 1, sp.nat(0))
+            sp.result(sp.range(sp.min(start, self.data.all_tokens),
+                               sp.min(start + params.limit, self.data.all_tokens)))
+        else:
+            page = sp.local("page", sp.list(t = token_id_type))
+            count = sp.local("count", sp.nat(0))
+            sp.if params.cursor.is_some():
+                sp.verify(self.data.all_tokens.next.contains(params.cursor.open_some()), message = self.error_message.token_undefined())
+            cursor = sp.local("cursor", sp.eif(params.cursor.is_some(),
+                                               self.data.all_tokens.next[params.cursor.open_some()],
+                                               self.data.all_tokens.first))
+            sp.while cursor.value.is_some() & (count.value < params.limit):
+                page.value.push(cursor.value.open_some())
+                count.value += 1
+                cursor.value = self.data.all_tokens.next[cursor.value.open_some()]
+            sp.result(page.value.rev())
 
     @sp.offchain_view(pure = True)
     def total_supply(self, tok):
-        if self.config.store_total_supply:
+        if self.config.non_fungible:
+            sp.set_type(tok, sp.TNat)
+            sp.verify(self.data.token_metadata.contains(tok), message = self.error_message.token_undefined())
+            sp.result(sp.nat(1))
+        elif self.config.store_total_supply:
             sp.result(self.data.total_supply[tok])
         else:
             sp.set_type(tok, sp.TNat)
             sp.result("total-supply not supported")
 
+    @sp.offchain_view(pure = True)
+    def owner_of(self, tok):
+        """Get the owner of a non-fungible token."""
+        sp.set_type(tok, sp.TNat)
+        if self.config.non_fungible:
+            sp.verify(self.data.token_metadata.contains(tok), message = self.error_message.token_undefined())
+            sp.result(self.data.ledger[tok])
+        else:
+            sp.result("owner_of only supported for non-fungible tokens")
+
+    @sp.onchain_view()
+    def owner_of_view(self, tok):
+        """On-chain version of `owner_of`, `None` for an undefined token or
+        a fungible contract."""
+        sp.set_type(tok, sp.TNat)
+        if self.config.non_fungible:
+            sp.if self.data.ledger.contains(tok):
+                sp.result(sp.some(self.data.ledger[tok]))
+            sp.else:
+                sp.result(sp.none)
+        else:
+            sp.result(sp.set_type_expr(sp.none, sp.TOption(sp.TAddress)))
+
     @sp.offchain_view(pure = True)
     def is_operator(self, query):
         sp.set_type(query,
@@ -746,12 +1087,30 @@ class FA2(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrator,
                                owner = sp.TAddress,
                                operator = sp.TAddress).layout(
                                    ("owner", ("operator", "token_id"))))
-        sp.result(
-            self.operator_set.is_member(self.data.operators,
-                                        query.owner,
-                                        query.operator,
-                                        query.token_id)
-        )
+        sp.result(self.is_operator_of(query.owner, query.operator, query.token_id))
+
+    @sp.onchain_view()
+    def is_operator_view(self, query):
+        """On-chain version of `is_operator`."""
+        sp.set_type(query,
+                    sp.TRecord(token_id = sp.TNat,
+                               owner = sp.TAddress,
+                               operator = sp.TAddress).layout(
+                                   ("owner", ("operator", "token_id"))))
+        sp.result(self.is_operator_of(query.owner, query.operator, query.token_id))
+
+    @sp.offchain_view(pure = True)
+    def are_operators(self, queries):
+        """Batched `is_operator`, all the queries are answered in one run."""
+        sp.set_type(queries,
+                    sp.TList(sp.TRecord(token_id = sp.TNat,
+                                        owner = sp.TAddress,
+                                        operator = sp.TAddress).layout(
+                                            ("owner", ("operator", "token_id")))))
+        def f_process_query(query):
+            sp.result(sp.record(request = query,
+                                is_operator = self.is_operator_of(query.owner, query.operator, query.token_id)))
+        sp.result(queries.map(f_process_query))
 
     def __init__(self, config, metadata, admin):
         # Let's show off some meta-programming:
@@ -767,19 +1126,31 @@ class FA2(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrator,
             This view is specified (but optional) in the standard.
 
             This contract is built with assume_consecutive_token_ids =
-            False, so we convert the set of tokens from the storage to a list
-            to fit the expected type of TZIP-16.
+            False, so we walk the chain of token-ids from the storage in
+            minting order to fit the expected type of TZIP-16.
             """
         list_of_views = [
             self.get_balance
             , self.does_token_exist
             , self.count_tokens
             , self.all_tokens
+            , self.all_tokens_page
+            , self.all_tokens_after
             , self.is_operator
+            , self.get_balances
+            , self.are_operators
         ]
 
-        if config.store_total_supply:
+        if config.store_total_supply or config.non_fungible:
             list_of_views = list_of_views + [self.total_supply]
+        if config.non_fungible:
+            list_of_views = list_of_views + [self.owner_of]
+        list_of_views = list_of_views + [
+            self.getRecordingRight
+            , self.getPropagatingRight
+            , self.getRightsRight
+            , self.rights_of
+        ]
         if config.use_token_metadata_offchain_view:
             self.set_token_metadata_view()
             list_of_views = list_of_views + [self.token_metadata]
@@ -816,6 +1187,11 @@ class FA2(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrator,
         self.init_metadata("metadata_base", metadata_base)
         FA2_core.__init__(self, config, metadata, paused = False, administrator = admin)
 
+## live auctions are indexed by the hour of their stop time, see getDueAuctions.
+expiry_bucket_seconds = 3600
+## the most expiryIndex buckets read by one getDueAuctions call, one week of hours.
+due_auctions_max_buckets = 168
+
 ## ## 
 ##
 ## ### NftAuctionMarket Contract
@@ -825,6 +1201,7 @@ class FA2(FA2_change_metadata, FA2_token_metadata, FA2_mint, FA2_administrator,
 ## param _admin:the market administrator address
 ## param _nftAddress: the _FA2.NFT contract address
 ## 
+
 class  NftAuctionMarket(sp.Contract):
 
     ## __init__: constructor function
@@ -864,7 +1241,10 @@ class  NftAuctionMarket(sp.Contract):
                 currentRSAPublicKey = sp.TString,
                 EncryptedSrcUrl  = sp.TString,
                 #status = sp.TBounded(["Initial", "Bidding", "Ended"])
-                status = sp.TVariant(status = sp.TString)                
+                status = sp.TVariant(status = sp.TString),
+                ### True if the token is held by the market during the auction,
+                ### False if the market is only the seller's FA2 operator.
+                escrowed = sp.TBool
             ) ),
 
             ## fans donation records
@@ -921,6 +1301,10 @@ class  NftAuctionMarket(sp.Contract):
                     registeredDate = sp.TString
             ) ),   
 
+            ## live auctions index
+            # expiryIndex key valuable: stopTime bucket (hours since epoch), the token ids which stop in the bucket
+            expiryIndex = sp.TBigMap(sp.TNat, sp.TSet(sp.TNat)),
+
         ) )
 
         # Initialize the contract storage
@@ -932,7 +1316,8 @@ class  NftAuctionMarket(sp.Contract):
             donationRecordsMap = sp.map(),
             voteRecordsMap = sp.map(),
             rankingMaps = sp.map(),
-            ipAssetsCert= sp.map()
+            ipAssetsCert= sp.map(),
+            expiryIndex = sp.big_map()
         )
 
     ##
@@ -1063,13 +1448,103 @@ class  NftAuctionMarket(sp.Contract):
          
 
     ##
-    ## ## openAuction
+    ## ## verifySellerOwnsToken
     ##
-    ## administrater can update author information which is in the authorMap.
+    ## check through the FA2 get_balance_view that the seller still owns the token, unlike
+    ## owner_of_view it also answers for FA2 contracts which are not non_fungible.
     ## 
-    @sp.entry_point     
-    def openAuction(self, _param):  
+    def verifySellerOwnsToken(self, _seller, _token_id):
+        sp.verify(self.sellerBalance(_seller, _token_id) == 1, "the seller does not own the token!")
+
+
+    ##
+    ## ## verifySellerCanDeliver
+    ##
+    ## a non-escrowed auction can only be delivered if the seller still owns the token
+    ## and the auction contract is still the FA2 operator of the token.
+    ## 
+    def verifySellerCanDeliver(self, _seller, _token_id):
+        self.verifySellerOwnsToken(_seller, _token_id)
+        sp.verify(self.isSellerOperator(_seller, _token_id), "the auction contract is not the operator of the seller's token!")
+
+
+    ##
+    ## ## sellerCanDeliver
+    ##
+    ## True if verifySellerCanDeliver succeeds.
+    ## 
+    def sellerCanDeliver(self, _seller, _token_id):
+        return (self.sellerBalance(_seller, _token_id) == 1) & self.isSellerOperator(_seller, _token_id)
+
+
+    ##
+    ## ## sellerBalance
+    ##
+    ## the balance of the token of the seller from the FA2 get_balance_view.
+    ## 
+    def sellerBalance(self, _seller, _token_id):
+        return sp.view("get_balance_view",
+                       self.data.nftContractAddress,
+                       sp.set_type_expr(sp.record(owner = _seller, token_id = _token_id),
+                                        sp.TRecord(owner = sp.TAddress, token_id = sp.TNat).layout(("owner", "token_id"))),
+                       t = sp.TNat).open_some(message = "the get_balance_view of the NFT contract is not available!")
+
+
+    ##
+    ## ## isSellerOperator
+    ##
+    ## True if the auction contract is an FA2 operator of the seller's token, from the FA2 is_operator_view.
+    ## 
+    def isSellerOperator(self, _seller, _token_id):
+        return sp.view("is_operator_view",
+                       self.data.nftContractAddress,
+                       sp.set_type_expr(sp.record(owner = _seller, operator = sp.self_address, token_id = _token_id),
+                                        sp.TRecord(owner = sp.TAddress, operator = sp.TAddress, token_id = sp.TNat).layout(("owner", ("operator", "token_id")))),
+                       t = sp.TBool).open_some(message = "the is_operator_view of the NFT contract is not available!")
+
+
+    ##
+    ## ## expiryBucket
+    ##
+    ## the expiryIndex bucket of a stop time.
+    ## 
+    def expiryBucket(self, _time):
+        return sp.as_nat(_time - sp.timestamp(0), message = "the time should not be before the epoch!") // expiry_bucket_seconds
+
+
+    ##
+    ## ## addToExpiryIndex
+    ##
+    ## index a live auction by its stop time.
+    ## 
+    def addToExpiryIndex(self, _token_id, _stopTime):
+        bucket = sp.local("bucket", self.expiryBucket(_stopTime))
+        sp.if self.data.expiryIndex.contains(bucket.value) :
+            self.data.expiryIndex[bucket.value].add(_token_id)
+        sp.else :
+            self.data.expiryIndex[bucket.value] = sp.set([_token_id])
+
+
+    ##
+    ## ## removeFromExpiryIndex
+    ##
+    ## remove a canceled or settled auction from the index, empty buckets are deleted.
+    ## 
+    def removeFromExpiryIndex(self, _token_id, _stopTime):
+        bucket = sp.local("bucket", self.expiryBucket(_stopTime))
+        sp.if self.data.expiryIndex.contains(bucket.value) :
+            self.data.expiryIndex[bucket.value].remove(_token_id)
+            sp.if sp.len(self.data.expiryIndex[bucket.value]) == 0 :
+                del self.data.expiryIndex[bucket.value]
+
 
+    ##
+    ## ## registerAuction
+    ##
+    ## check the auction parameters and put the goods in goodsStoreMap.
+    ## _escrowed: True if the token was transferred to the auction contract.
+    ## 
+    def registerAuction(self, _param, _escrowed):
         # 1. Initial the input parameter types
         sp.set_type(_param, sp.TRecord(
                                 token_id = sp.TNat,
@@ -1090,10 +1565,6 @@ class  NftAuctionMarket(sp.Contract):
         sp.verify(self.data.authorMap.contains(_param.authorID), "the author id does not exist!")
 
 
-        # 3. transfer the token to the auciton contarct. this can check whether the sender has the transfer right.
-        self.fa2Transfer(self.data.nftContractAddress, _param.sellerAddress, sp.self_address, _param.token_id, 1)
-
-
         # 4.1 if the token is in goodsStoreMap 
         goodsInfo = sp.record(
                             # set the auction information
@@ -1110,7 +1581,8 @@ class  NftAuctionMarket(sp.Contract):
                             currentRSAPublicKey = '',
                             EncryptedSrcUrl = '',
                             # sp.TBounded(["Initial", "Bidding", "Ended"])
-                            status = sp.variant('status', "Initial")
+                            status = sp.variant('status', "Initial"),
+                            escrowed = _escrowed
                         )
 
 
@@ -1126,6 +1598,40 @@ class  NftAuctionMarket(sp.Contract):
         sp.else :
             self.data.goodsStoreMap[_param.token_id] = goodsInfo
 
+        # 7. index the auction by its stop time
+        self.addToExpiryIndex(_param.token_id, _param.stopTime)
+
+
+    ##
+    ## ## openAuction
+    ##
+    ## the seller opens an auction, the token is transferred to the auction contract until the auction ends.
+    ## 
+    @sp.entry_point     
+    def openAuction(self, _param):  
+        # 1. check the parameters and register the goods
+        self.registerAuction(_param, True)
+
+        # 2. transfer the token to the auciton contarct. this can check whether the sender has the transfer right.
+        self.fa2Transfer(self.data.nftContractAddress, _param.sellerAddress, sp.self_address, _param.token_id, 1)
+
+
+    ##
+    ## ## openAuctionWithOperator
+    ##
+    ## the seller opens an auction without escrowing the token: the auction contract must be
+    ## an FA2 operator of the token, which moves only once, from the seller to the buyer, 
+    ## in closeAuctionWithDelivery. Unsold or canceled auctions need no FA2 transfer at all.
+    ## If the seller can not deliver any more, the bidder gets a refund with refundUndeliverableAuction.
+    ## 
+    @sp.entry_point     
+    def openAuctionWithOperator(self, _param):  
+        # 1. check the parameters and register the goods
+        self.registerAuction(_param, False)
+
+        # 2. check the seller owns the token and the auction contract is its operator.
+        self.verifySellerCanDeliver(_param.sellerAddress, _param.token_id)
+
         
     ##
     ## ## englishBidding
@@ -1150,6 +1656,10 @@ class  NftAuctionMarket(sp.Contract):
         # 3. check now is between startingTime and stoppingTime
         sp.verify( (sp.now >= goodsInfo.startTime) & (sp.now <= goodsInfo.stopTime), "the bidding time should be between startTime and stoppTime!")
 
+        # 3.1 a token which is not escrowed must still be deliverable by the seller
+        sp.if ~goodsInfo.escrowed :
+            self.verifySellerCanDeliver(goodsInfo.sellerAddress, _token_id)
+
         # 4. judge the goods state
         ## sp.TBounded(["Initial", "Bidding", "Ended"])
         #currentStatus = goodsInfo.status.open_variant("status", message = "status has no status value!")
@@ -1306,11 +1816,19 @@ class  NftAuctionMarket(sp.Contract):
         # 3. check now is bigger than the stop time
         sp.verify( (sp.now > goodsInfo.stopTime), "the seller can only end the auction after the stop time!")
 
+        # 3.1 the auction is settled, remove it from the expiry index before the stop time is reset
+        self.removeFromExpiryIndex(_token_id, goodsInfo.stopTime)
+
         # 4. check whether there is any bidder
         ## 4.2 has bidder
         sp.if (goodsInfo.currentBidder.is_some()):
             ## 4.2.1 transfer the NFT token to the last bidder
-            self.fa2Transfer(self.data.nftContractAddress, sp.self_address, goodsInfo.currentBidder.open_some(),  _token_id, 1)
+            sp.if goodsInfo.escrowed :
+                self.fa2Transfer(self.data.nftContractAddress, sp.self_address, goodsInfo.currentBidder.open_some(),  _token_id, 1)
+            ### the token is still with the seller, the auction contract transfers it as the operator.
+            sp.else :
+                self.verifySellerCanDeliver(goodsInfo.sellerAddress, _token_id)
+                self.fa2Transfer(self.data.nftContractAddress, goodsInfo.sellerAddress, goodsInfo.currentBidder.open_some(),  _token_id, 1)
 
             ## 4.2.2 transfer the tezos to the seller
             ## verify the balance of the contract is equal to or bigger than the bidding price
@@ -1333,8 +1851,9 @@ class  NftAuctionMarket(sp.Contract):
 
         ## 4.1 no bidder
         sp.else :
-            ## 4.2.1 withdraw the NFT token
-            self.fa2Transfer(self.data.nftContractAddress, sp.self_address, goodsInfo.sellerAddress,  _token_id, 1)
+            ## 4.2.1 withdraw the NFT token if it is escrowed
+            sp.if goodsInfo.escrowed :
+                self.fa2Transfer(self.data.nftContractAddress, sp.self_address, goodsInfo.sellerAddress,  _token_id, 1)
             
             ## 4.2.2 delete the goods
             del self.data.goodsStoreMap[_token_id]
@@ -1363,6 +1882,9 @@ class  NftAuctionMarket(sp.Contract):
       
         #status = sp.TBounded(["Initial", "Bidding", "Ended"])
         sp.verify(  currentStatus != "Ended","the goods status is not Ended, because this seems the auction is ended.")
+
+        # the auction is not live any more
+        self.removeFromExpiryIndex(_token_id, goodsInfo.stopTime)
               
 
         # 4.if there has a bidding, the status must be "Bidding"
@@ -1373,13 +1895,74 @@ class  NftAuctionMarket(sp.Contract):
             sp.send(goodsInfo.currentBidder.open_some(), goodsInfo.currentPrice, message = "returning  previous amount to the previous bidder failed!")
 
 
-        # 5.return the NFT token to the seller
-        self.fa2Transfer(self.data.nftContractAddress, sp.self_address, goodsInfo.sellerAddress,  _token_id, 1)
+        # 5.return the NFT token to the seller if it is escrowed
+        sp.if goodsInfo.escrowed :
+            self.fa2Transfer(self.data.nftContractAddress, sp.self_address, goodsInfo.sellerAddress,  _token_id, 1)
 
         # 6. delete the goods
         del self.data.goodsStoreMap[_token_id]  
 
 
+    ##
+    ## ## refundUndeliverableAuction
+    ##
+    ## after the stop time of a non-escrowed auction, the last bidder gets the bid back if the seller
+    ## does not own the token any more or the auction contract is not its operator any more.
+    ## 
+    @sp.entry_point   
+    def refundUndeliverableAuction(self, _token_id):  
+        # set type, 
+        sp.set_type(_token_id, sp.TNat)
+
+        # 1. check whether the token id is in goodsStore     
+        sp.verify(self.data.goodsStoreMap.contains(_token_id), "the token id is not in goodsStore !") 
+        goodsInfo = self.data.goodsStoreMap[_token_id]
+
+        # 2. check the sender is the last bidder of an auction which is not escrowed
+        sp.verify(~goodsInfo.escrowed, "the token is escrowed by the auction contract!")
+        sp.verify(goodsInfo.currentBidder == sp.some(sp.sender), "the sender must be the current bidder!")
+
+        # 3. check the auction is over and can not be delivered
+        sp.verify( (sp.now > goodsInfo.stopTime), "the bidder can only be refunded after the stop time!")
+        sp.verify(~self.sellerCanDeliver(goodsInfo.sellerAddress, _token_id), "the seller can still deliver the token!")
+
+        # 4. the auction is not live any more
+        self.removeFromExpiryIndex(_token_id, goodsInfo.stopTime)
+
+        # 5. return the bid to the bidder
+        sp.verify( (sp.balance >= goodsInfo.currentPrice), "the balance of the contract must be equal to or bigger than the previous bidding price")
+        sp.send(sp.sender, goodsInfo.currentPrice, message = "returning the bid to the bidder failed!")
+
+        # 6. delete the goods
+        del self.data.goodsStoreMap[_token_id]
+
+
+    ##
+    ## ## getDueAuctions
+    ##
+    ## the live auctions whose stop time is between [fromTime:toTime].
+    ## only the expiryIndex buckets of the range are read, so keepers do not scan goodsStoreMap.
+    ## the range spans at most due_auctions_max_buckets hours, keepers page longer ranges.
+    ## 
+    @sp.onchain_view()
+    def getDueAuctions(self, _param):
+        sp.set_type(_param, sp.TRecord(fromTime = sp.TTimestamp, toTime = sp.TTimestamp))
+
+        dueAuctions = sp.local("dueAuctions", sp.list(t = sp.TNat))
+        bucket = sp.local("bucket", self.expiryBucket(_param.fromTime))
+        lastBucket = self.expiryBucket(_param.toTime)
+        sp.verify(lastBucket < bucket.value + due_auctions_max_buckets, "the range should span at most due_auctions_max_buckets hours!")
+        sp.while bucket.value <= lastBucket :
+            sp.if self.data.expiryIndex.contains(bucket.value) :
+                sp.for token_id in self.data.expiryIndex[bucket.value].elements() :
+                    stopTime = self.data.goodsStoreMap[token_id].stopTime
+                    sp.if (stopTime >= _param.fromTime) & (stopTime <= _param.toTime) :
+                        dueAuctions.value.push(token_id)
+            bucket.value += 1
+
+        sp.result(dueAuctions.value)
+
+
     ##
     ## ## string_of_nat
     ##
@@ -1796,6 +2379,8 @@ def add_test(config, is_default = True):
                                                )   
                                     ])                                         
             nftContract.transfer( transferParam ).run(sender = bob)
+            ## the owner of token 3 is overwritten, no entry is left for bob
+            scenario.verify(nftContract.data.ledger[3] == duncan.address)
 
             # approve Right
             nftContract.mint(address = bob.address,
@@ -1839,6 +2424,33 @@ def add_test(config, is_default = True):
                                                )   
                                     ])                                         
             nftContract.transfer( transferParam ).run(sender = bob)
+            ## the rights follow the token, nothing is stored for tokens whose rights were never delegated
+            scenario.verify(~nftContract.data.rights.contains(5))
+            scenario.verify(~nftContract.data.rights.contains(0))
+            scenario.verify(nftContract.data.rights[4].recording == sp.some(alice.address))
+
+            scenario.h3("owner_of_view and rights_of_view")
+            scenario.verify(nftContract.owner_of_view(5) == sp.some(duncan.address))
+            scenario.verify(nftContract.owner_of_view(4) == sp.some(bob.address))
+            ## an undefined token or a fungible contract has no owner
+            scenario.verify(nftContract.owner_of_view(99) == sp.none)
+            scenario.verify(ftContract.owner_of_view(0) == sp.none)
+            scenario.verify(nftContract.rights_of_view(4) == sp.record(recording = sp.some(alice.address),
+                                                                       propagating = sp.some(duncan.address),
+                                                                       other = sp.some(duncan.address)))
+            scenario.verify(nftContract.rights_of_view(5) == Rights.owner_holds_all())
+
+            scenario.h3("only the holder of a delegated right can transfer it")
+            ## bob owns token 4 but delegated the rights, FAIL
+            nftContract.transferPropagatingRight(token_id = 4 , address = bob.address).run(sender = bob, valid = False)
+            nftContract.transferRecordingRight(token_id = 4 , address = bob.address).run(sender = bob, valid = False)
+            nftContract.transferOtherRightsRight(token_id = 4 , address = alice.address).run(sender = duncan)
+            ## duncan does not hold the right any more, FAIL
+            nftContract.transferOtherRightsRight(token_id = 4 , address = duncan.address).run(sender = duncan, valid = False)
+            nftContract.transferRecordingRight(token_id = 4 , address = bob.address).run(sender = alice)
+            scenario.verify(nftContract.data.rights[4] == sp.record(recording = sp.some(bob.address),
+                                                                   propagating = sp.some(duncan.address),
+                                                                   other = sp.some(alice.address)))
 
 
             scenario.h2("Change token metadata")    
@@ -1856,7 +2468,62 @@ def add_test(config, is_default = True):
                     metadata = mozTestMeta).run(sender = alice, valid = False)                                
             # expect invalid because of token_id not exist
             nftContract.set_token_metadata( token_id = 100,
-                    metadata = mozTestMeta).run(sender = admin, valid = False)   
+                    metadata = mozTestMeta).run(sender = admin, valid = False)
+
+            nftContract.set_token_metadata_batch([sp.record(token_id = token_id, metadata = mozTestMeta) for token_id in [1, 2]]).run(sender = alice, valid = False)
+            nftContract.set_token_metadata_batch([sp.record(token_id = token_id, metadata = mozTestMeta) for token_id in [1, 100]]).run(sender = admin, valid = False)
+            nftContract.set_token_metadata_batch([sp.record(token_id = token_id, metadata = mozTestMeta) for token_id in [1, 2]]).run(sender = admin)
+            scenario.verify(nftContract.data.token_metadata[2].token_info["symbol"] == sp.utils.bytes_of_string("test MOZ@NFT"))
+
+            scenario.h2("Set the metadata base URI and the shared token-info")
+            baseUri = sp.utils.bytes_of_string("ipfs://QmMozikCatalog/")
+            sharedInfo = sp.map(l = {
+                "decimals" : sp.utils.bytes_of_string("0"),
+                "shouldPreferSymbol" : sp.utils.bytes_of_string("true"),
+                "symbol" : sp.utils.bytes_of_string("NFT@MOZIK") })
+            if not config.use_token_metadata_offchain_view:
+                ## the shared token-info is only served by the token_metadata view, FAIL
+                nftContract.set_metadata_base(base_uri = baseUri, defaults = sharedInfo).run(sender = admin, valid = False)
+            else:
+                # expect invalid because of the sender is not the admin
+                nftContract.set_metadata_base(base_uri = baseUri, defaults = sharedInfo).run(sender = alice, valid = False)
+                nftContract.set_metadata_base(base_uri = baseUri, defaults = sharedInfo).run(sender = admin)
+                scenario.verify(nftContract.data.metadata_base_uri == baseUri)
+                scenario.verify(nftContract.data.metadata_defaults["symbol"] == sp.utils.bytes_of_string("NFT@MOZIK"))
+
+                ## the token_metadata view merges the shared token-info with the entries of the token,
+                ## the "" suffix of the token is appended to the base URI
+                nftContract.set_token_metadata(token_id = 3,
+                                               metadata = sp.map(l = {
+                                                   "" : sp.utils.bytes_of_string("track3.json"),
+                                                   "name" : sp.utils.bytes_of_string("Track 3") })).run(sender = admin)
+                scenario.verify_equal(nftContract.token_metadata(3),
+                                      sp.record(token_id = 3,
+                                                token_info = sp.map(l = {
+                                                    "" : sp.utils.bytes_of_string("ipfs://QmMozikCatalog/track3.json"),
+                                                    "decimals" : sp.utils.bytes_of_string("0"),
+                                                    "name" : sp.utils.bytes_of_string("Track 3"),
+                                                    "shouldPreferSymbol" : sp.utils.bytes_of_string("true"),
+                                                    "symbol" : sp.utils.bytes_of_string("NFT@MOZIK") })))
+                ## token 2 overrides the decimals and the symbol and has no URI
+                scenario.verify_equal(nftContract.token_metadata(2),
+                                      sp.record(token_id = 2,
+                                                token_info = sp.map(l = {
+                                                    "decimals" : sp.utils.bytes_of_string("1"),
+                                                    "name" : sp.utils.bytes_of_string("test The MOZIK Non-Fungible Token "),
+                                                    "shouldPreferSymbol" : sp.utils.bytes_of_string("true"),
+                                                    "symbol" : sp.utils.bytes_of_string("test MOZ@NFT") })))
+                ## a full URI is kept as is
+                nftContract.set_token_metadata(token_id = 1,
+                                               metadata = sp.map(l = {
+                                                   "" : sp.utils.bytes_of_string("https://example.com/track1.json") })).run(sender = admin)
+                scenario.verify_equal(nftContract.token_metadata(1),
+                                      sp.record(token_id = 1,
+                                                token_info = sp.map(l = {
+                                                    "" : sp.utils.bytes_of_string("https://example.com/track1.json"),
+                                                    "decimals" : sp.utils.bytes_of_string("0"),
+                                                    "shouldPreferSymbol" : sp.utils.bytes_of_string("true"),
+                                                    "symbol" : sp.utils.bytes_of_string("NFT@MOZIK") })))
 
    
 
@@ -2045,7 +2712,7 @@ def add_test(config, is_default = True):
             nftAuctionContract.closeAuctionWithDelivery(_token_id = 0, _EncryptedSrcUrl = EncryptedSrcUrl).run(sender = bob, now = sp.timestamp(1630723915))
 
             ## check the balance
-            scenario.verify(nftContract.data.ledger[nftContract.ledger_key.make(duncan.address, 0)].balance == 1 )
+            scenario.verify(nftContract.data.ledger[0] == duncan.address)
             scenario.verify(nftAuctionContract.balance == sp.mutez(0))
 
 
@@ -2072,7 +2739,7 @@ def add_test(config, is_default = True):
             EncryptedSrcUrl = ""
             nftAuctionContract.closeAuctionWithDelivery(_token_id = 1, _EncryptedSrcUrl = EncryptedSrcUrl).run(sender = bob, now = sp.timestamp(1630723915))
             ## check the balance
-            scenario.verify(nftContract.data.ledger[nftContract.ledger_key.make(bob.address, 1)].balance == 1 )
+            scenario.verify(nftContract.data.ledger[1] == bob.address)
             scenario.verify(nftAuctionContract.balance == sp.mutez(0))
 
             #  begin openAuction 
@@ -2110,13 +2777,94 @@ def add_test(config, is_default = True):
             scenario.h3("admin cancel the auction,SUCC")  
             nftAuctionContract.cancelAuction(2).run(sender = admin)
             ## check the balance
-            scenario.verify(nftContract.data.ledger[nftContract.ledger_key.make(bob.address, 2)].balance == 1 )
+            scenario.verify(nftContract.data.ledger[2] == bob.address)
             scenario.verify(nftAuctionContract.balance == sp.mutez(0))            
 
             # ## admin cancel the auction token 0,FAIL
             scenario.h3("admin cancel the auction in Ended state,FAIL")  
             nftAuctionContract.cancelAuction(0).run(sender = admin, valid = False)
 
+            #  begin openAuctionWithOperator
+            scenario.h2("Begin openAuctionWithOperator token 6")
+            nftContract.mint(address = bob.address,
+                                amount = 1,
+                                metadata = mozNFTMeta,
+                                token_id = 6).run(sender = admin)
+
+            ## approve bob token 6 to nftAuctionContract, the token stays with bob
+            nftContract.update_operators([
+                sp.variant("add_operator", nftContract.operator_param.make(
+                    owner = bob.address,
+                    operator = nftAuctionContract.address,
+                    token_id = 6))
+            ]).run(sender = bob)
+
+            param = sp.record(token_id = 6, authorID = 0, sellerAddress =  bob.address, auctionTypeEnglish = True, \
+                              startTime = sp.timestamp(1630723485), stopTime = sp.timestamp(1630723485).add_seconds(60), \
+                              startPrice = sp.mutez(100), minStep = sp.mutez(10))
+
+            ## alice does not own token 6, FAIL
+            alice_param = sp.record(token_id = 6, authorID = 0, sellerAddress =  alice.address, auctionTypeEnglish = True, \
+                              startTime = sp.timestamp(1630723485), stopTime = sp.timestamp(1630723485).add_seconds(60), \
+                              startPrice = sp.mutez(100), minStep = sp.mutez(10))
+            nftAuctionContract.openAuctionWithOperator(alice_param).run(sender = alice, now = sp.timestamp(1630723485), valid = False )
+
+            ## bob opens the auction and still holds the token, SUCC
+            nftAuctionContract.openAuctionWithOperator(param).run(sender = bob, now = sp.timestamp(1630723485) )
+            scenario.verify(nftContract.data.ledger[6] == bob.address)
+            scenario.verify(~nftAuctionContract.data.goodsStoreMap[6].escrowed)
+
+            ## the canceled auction does not move the token
+            nftAuctionContract.cancelAuction(6).run(sender = admin)
+            scenario.verify(nftContract.data.ledger[6] == bob.address)
+
+            ## bob opens the auction once more, alice bids
+            nftAuctionContract.openAuctionWithOperator(param).run(sender = bob, now = sp.timestamp(1630723485) )
+            nftAuctionContract.englishBidding(_token_id = 6, _currentRsaPublicKey = publicKey).run(
+                                sender = alice, amount = sp.mutez(100), now = sp.timestamp(1630723495))
+
+            ## the auction is indexed by its stop time
+            scenario.verify_equal(nftAuctionContract.getDueAuctions(sp.record(fromTime = sp.timestamp(1630723485),
+                                                                             toTime = sp.timestamp(1630723915))), [6])
+            scenario.verify(sp.len(nftAuctionContract.getDueAuctions(sp.record(fromTime = sp.timestamp(1630723546),
+                                                                              toTime = sp.timestamp(1630727200)))) == 0)
+
+            ## close the auction, the token goes directly from bob to alice
+            scenario.h3("close the operator auction and delivery the token from the seller. SUCC")
+            nftAuctionContract.closeAuctionWithDelivery(_token_id = 6, _EncryptedSrcUrl = EncryptedSrcUrl).run(sender = bob, now = sp.timestamp(1630723915))
+            scenario.verify(nftContract.data.ledger[6] == alice.address)
+            scenario.verify(nftContract.data.ledger[6] != bob.address)
+            scenario.verify(nftAuctionContract.balance == sp.mutez(0))
+            scenario.verify(sp.len(nftAuctionContract.getDueAuctions(sp.record(fromTime = sp.timestamp(1630723485),
+                                                                              toTime = sp.timestamp(1630723915)))) == 0)
+
+            ## alice auctions token 6 without escrow, the auction contract is not her operator, FAIL
+            scenario.h3("refund the bidder of an auction the seller can not deliver")
+            alice_param = sp.record(token_id = 6, authorID = 0, sellerAddress =  alice.address, auctionTypeEnglish = True, \
+                              startTime = sp.timestamp(1630730000), stopTime = sp.timestamp(1630730060), \
+                              startPrice = sp.mutez(100), minStep = sp.mutez(10))
+            nftAuctionContract.openAuctionWithOperator(alice_param).run(sender = alice, now = sp.timestamp(1630730000), valid = False)
+            alice_operator = nftContract.operator_param.make(owner = alice.address, operator = nftAuctionContract.address, token_id = 6)
+            nftContract.update_operators([sp.variant("add_operator", alice_operator)]).run(sender = alice)
+            nftAuctionContract.openAuctionWithOperator(alice_param).run(sender = alice, now = sp.timestamp(1630730000))
+            nftAuctionContract.englishBidding(_token_id = 6, _currentRsaPublicKey = publicKey).run(
+                                sender = duncan, amount = sp.mutez(100), now = sp.timestamp(1630730010))
+
+            ## alice revokes the approval, bob can not bid any more, FAIL
+            nftContract.update_operators([sp.variant("remove_operator", alice_operator)]).run(sender = alice)
+            nftAuctionContract.englishBidding(_token_id = 6, _currentRsaPublicKey = publicKey).run(
+                                sender = bob, amount = sp.mutez(110), now = sp.timestamp(1630730020), valid = False)
+
+            ## only duncan after the stop time, FAIL
+            nftAuctionContract.refundUndeliverableAuction(6).run(sender = duncan, now = sp.timestamp(1630730030), valid = False)
+            nftAuctionContract.refundUndeliverableAuction(6).run(sender = bob, now = sp.timestamp(1630730100), valid = False)
+            ## the delivery fails, duncan gets the bid back
+            nftAuctionContract.closeAuctionWithDelivery(_token_id = 6, _EncryptedSrcUrl = EncryptedSrcUrl).run(sender = alice, now = sp.timestamp(1630730100), valid = False)
+            nftAuctionContract.refundUndeliverableAuction(6).run(sender = duncan, now = sp.timestamp(1630730100))
+            scenario.verify(~nftAuctionContract.data.goodsStoreMap.contains(6))
+            scenario.verify(nftAuctionContract.balance == sp.mutez(0))
+            scenario.verify(nftContract.data.ledger[6] == alice.address)
+
 
             ## remove apporval of bob token 0 to nftAuctionContract because bob has no token 0
             nftContract.update_operators([
@@ -2140,7 +2888,63 @@ def add_test(config, is_default = True):
                     token_id = 2))
             ]).run(sender = bob)   
 
-            
+            # mint a catalog of tokens 7/8/9 in one operation
+            scenario.h2("Begin mint_batch tokens 7/8/9")
+            batch = [sp.record(address = alice.address, amount = 1, metadata = mozNFTMeta, token_id = token_id) for token_id in [7, 8, 9]]
+            ## only the administrator can mint, FAIL
+            nftContract.mint_batch(batch).run(sender = alice, valid = False)
+            ## the token-ids must continue the existing ones, FAIL
+            nftContract.mint_batch([sp.record(address = alice.address, amount = 1, metadata = mozNFTMeta, token_id = token_id) for token_id in [7, 9]]).run(sender = admin, valid = False)
+            nftContract.mint_batch(batch).run(sender = admin)
+            scenario.verify(nftContract.data.all_tokens == 10)
+            scenario.verify(nftContract.data.ledger[9] == alice.address)
+            ## minted twice, FAIL
+            nftContract.mint_batch(batch).run(sender = admin, valid = False)
+
+            scenario.h2("Begin update_operators_for_all")
+            def alice_to_duncan(token_id):
+                return [nftContract.batch_transfer.item(from_ = alice.address,
+                                    txs = [sp.record(to_ = duncan.address, amount = 1, token_id = token_id)])]
+            approval = nftContract.operator_param.make_for_all(owner = alice.address, operator = bob.address)
+            ## bob is not an operator of alice, FAIL
+            nftContract.transfer(alice_to_duncan(7)).run(sender = bob, valid = False)
+            ## only alice or the administrator approve for alice, FAIL
+            nftContract.update_operators_for_all([sp.variant("add_operator", approval)]).run(sender = bob, valid = False)
+            nftContract.update_operators_for_all([sp.variant("add_operator", approval)]).run(sender = alice)
+            nftContract.transfer(alice_to_duncan(7)).run(sender = bob)
+            nftContract.transfer(alice_to_duncan(8)).run(sender = bob)
+            scenario.verify(nftContract.data.ledger[7] == duncan.address)
+            scenario.verify(nftContract.data.ledger[8] == duncan.address)
+            nftContract.update_operators_for_all([sp.variant("remove_operator", approval)]).run(sender = alice)
+            nftContract.transfer(alice_to_duncan(9)).run(sender = bob, valid = False)
+
+            scenario.h2("Batched views get_balances, are_operators and rights_of")
+            ## one response per query in the order of the queries, unknown owners have a balance of 0
+            requests = [sp.record(owner = alice.address, token_id = 9),
+                        sp.record(owner = duncan.address, token_id = 7),
+                        sp.record(owner = bob.address, token_id = 9),
+                        sp.record(owner = admin.address, token_id = 8)]
+            scenario.verify_equal(nftContract.get_balances(requests),
+                                  [sp.record(request = request, balance = balance) for (request, balance) in zip(requests, [1, 1, 0, 0])])
+
+            nftContract.update_operators([
+                sp.variant("add_operator", nftContract.operator_param.make(
+                    owner = alice.address,
+                    operator = duncan.address,
+                    token_id = 9))
+            ]).run(sender = alice)
+            queries = [sp.record(owner = alice.address, operator = duncan.address, token_id = 9),
+                       sp.record(owner = alice.address, operator = duncan.address, token_id = 7),
+                       sp.record(owner = alice.address, operator = bob.address, token_id = 9),
+                       sp.record(owner = duncan.address, operator = alice.address, token_id = 7)]
+            scenario.verify_equal(nftContract.are_operators(queries),
+                                  [sp.record(request = query, is_operator = is_operator) for (query, is_operator) in zip(queries, [True, False, False, False])])
+
+            scenario.verify_equal(nftContract.rights_of([4, 5]),
+                                  [sp.record(token_id = 4, rights = sp.record(recording = sp.some(bob.address),
+                                                                              propagating = sp.some(duncan.address),
+                                                                              other = sp.some(alice.address))),
+                                   sp.record(token_id = 5, rights = Rights.owner_holds_all())])
 
             return
 
@@ -2476,6 +3280,116 @@ def environment_config():
         use_token_metadata_offchain_view = global_parameter("use_token_metadata_offchain_view", True),
     )
 
+## ## Transfer benchmark
+##
+## Runs transfer batches of growing sizes, once by the owner and once by an
+## operator. The gas reported for each run divided by the batch size gives
+## the gas per transaction.
+def add_transfer_benchmark(config, batch_sizes = [1, 10, 50], is_default = True):
+    @sp.add_test(name = "Transfer benchmark: " + config.name, is_default = is_default)
+    def test():
+        scenario = sp.test_scenario()
+        scenario.h1("Transfer benchmark: " + config.name)
+        admin = sp.test_account("administrator")
+        alice = sp.test_account("alice")
+        bob   = sp.test_account("bob")
+        operator = sp.test_account("operator")
+        c1 = FA2(config = config,
+                 metadata = sp.utils.metadata_of_url("https://example.com"),
+                 admin = admin.address)
+        scenario += c1
+        benchMeta = FA2.make_metadata(name = "Benchmark", decimals = 0, symbol = "BNC")
+        # 1.mint the tokens moved by the biggest batch to alice
+        size = max(batch_sizes)
+        if config.non_fungible:
+            token_ids = list(range(size))
+            c1.mint_batch([sp.record(address = alice.address,
+                                     amount = 1,
+                                     metadata = benchMeta,
+                                     token_id = token_id) for token_id in token_ids]).run(sender = admin)
+        else:
+            token_ids = [0] * size
+            c1.mint(address = alice.address,
+                    amount = size,
+                    metadata = benchMeta,
+                    token_id = 0).run(sender = admin)
+        # 2.alice lets the operator move every token
+        c1.update_operators([
+            sp.variant("add_operator", c1.operator_param.make(
+                owner = alice.address,
+                operator = operator.address,
+                token_id = token_id)) for token_id in sorted(set(token_ids))
+        ]).run(sender = alice)
+        # 3.transfer each batch size to bob and back
+        for batch_size in batch_sizes:
+            def batch(from_, to_):
+                return [c1.batch_transfer.item(from_ = from_,
+                                               txs = [sp.record(to_ = to_,
+                                                                amount = 1,
+                                                                token_id = token_id)
+                                                      for token_id in token_ids[:batch_size]])]
+            scenario.h2("Batch of %d transactions by the owner" % batch_size)
+            c1.transfer(batch(alice.address, bob.address)).run(sender = alice)
+            c1.transfer(batch(bob.address, alice.address)).run(sender = bob)
+            scenario.h2("Batch of %d transactions by an operator" % batch_size)
+            c1.transfer(batch(alice.address, bob.address)).run(sender = operator)
+            c1.transfer(batch(bob.address, alice.address)).run(sender = bob)
+        if config.non_fungible:
+            scenario.verify(c1.data.ledger[size - 1] == alice.address)
+            scenario.verify(c1.token_id_set.cardinal(c1.data.all_tokens) == size)
+        else:
+            scenario.verify(c1.data.ledger[c1.ledger_key.make(alice.address, 0)].balance == size)
+
+def add_pagination_test(config, token_ids = list(range(5)), is_default = True):
+    @sp.add_test(name = "Pagination: " + config.name, is_default = is_default)
+    def test():
+        scenario = sp.test_scenario()
+        scenario.h1("Pagination: " + config.name)
+        admin = sp.test_account("administrator")
+        alice = sp.test_account("alice")
+        c1 = FA2(config = config,
+                 metadata = sp.utils.metadata_of_url("https://example.com"),
+                 admin = admin.address)
+        scenario += c1
+        pageMeta = FA2.make_metadata(name = "Page", decimals = 0, symbol = "PAG")
+        c1.mint_batch([sp.record(address = alice.address,
+                                 amount = 1,
+                                 metadata = pageMeta,
+                                 token_id = token_id) for token_id in token_ids]).run(sender = admin)
+        size = len(token_ids)
+        scenario.h2("all_tokens_page")
+        scenario.verify_equal(c1.all_tokens_page(sp.record(offset = 0, limit = size)), token_ids)
+        scenario.verify_equal(c1.all_tokens_page(sp.record(offset = 2, limit = 2)), token_ids[2:4])
+        ## a page running past the end is cut, a page starting past the end is empty
+        scenario.verify_equal(c1.all_tokens_page(sp.record(offset = size - 1, limit = 5)), token_ids[size - 1:])
+        scenario.verify_equal(c1.all_tokens_page(sp.record(offset = size + 2, limit = 5)), [])
+        scenario.verify_equal(c1.all_tokens_page(sp.record(offset = 0, limit = 0)), [])
+        scenario.h2("all_tokens_after")
+        ## the last id of each page is the cursor of the next one
+        cursor = sp.none
+        for start in range(0, size + 1, 2):
+            scenario.verify_equal(c1.all_tokens_after(sp.record(cursor = cursor, limit = 2)), token_ids[start:start + 2])
+            if start + 1 < size:
+                cursor = sp.some(token_ids[start + 1])
+        scenario.verify_equal(c1.all_tokens_after(sp.record(cursor = sp.some(token_ids[size - 1]), limit = 2)), [])
+        scenario.verify_equal(c1.all_tokens_after(sp.record(cursor = sp.none, limit = 0)), [])
+        if not config.assume_consecutive_token_ids:
+            scenario.h2("The chain of the non-consecutive token ids")
+            ## the tokens are chained in the minting order, whatever their ids
+            scenario.verify_equal(c1.all_tokens(), token_ids)
+            scenario.verify(c1.data.all_tokens.first == sp.some(token_ids[0]))
+            scenario.verify(c1.data.all_tokens.last == sp.some(token_ids[-1]))
+            scenario.verify(c1.data.all_tokens.next[token_ids[-1]] == sp.none)
+            scenario.verify(c1.data.all_tokens.size == size)
+            ## minting more of an existing token does not chain it twice
+            remint = sp.record(address = alice.address, amount = 1, metadata = pageMeta, token_id = token_ids[0])
+            if config.non_fungible:
+                c1.mint(remint).run(sender = admin, valid = False)
+            else:
+                c1.mint(remint).run(sender = admin)
+            scenario.verify(c1.data.all_tokens.size == size)
+            scenario.verify_equal(c1.all_tokens(), token_ids)
+
 ## ## Standard “main”
 ##
 ## This specific main uses the relative new feature of non-default tests
@@ -2500,6 +3414,17 @@ if "templates" not in __name__:
                  , is_default = not sp.in_browser)
         add_test(FA2_config(lazy_entry_points = True)
                  , is_default = not sp.in_browser)
+        add_transfer_benchmark(FA2_config(non_fungible = True),
+                               is_default = not sp.in_browser)
+        add_transfer_benchmark(FA2_config(non_fungible = True, assume_consecutive_token_ids = False),
+                               is_default = not sp.in_browser)
+        add_transfer_benchmark(FA2_config(), is_default = not sp.in_browser)
+        add_pagination_test(FA2_config(non_fungible = True),
+                            is_default = not sp.in_browser)
+        add_pagination_test(FA2_config(non_fungible = True, assume_consecutive_token_ids = False),
+                            token_ids = [10, 3, 7, 42, 5], is_default = not sp.in_browser)
+        add_pagination_test(FA2_config(assume_consecutive_token_ids = False),
+                            token_ids = [10, 3, 7, 42, 5], is_default = not sp.in_browser)
 
     sp.add_compilation_target("FA2_MOZ_NFT", FA2(config = environment_config(),
                               metadata = sp.utils.metadata_of_url("ipfs://Qmf6tjsd7kwHESMJhCLYNHF7j6AdGNmtnBrcVC4aS87YwL"),